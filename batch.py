@@ -0,0 +1,425 @@
+import argparse
+import glob
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import tpf
+import tracing
+import validate
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+# Images with more pixels than this are encoded to text TPF in row bands
+# spread over the worker pool instead of as one task
+BAND_SPLIT_PIXELS = 1 << 22
+
+
+def find_inputs(patterns, recursive=False):
+    files = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, dirs, names in os.walk(pattern):
+                files.extend(os.path.join(root, name) for name in sorted(names))
+                if not recursive:
+                    break
+                dirs.sort()
+        else:
+            # A pattern that matches nothing is kept so it gets reported
+            files.extend(sorted(glob.glob(pattern, recursive=True)) or [pattern])
+    return [f for f in files if f.lower().endswith(('.tpf',) + IMAGE_EXTENSIONS)
+            or not os.path.exists(f)]
+
+
+def output_path(file_path, output_dir, image_format):
+    directory, name = os.path.split(file_path)
+    stem, ext = os.path.splitext(name)
+    ext = "." + image_format if ext.lower() == '.tpf' else ".tpf"
+    return os.path.join(output_dir or directory, stem + ext)
+
+
+def claim_output(save_path, claimed, file_path):
+    # Inputs such as a.png and a.jpg map to one output; only the first is
+    # converted, since parallel workers would overwrite each other's result
+    key = os.path.normcase(os.path.abspath(save_path))
+    if key in claimed:
+        raise ValueError(f"{save_path} is already the output of {claimed[key]}")
+    claimed[key] = file_path
+
+
+def write_tpf_file(save_path, pixels, tpf_format, progress=None, codec=None):
+    # codec is a (compression, level) pair for compressed text formats
+    if tpf_format in tpf.TEXT_FORMATS:
+        compression, level = codec or (tpf.COMPRESSION_NONE, tpf.DEFAULT_LEVEL)
+        tpf.write(save_path, pixels, progress=progress, tpf_format=tpf_format,
+                  compression=compression, level=level)
+    else:
+        compression = tpf.COMPRESSION_ZLIB if tpf_format == 'zlib' else tpf.COMPRESSION_NONE
+        tpf.write_binary(save_path, pixels, compression, progress=progress)
+
+
+def parse_crop(text):
+    try:
+        x, y, width, height = map(int, text.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected X,Y,WIDTH,HEIGHT")
+    if width <= 0 or height <= 0:
+        raise argparse.ArgumentTypeError("the crop must not be empty")
+    return x, y, width, height
+
+
+def parse_codec(text):
+    name, _, level = text.partition(':')
+    if name not in tpf.CODECS:
+        raise argparse.ArgumentTypeError(f"unknown codec {name!r}, expected one of {', '.join(tpf.CODECS)}")
+    compression = tpf.CODECS[name]
+    try:
+        level = int(level) if level else tpf.DEFAULT_LEVEL
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected CODEC[:LEVEL]")
+    levels = tpf.CODEC_LEVELS[compression]
+    if level not in levels:
+        raise argparse.ArgumentTypeError(f"{name} levels go from {levels[0]} to {levels[-1]}")
+    return compression, level
+
+
+def read_pixels(file_path, progress=None):
+    if file_path.lower().endswith('.tpf'):
+        return tpf.read(file_path, progress=progress)
+    from PIL import Image
+    with Image.open(file_path) as img:
+        return tpf.from_pil(img)
+
+
+def codec_report(pixels, tpf_format='text', progress=None):
+    """Time every codec and level on pixels written in a text TPF format.
+
+    Returns (plain text size, rows) where every row is a dict with the
+    codec name, level, compressed size, ratio against the plain text and
+    the encode and decode rates in MB/s of plain text.
+    """
+    import tempfile
+    runs = [(name, level) for name, compression in tpf.CODECS.items()
+            for level in tpf.CODEC_LEVELS[compression]]
+    rows = []
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'report.tpf')
+        tpf.write(path, pixels, tpf_format=tpf_format)
+        plain = os.path.getsize(path)
+        for i, (name, level) in enumerate(runs):
+            if progress:
+                progress(i, len(runs))
+            start = time.perf_counter()
+            tpf.write(path, pixels, tpf_format=tpf_format,
+                      compression=tpf.CODECS[name], level=level)
+            encoded = time.perf_counter()
+            tpf.read(path)
+            decoded = time.perf_counter()
+            size = os.path.getsize(path)
+            rows.append({
+                'codec': name, 'level': level, 'bytes': size,
+                'ratio': plain / max(size, 1),
+                'encode_mbps': plain / max(encoded - start, 1e-9) / 1e6,
+                'decode_mbps': plain / max(decoded - encoded, 1e-9) / 1e6,
+            })
+    if progress:
+        progress(len(runs), len(runs))
+    return plain, rows
+
+
+def format_codec_report(plain, rows):
+    lines = [f"plain text: {plain} bytes",
+             f"{'codec':<6}{'level':>6}{'bytes':>12}{'ratio':>8}{'encode':>12}{'decode':>12}"]
+    for row in rows:
+        lines.append(f"{row['codec']:<6}{row['level']:>6}{row['bytes']:>12}{row['ratio']:>7.1f}x"
+                     f"{row['encode_mbps']:>7.1f} MB/s{row['decode_mbps']:>7.1f} MB/s")
+    return "\n".join(lines)
+
+
+def convert_file(file_path, save_path, tpf_format, progress=None, crop=None, codec=None):
+    # Runs in a worker process or thread; returns (bytes read, bytes written).
+    # Outputs go through a temporary file, so failures leave nothing behind.
+    # crop is an (x, y, width, height) rectangle, clipped to each image.
+    from PIL import Image
+    if file_path.lower().endswith('.tpf'):
+        # A crop of a big TPF file only decodes the rows it covers
+        if crop:
+            pixels = tpf.decode_region(file_path, *crop)
+        else:
+            pixels = tpf.read(file_path, progress=progress)
+        with tracing.span('save image', pixels=pixels.shape[0] * pixels.shape[1]):
+            img = tpf.to_pil(pixels)
+            with tpf.atomic_path(save_path) as temp_path:
+                img.save(temp_path)
+    else:
+        with tracing.span('load image', bytes=os.path.getsize(file_path)) as span:
+            with Image.open(file_path) as img:
+                if crop:
+                    x, y, width, height = crop
+                    img = img.crop((max(x, 0), max(y, 0),
+                                    min(x + width, img.width), min(y + height, img.height)))
+                pixels = tpf.from_pil(img)
+            span.add(pixels=pixels.shape[0] * pixels.shape[1])
+        write_tpf_file(save_path, pixels, tpf_format, progress, codec)
+    return os.path.getsize(file_path), os.path.getsize(save_path)
+
+
+def translate_tpf(file_path, save_path, tpf_format, progress=None, codec=None):
+    # Rewrites a TPF file in another TPF format without going through PIL
+    write_tpf_file(save_path, tpf.read(file_path, progress=progress), tpf_format, progress, codec)
+
+
+def submit(executor, func, *args, **kwargs):
+    # With tracing on, worker processes send their spans back with the result
+    if tracing.enabled():
+        return executor.submit(tracing.call, func, *args, **kwargs)
+    return executor.submit(func, *args, **kwargs)
+
+
+def future_result(future):
+    # The result of a future from submit()
+    if tracing.enabled():
+        return tracing.merge(future.result())
+    return future.result()
+
+
+def encode_band(pixels, first_row, tpf_format):
+    if tpf_format == 'runs':
+        return tpf.encode_runs(pixels, first_row).tobytes()
+    return tpf.encode_rows(pixels, first_row).tobytes()
+
+
+def convert_in_bands(executor, jobs, file_path, save_path, tpf_format):
+    # Encode row bands of one large image in parallel and write them in order
+    from PIL import Image
+    with Image.open(file_path) as img:
+        pixels = tpf.from_pil(img)
+    height, width = pixels.shape[:2]
+    rows = max(1, tpf.ENCODE_BLOCK_PIXELS // width)
+    pending = deque()
+    try:
+        with tpf.atomic_path(save_path) as temp_path:
+            with open(temp_path, 'wb', buffering=tpf.WRITE_BUFFER_SIZE) as f:
+                f.write(tpf.format_header(width, height))
+                for y in range(0, height, rows):
+                    # Keep a bounded number of bands in flight
+                    if len(pending) >= 2 * jobs:
+                        f.write(future_result(pending.popleft()))
+                    pending.append(submit(executor, encode_band, pixels[y:y + rows], y, tpf_format))
+                while pending:
+                    f.write(future_result(pending.popleft()))
+    finally:
+        for future in pending:
+            future.cancel()
+    return os.path.getsize(file_path), os.path.getsize(save_path)
+
+
+def repair_path(file_path, output_dir):
+    if output_dir:
+        return os.path.join(output_dir, os.path.basename(file_path))
+    stem, ext = os.path.splitext(file_path)
+    return stem + ".repaired" + ext
+
+
+def check_file(file_path, save_path=None, tpf_format='text', codec=None):
+    # Runs in a worker process; returns the validate.Report. With save_path,
+    # a file with problems is written there again without the lines the
+    # check found errors in, with runs clipped and the canonical header
+    report = validate.check(file_path, decode=bool(save_path))
+    pixels, report.pixels = report.pixels, None
+    if pixels is not None and report.problems and not report.fatal():
+        write_tpf_file(save_path, pixels, tpf_format, codec=codec)
+        report.repaired = save_path
+    return report
+
+
+def is_large_image(file_path):
+    if file_path.lower().endswith('.tpf'):
+        return False
+    from PIL import Image
+    with Image.open(file_path) as img:
+        width, height = img.size
+    return width * height > BAND_SPLIT_PIXELS
+
+
+def _batch_counts(result, *args):
+    results, _ = result
+    return {'bytes': sum(read + written for read, written in results)}
+
+
+@tracing.traced('batch', _batch_counts)
+def convert_files(files, args, jobs):
+    # Returns the (bytes read, bytes written) of every converted file and
+    # the (file, error) of every failure
+    failures = []
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = []
+        large = []
+        claimed = {}
+        for file_path in files:
+            save_path = output_path(file_path, args.output_dir, args.image_format)
+            try:
+                claim_output(save_path, claimed, file_path)
+                # Palette files need every color up front and compressed ones
+                # are chunked by tpf.write itself, so neither is split
+                if (args.tpf_format in ('text', 'runs') and not args.crop and not args.compress
+                        and is_large_image(file_path)):
+                    large.append((file_path, save_path))
+                    continue
+            except Exception as e:
+                failures.append((file_path, e))
+                continue
+            future = submit(executor, convert_file, file_path, save_path, args.tpf_format,
+                            crop=args.crop, codec=args.compress)
+            futures.append((file_path, future))
+
+        # Large images are split here and their bands share the pool with
+        # the whole-file tasks queued above
+        results = []
+        for file_path, save_path in large:
+            try:
+                results.append(convert_in_bands(executor, jobs, file_path, save_path, args.tpf_format))
+            except Exception as e:
+                failures.append((file_path, e))
+
+        for file_path, future in futures:
+            try:
+                results.append(future_result(future))
+            except Exception as e:
+                failures.append((file_path, e))
+    return results, failures
+
+
+def run_batch(argv):
+    argv = tracing.from_argv(argv)
+    parser = argparse.ArgumentParser(
+        prog="batch.py",
+        description="Convert images to TPF and TPF files to images without opening a window.",
+        epilog="Pass --profile [trace.json] or set TPF_PROFILE=trace.json to record "
+               "a Chrome trace of the conversion."
+    )
+    parser.add_argument('inputs', nargs='+', help="files, directories or glob patterns")
+    parser.add_argument('-o', '--output-dir', help="write results here instead of next to the inputs")
+    parser.add_argument('-r', '--recursive', action='store_true', help="descend into subdirectories")
+    parser.add_argument('--image-format', choices=('png', 'jpg'), default='png',
+                        help="format for images converted from TPF (default: png)")
+    parser.add_argument('--tpf-format', choices=tpf.TEXT_FORMATS + ('binary', 'zlib'), default='text',
+                        help="format for TPF files converted from images (default: text)")
+    parser.add_argument('--compress', type=parse_codec, metavar='CODEC[:LEVEL]',
+                        help="compress text TPF output with zlib or lzma, e.g. lzma:9 "
+                             f"(default level: {tpf.DEFAULT_LEVEL})")
+    parser.add_argument('--codec-report', action='store_true',
+                        help="instead of converting, print the size and speed of every "
+                             "codec level on each input")
+    parser.add_argument('--check', action='store_true',
+                        help="instead of converting, check every TPF input and report "
+                             "problems with their line numbers")
+    parser.add_argument('--repair', action='store_true',
+                        help="like --check, and write every file with problems again in "
+                             "--tpf-format, to --output-dir or as NAME.repaired.tpf")
+    parser.add_argument('--crop', type=parse_crop, metavar='X,Y,WIDTH,HEIGHT',
+                        help="only convert this rectangle of every input")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help="worker processes (default: number of cores)")
+    args = parser.parse_args(argv)
+    if args.compress and args.tpf_format not in tpf.TEXT_FORMATS:
+        parser.error("--compress only applies to the text TPF formats")
+
+    files = find_inputs(args.inputs, args.recursive)
+    if not files:
+        print("No TPF or image files found", file=sys.stderr)
+        return 2
+    if args.check or args.repair:
+        return run_check(files, args, max(1, args.jobs))
+    if args.codec_report:
+        return run_codec_report(files, args.tpf_format if args.tpf_format in tpf.TEXT_FORMATS else 'text')
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    jobs = max(1, args.jobs)
+    start = time.perf_counter()
+    results, failures = convert_files(files, args, jobs)
+    bytes_in = bytes_out = 0
+
+    for read, written in results:
+        bytes_in += read
+        bytes_out += written
+    for file_path, error in failures:
+        print(f"error: {file_path}: {error}", file=sys.stderr)
+
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    converted = len(files) - len(failures)
+    print(
+        f"Converted {converted} of {len(files)} files in {elapsed:.2f} s "
+        f"({converted / elapsed:.1f} files/s, {bytes_in / elapsed / 1e6:.1f} MB/s read, "
+        f"{bytes_out / elapsed / 1e6:.1f} MB/s written)"
+    )
+    if tracing.enabled():
+        print(tracing.summary('batch'))
+    return 1 if failures else 0
+
+
+def run_check(files, args, jobs):
+    files = [f for f in files if f.lower().endswith('.tpf') or not os.path.exists(f)]
+    if not files:
+        print("No TPF files found", file=sys.stderr)
+        return 2
+    if args.repair and args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    start = time.perf_counter()
+    total = failed = broken = repaired = 0
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = []
+        claimed = {}
+        for file_path in files:
+            save_path = repair_path(file_path, args.output_dir) if args.repair else None
+            if save_path:
+                try:
+                    claim_output(save_path, claimed, file_path)
+                except ValueError as e:
+                    print(f"error: {file_path}: {e}", file=sys.stderr)
+                    failed += 1
+                    continue
+            futures.append((file_path, submit(executor, check_file, file_path, save_path,
+                                              args.tpf_format, codec=args.compress)))
+        for file_path, future in futures:
+            try:
+                report = future_result(future)
+            except Exception as e:
+                print(f"error: {file_path}: {e}", file=sys.stderr)
+                failed += 1
+                continue
+            total += os.path.getsize(file_path)
+            print(report.format())
+            if report.repaired:
+                repaired += 1
+            elif report.errors():
+                broken += 1
+
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    summary = (f"Checked {len(files) - failed} of {len(files)} files in {elapsed:.2f} s "
+               f"({total / elapsed / 1e6:.1f} MB/s): {broken} with errors")
+    if args.repair:
+        summary += f", {repaired} repaired"
+    print(summary)
+    return 1 if failed or broken else 0
+
+
+def run_codec_report(files, tpf_format):
+    failed = False
+    for file_path in files:
+        try:
+            report = codec_report(read_pixels(file_path), tpf_format)
+        except Exception as e:
+            print(f"error: {file_path}: {e}", file=sys.stderr)
+            failed = True
+            continue
+        print(f"{file_path} ({tpf_format})")
+        print(format_codec_report(*report))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(run_batch(sys.argv[1:]))
@@ -0,0 +1,620 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+
+import tpf
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+KINDS = ('noise', 'flat', 'gradient', 'maze')
+SIZES = ('1x1', '256x256', '1000x1000', '2000x2000')
+BRUSH_SIZES = (1, 5, 10, 25, 50, 99)
+# Strokes per run of a stroke case
+STROKES = 100
+
+# Every dialect the readers accept, with the writer arguments that produce it
+DIALECTS = {
+    'text': {'tpf_format': 'text'},
+    'bare': {'tpf_format': 'text', 'version': None},
+    'runs': {'tpf_format': 'runs'},
+    'palette': {'tpf_format': 'palette'},
+    'binary': {'compression': tpf.COMPRESSION_NONE},
+    'zlib': {'compression': tpf.COMPRESSION_ZLIB},
+    'runs-zlib': {'tpf_format': 'runs', 'compression': tpf.COMPRESSION_ZLIB},
+    'runs-lzma': {'tpf_format': 'runs', 'compression': tpf.COMPRESSION_LZMA, 'level': 1},
+}
+
+# A case is slower than the baseline if it takes this much longer
+REGRESSION_THRESHOLD = 0.25
+
+# Cold-start budgets in seconds: import time of the headless modules (from
+# -X importtime) and the wall time from launch to the first shown window
+STARTUP_BUDGETS = {
+    'import tpf': 0.3,
+    'import batch': 0.3,
+    'import paint': 0.6,
+    'first window converter': 1.5,
+    'first window viewer': 1.5,
+    'first window paint': 1.5,
+}
+WINDOWS = {
+    'converter': 'ImageConverter',
+    'viewer': 'TPFViewer',
+    'paint': 'MainWindow',
+}
+
+
+def make_pixels(kind, width, height, seed=0):
+    """Deterministic test pictures: camera-like noise, flat artwork, gradients, mazes."""
+    rng = np.random.default_rng(seed)
+    if kind == 'maze':
+        return make_maze(width, height, rng)
+    if kind == 'noise':
+        return rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    if kind == 'gradient':
+        pixels = np.empty((height, width, 3), dtype=np.uint8)
+        pixels[..., 0] = (np.arange(width) * 255 // max(width - 1, 1))[None, :]
+        pixels[..., 1] = (np.arange(height) * 255 // max(height - 1, 1))[:, None]
+        pixels[..., 2] = 128
+        return pixels
+    # Flat: a few colored rectangles on white, like a Paint drawing
+    pixels = np.full((height, width, 3), 255, dtype=np.uint8)
+    colors = rng.integers(0, 256, (8, 3), dtype=np.uint8)
+    for _ in range(24):
+        x, y = rng.integers(0, width), rng.integers(0, height)
+        w, h = rng.integers(1, width // 3 + 2), rng.integers(1, height // 3 + 2)
+        pixels[y:y + h, x:x + w] = colors[rng.integers(0, len(colors))]
+    return pixels
+
+
+def corpus_path(corpus, kind, size, dialect):
+    return os.path.join(corpus, f"{kind}-{size}.{dialect}.tpf" if dialect else f"{kind}-{size}.png")
+
+
+def make_corpus(corpus, kinds=KINDS, sizes=SIZES):
+    """Write the PNG and every TPF dialect of each picture; existing files are kept."""
+    from PIL import Image
+    os.makedirs(corpus, exist_ok=True)
+    for kind in kinds:
+        for size in sizes:
+            width, height = map(int, size.split('x'))
+            pixels = None
+            for dialect in (None,) + tuple(DIALECTS):
+                path = corpus_path(corpus, kind, size, dialect)
+                if os.path.exists(path):
+                    continue
+                if pixels is None:
+                    pixels = make_pixels(kind, width, height)
+                if dialect is None:
+                    Image.fromarray(pixels).save(path)
+                elif 'tpf_format' not in DIALECTS[dialect]:
+                    tpf.write_binary(path, pixels, **DIALECTS[dialect])
+                else:
+                    tpf.write(path, pixels, **DIALECTS[dialect])
+
+
+def make_maze(width, height, rng):
+    # A perfect maze of one pixel wide white corridors on black, the worst
+    # case for a fill: every cell opens to the north or the east at random
+    pixels = np.zeros((height, width, 3), dtype=np.uint8)
+    rows, cols = (height - 1) // 2, (width - 1) // 2
+    pixels[1:2 * rows:2, 1:2 * cols:2] = 255
+    north = rng.random((rows, cols)) < 0.5
+    north[:, -1:] = True
+    north[:1, :] = False
+    east = ~north
+    east[:1, -1:] = False
+    y, x = np.nonzero(north)
+    pixels[2 * y, 2 * x + 1] = 255
+    y, x = np.nonzero(east)
+    pixels[2 * y + 1, 2 * x + 2] = 255
+    return pixels
+
+
+_app = None
+
+
+def qt_app():
+    # Kept in a global, since Qt tears the application down with its wrapper
+    global _app
+    from PyQt6.QtWidgets import QApplication
+    _app = QApplication.instance() or QApplication(sys.argv[:1])
+    return _app
+
+
+def load_pixels(corpus, kind, size):
+    from PIL import Image
+    with Image.open(corpus_path(corpus, kind, size, None)) as image:
+        return tpf.from_pil(image)
+
+
+# Every case gets the corpus entry and a scratch directory, does its setup,
+# and returns (function to time, output file or None). Bytes processed are
+# the input TPF for loads and the output for saves.
+
+def case_decode(dialect):
+    def setup(corpus, kind, size, scratch):
+        return lambda: tpf.read(corpus_path(corpus, kind, size, dialect)), None
+    return setup
+
+
+def case_decode_parallel(corpus, kind, size, scratch):
+    return lambda: tpf.read_parallel(corpus_path(corpus, kind, size, 'text')), None
+
+
+def case_decode_region(corpus, kind, size, scratch):
+    # A 256x256 crop from the middle, with the row index already built
+    path = corpus_path(corpus, kind, size, 'text')
+    width, height = tpf.read_size(path)
+    if os.path.getsize(path) >= tpf.INDEX_MIN_BYTES:
+        tpf.row_index(path)
+    return lambda: tpf.decode_region(path, width // 2 - 128, height // 2 - 128, 256, 256), None
+
+
+def case_encode(dialect):
+    def setup(corpus, kind, size, scratch):
+        pixels = load_pixels(corpus, kind, size)
+        out = os.path.join(scratch, "out.tpf")
+        options = DIALECTS[dialect]
+        if 'tpf_format' not in options:
+            return lambda: tpf.write_binary(out, pixels, **options), out
+        return lambda: tpf.write(out, pixels, **options), out
+    return setup
+
+
+def case_convert_to_tpf(corpus, kind, size, scratch):
+    import batch
+    out = os.path.join(scratch, "out.tpf")
+    return lambda: batch.convert_file(corpus_path(corpus, kind, size, None), out, 'text'), out
+
+
+def case_convert_from_tpf(corpus, kind, size, scratch):
+    import batch
+    out = os.path.join(scratch, "out.png")
+    return lambda: batch.convert_file(corpus_path(corpus, kind, size, 'text'), out, None), None
+
+
+def case_viewer_load(corpus, kind, size, scratch):
+    import viewer
+    return lambda: viewer.read_image(corpus_path(corpus, kind, size, 'text')), None
+
+
+def case_viewer_save(corpus, kind, size, scratch):
+    import viewer
+    image = tpf.to_qimage(load_pixels(corpus, kind, size), viewer.QImage.Format.Format_RGB32)
+    out = os.path.join(scratch, "out.tpf")
+    return lambda: viewer.write_image(out, image, 'palette'), out
+
+
+def case_viewer_display(corpus, kind, size, scratch):
+    import viewer
+    qt_app()
+    window = viewer.TPFViewer()
+    window.resize(800, 600)
+    window.show()
+    image = tpf.to_qimage(load_pixels(corpus, kind, size), viewer.QImage.Format.Format_RGB32)
+
+    def display():
+        window.show_loaded_image(image)
+        # Render the window as it would reach the screen
+        window.grab()
+    return display, None
+
+
+def case_paint_load(corpus, kind, size, scratch):
+    import paint
+    return lambda: paint.read_canvas(corpus_path(corpus, kind, size, 'text')), None
+
+
+def case_paint_save(corpus, kind, size, scratch):
+    import paint
+    image = tpf.to_qimage(load_pixels(corpus, kind, size), paint.QImage.Format.Format_RGB32)
+    out = os.path.join(scratch, "out.tpf")
+    return lambda: paint.write_canvas(out, image, 'palette'), out
+
+
+def case_paint_display(corpus, kind, size, scratch):
+    import paint
+    qt_app()
+    canvas = paint.Canvas()
+    canvas.resize(800, 600)
+    image = tpf.to_qimage(load_pixels(corpus, kind, size), paint.QImage.Format.Format_RGB32)
+
+    def display():
+        canvas.set_image(image)
+        canvas.grab()
+    return display, None
+
+
+def make_strokes(count, width, height, seed=0):
+    from PyQt6.QtCore import QPoint
+
+    rng = np.random.default_rng(seed)
+    # Mouse-like paths: 20 events per stroke, up to 40px apart
+    starts = rng.integers(0, (width, height), (count, 1, 2))
+    steps = rng.integers(-40, 41, (count, 20, 2))
+    paths = np.clip(starts + np.cumsum(steps, axis=1), 0, (width - 1, height - 1))
+    return [[QPoint(int(x), int(y)) for x, y in path] for path in paths]
+
+
+def case_paint_strokes(brush_size):
+    def setup(corpus, kind, size, scratch):
+        import paint
+        qt_app()
+        image = tpf.to_qimage(load_pixels(corpus, kind, size), paint.QImage.Format.Format_RGB32)
+        canvas = paint.Canvas()
+        canvas.set_image(image)
+        canvas.brush_size = brush_size
+        strokes = make_strokes(STROKES, image.width(), image.height())
+
+        def draw():
+            for points in strokes:
+                canvas.begin_stroke(points[0])
+                for point in points[1:]:
+                    canvas.extend_stroke(point)
+                    # Worst case: every mouse event gets a frame of its own
+                    canvas.flush_stroke()
+                canvas.end_stroke()
+        return draw, None
+    return setup
+
+
+def legacy_save(path, pixels):
+    # The per-pixel loop the converter used before the bulk writer
+    height, width = pixels.shape[:2]
+    with open(path, 'w') as f:
+        f.write(f"1 {width}x{height}\n")
+        for y in range(height):
+            for x in range(width):
+                r, g, b = pixels[y, x]
+                f.write(f"({x},{y}) ({r},{g},{b})\n")
+
+
+def legacy_stroke(image, points, brush_size):
+    # The per-step ellipse loop Paint used before the stroke engine
+    from PyQt6.QtCore import QPointF
+    from PyQt6.QtGui import QColor, QPainter, QPen
+
+    last_point = points[0]
+    for current_point in points[1:]:
+        painter = QPainter(image)
+        painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+        painter.setPen(QPen(QColor(0, 0, 0), 1))
+        painter.setBrush(QColor(0, 0, 0))
+        steps = max(abs(current_point.x() - last_point.x()),
+                    abs(current_point.y() - last_point.y())) // 2 or 1
+        for i in range(steps + 1):
+            x = last_point.x() + ((current_point.x() - last_point.x()) * i) / steps
+            y = last_point.y() + ((current_point.y() - last_point.y()) * i) / steps
+            painter.drawEllipse(QPointF(x, y), brush_size / 2, brush_size / 2)
+        painter.end()
+        last_point = current_point
+
+
+def case_encode_legacy(corpus, kind, size, scratch):
+    pixels = load_pixels(corpus, kind, size)
+    out = os.path.join(scratch, "out.tpf")
+    return lambda: legacy_save(out, pixels), out
+
+
+def case_paint_strokes_legacy(brush_size):
+    def setup(corpus, kind, size, scratch):
+        from PyQt6.QtGui import QImage
+        qt_app()
+        image = tpf.to_qimage(load_pixels(corpus, kind, size), QImage.Format.Format_RGB32)
+        strokes = make_strokes(STROKES, image.width(), image.height())
+        return lambda: [legacy_stroke(image, points, brush_size) for points in strokes], None
+    return setup
+
+
+def case_paint_fill(corpus, kind, size, scratch):
+    # A bucket fill from the middle; it flips between two colors, so every
+    # run fills the same area
+    import paint
+    qt_app()
+    image = tpf.to_qimage(load_pixels(corpus, kind, size), paint.QImage.Format.Format_RGB32)
+    canvas = paint.Canvas()
+    canvas.image = image
+    canvas.fill_mode = True
+    point = paint.QPoint(image.width() // 2 | 1, image.height() // 2 | 1)
+    colors = [paint.QColor(1, 2, 3), paint.QColor(3, 2, 1)]
+
+    def fill():
+        canvas.brush_color = colors[0]
+        colors.reverse()
+        canvas.fill_at(point)
+    return fill, None
+
+
+CASES = {
+    **{f'decode {dialect}': case_decode(dialect) for dialect in DIALECTS},
+    'decode parallel': case_decode_parallel,
+    'decode region': case_decode_region,
+    **{f'encode {dialect}': case_encode(dialect) for dialect in DIALECTS},
+    'converter to tpf': case_convert_to_tpf,
+    'converter from tpf': case_convert_from_tpf,
+    'viewer load': case_viewer_load,
+    'viewer save': case_viewer_save,
+    'viewer display': case_viewer_display,
+    'paint load': case_paint_load,
+    'paint save': case_paint_save,
+    'paint display': case_paint_display,
+    'paint fill': case_paint_fill,
+    **{f'paint strokes {brush_size}': case_paint_strokes(brush_size) for brush_size in BRUSH_SIZES},
+}
+
+# The code paths the optimized ones replaced, to compare against; they are
+# slow, so they only run when named in --cases
+LEGACY_CASES = {
+    'encode legacy': case_encode_legacy,
+    **{f'paint strokes legacy {brush_size}': case_paint_strokes_legacy(brush_size)
+       for brush_size in BRUSH_SIZES},
+}
+CASES.update(LEGACY_CASES)
+
+# Inputs of the load cases, for the throughput figure
+CASE_INPUTS = {
+    **{f'decode {dialect}': dialect for dialect in DIALECTS},
+    'decode parallel': 'text',
+    'converter from tpf': 'text',
+    'viewer load': 'text',
+    'paint load': 'text',
+}
+
+
+def peak_rss():
+    # Megabytes; ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20 if sys.platform == 'darwin' else 1 << 10)
+
+
+def _proc_status(field):
+    # Kilobyte fields of /proc/self/status, in bytes
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) * 1024
+    raise OSError(f"no {field} in /proc/self/status")
+
+
+def peak_growth(func):
+    """Run func and return how far its peak RSS rose above the RSS it started at.
+
+    Only Linux can reset the peak (through /proc/self/clear_refs); elsewhere
+    the result is None.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        before = _proc_status('VmRSS')
+    except OSError:
+        func()
+        return None
+    func()
+    return max(0, _proc_status('VmHWM') - before)
+
+
+def run_case(case, corpus, kind, size, repeat):
+    """Time one case; meant to run in a fresh process so peak RSS is its own."""
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    width, height = map(int, size.split('x'))
+    with tempfile.TemporaryDirectory() as scratch:
+        func, out = CASES[case](corpus, kind, size, scratch)
+        # The first run also measures the memory the case needs on top of
+        # what it started with, in buffers the size of the RGB raster
+        start = time.perf_counter()
+        growth = peak_growth(func)
+        seconds = min([time.perf_counter() - start] + [timed(func) for _ in range(repeat - 1)])
+        if _app:
+            # Background work a case started, like the viewer's pyramid,
+            # must not outlive the process's Qt objects
+            from PyQt6.QtCore import QThreadPool
+            QThreadPool.globalInstance().waitForDone()
+        if out:
+            size_bytes = os.path.getsize(out)
+        elif case in CASE_INPUTS:
+            size_bytes = os.path.getsize(corpus_path(corpus, kind, size, CASE_INPUTS[case]))
+        else:
+            size_bytes = width * height * 3
+    return {
+        'case': case,
+        'kind': kind,
+        'size': size,
+        'seconds': seconds,
+        'bytes': size_bytes,
+        'mb_per_s': size_bytes / seconds / 1e6 if seconds else None,
+        'peak_rss_mb': peak_rss(),
+        'buffers': None if growth is None else growth / (width * height * 3),
+    }
+
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def _python(*args):
+    # A fresh interpreter in this directory, so nothing is imported yet
+    env = dict(os.environ, QT_QPA_PLATFORM=os.environ.get('QT_QPA_PLATFORM', 'offscreen'))
+    return subprocess.Popen([sys.executable] + list(args), cwd=os.path.dirname(os.path.abspath(__file__)),
+                            env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+
+def import_time(module):
+    """Cumulative import time of a module in a new interpreter, from -X importtime."""
+    _, err = _python('-X', 'importtime', '-c', f'import {module}').communicate()
+    for line in err.splitlines():
+        parts = [part.strip() for part in line.split('|')]
+        if len(parts) == 3 and parts[2] == module:
+            return int(parts[1]) / 1e6
+    raise RuntimeError(f"importing {module} failed: {err.strip()}")
+
+
+def first_window_time(tool):
+    """Seconds from launching a new interpreter until the tool's window is shown."""
+    # Reports at the window's first paint, before any deferred work runs
+    script = (f"import {tool}\n"
+              f"from PyQt6.QtCore import QEvent, QObject\n"
+              f"from PyQt6.QtWidgets import QApplication\n"
+              f"class Probe(QObject):\n"
+              f"    def eventFilter(self, obj, event):\n"
+              f"        if event.type() == QEvent.Type.Paint:\n"
+              f"            print('shown', flush=True)\n"
+              f"            app.exit()\n"
+              f"        return False\n"
+              f"app = QApplication(['{tool}'])\n"
+              f"window = {tool}.{WINDOWS[tool]}()\n"
+              f"probe = Probe()\n"
+              f"window.installEventFilter(probe)\n"
+              f"window.show()\n"
+              f"app.exec()\n")
+    start = time.perf_counter()
+    process = _python('-c', script)
+    line = process.stdout.readline()
+    seconds = time.perf_counter() - start
+    process.communicate()
+    if line.strip() != 'shown':
+        raise RuntimeError(f"starting {tool} failed")
+    return seconds
+
+
+def run_startup(cases, repeat=1):
+    results = []
+    for case in cases:
+        if case.startswith('import '):
+            measure = lambda: import_time(case.split()[1])
+        else:
+            measure = lambda: first_window_time(case.split()[-1])
+        result = {
+            'case': case,
+            'kind': 'startup',
+            'size': '-',
+            'seconds': min(measure() for _ in range(repeat)),
+            'bytes': 0,
+            'mb_per_s': None,
+            'peak_rss_mb': None,
+            'budget': STARTUP_BUDGETS[case],
+        }
+        report(result)
+        results.append(result)
+    return results
+
+
+def run_suite(corpus, kinds, sizes, cases, repeat=1, isolate=True):
+    results = []
+    for kind in kinds:
+        for size in sizes:
+            for case in cases:
+                if isolate:
+                    # A new process per case keeps peak RSS and caches separate
+                    with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as executor:
+                        result = executor.submit(run_case, case, corpus, kind, size, repeat).result()
+                else:
+                    result = run_case(case, corpus, kind, size, repeat)
+                report(result)
+                results.append(result)
+    return results
+
+
+def report(result):
+    rate = f"{result['mb_per_s']:10.1f} MB/s" if result['mb_per_s'] else " " * 15
+    rss = f"{result['peak_rss_mb']:8.0f} MB RSS" if result['peak_rss_mb'] else ""
+    if result.get('buffers') is not None:
+        rss += f" {result['buffers']:6.2f} buffers"
+    if result.get('budget') and result['seconds'] > result['budget']:
+        rss = f"over the {result['budget'] * 1000:.0f} ms budget"
+    print(f"{result['kind']:<9} {result['size']:>10} {result['case']:<22} "
+          f"{result['seconds'] * 1000:10.1f} ms {rate} {rss}", flush=True)
+
+
+def key(result):
+    return result['kind'], result['size'], result['case']
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """Return the results that are slower or bigger than the baseline by more than threshold."""
+    before = {key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        old = before.get(key(result))
+        if old is None:
+            continue
+        for field in ('seconds', 'peak_rss_mb'):
+            if old.get(field) and result.get(field) and result[field] > old[field] * (1 + threshold):
+                regressions.append((result, field, old[field]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time every TPF load, save and render path on a generated corpus")
+    parser.add_argument('--corpus', default=os.path.join(tempfile.gettempdir(), 'tpf-corpus'),
+                        help="directory for the generated pictures (reused between runs)")
+    parser.add_argument('--kinds', default=','.join(KINDS), help="comma separated picture kinds")
+    parser.add_argument('--sizes', default=','.join(SIZES),
+                        help="comma separated WxH sizes, e.g. 1x1,8000x8000")
+    parser.add_argument('--cases', default=None, help="comma separated case names (default: all)")
+    parser.add_argument('--repeat', type=int, default=1, help="runs per case, the fastest counts")
+    parser.add_argument('--in-process', action='store_true',
+                        help="run cases in this process; faster, but peak RSS is shared")
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--compare', help="fail if slower than the results in this JSON file")
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help="allowed slowdown for --compare, as a fraction (default: 0.25)")
+    parser.add_argument('--list', action='store_true', help="print the case names and exit")
+    args = parser.parse_args()
+
+    if args.list:
+        print("\n".join(list(CASES) + list(STARTUP_BUDGETS)))
+        return 0
+    kinds = args.kinds.split(',')
+    sizes = args.sizes.split(',')
+    if args.cases:
+        cases = args.cases.split(',')
+    else:
+        cases = [case for case in CASES if case not in LEGACY_CASES] + list(STARTUP_BUDGETS)
+    unknown = [case for case in cases if case not in CASES and case not in STARTUP_BUDGETS]
+    if unknown:
+        parser.error(f"unknown cases: {', '.join(unknown)}")
+
+    startup = [case for case in cases if case in STARTUP_BUDGETS]
+    results = run_startup(startup, args.repeat)
+    cases = [case for case in cases if case in CASES]
+    if cases:
+        make_corpus(args.corpus, kinds, sizes)
+        results += run_suite(args.corpus, kinds, sizes, cases, args.repeat, not args.in_process)
+    over_budget = [result for result in results
+                   if result.get('budget') and result['seconds'] > result['budget']]
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'python': sys.version.split()[0], 'cpus': os.cpu_count(),
+                       'results': results}, f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for result, field, old in regressions:
+            print(f"REGRESSION {' '.join(key(result))}: {field} {old:.4g} -> {result[field]:.4g}")
+        if regressions:
+            return 1
+    return 1 if over_budget else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
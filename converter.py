@@ -1,9 +1,22 @@
-from PyQt6.QtWidgets import (QMainWindow, QApplication, QPushButton, QFileDialog,
-                           QVBoxLayout, QWidget, QLabel, QMessageBox)
-from PyQt6.QtGui import QImage, QPixmap
-from PIL import Image
 import sys
 import os
+from functools import partial
+import batch
+import tracing
+
+if __name__ == '__main__':
+    sys.argv = tracing.from_argv(sys.argv)
+    if len(sys.argv) > 1:
+        # Batch mode never loads Qt
+        sys.exit(batch.run_batch(sys.argv[1:]))
+
+from PyQt6.QtWidgets import (QMainWindow, QApplication, QPushButton, QFileDialog,
+                           QVBoxLayout, QHBoxLayout, QWidget, QLabel, QMessageBox,
+                           QComboBox, QSpinBox)
+import tpf
+from batch import (convert_file, translate_tpf, read_pixels, codec_report,
+                   format_codec_report)
+from workers import TaskProgress
 
 class ImageConverter(QMainWindow):
     def __init__(self):
@@ -19,137 +32,196 @@ class ImageConverter(QMainWindow):
         # Create buttons
         self.btn_to_tpf = QPushButton("Convert JPG/PNG to TPF", self)
         self.btn_from_tpf = QPushButton("Convert TPF to JPG/PNG", self)
+        self.btn_tpf_version = QPushButton("Convert TPF text <-> binary", self)
+        self.btn_report = QPushButton("Compare compression levels...", self)
         
-        # Add status label
+        # Output format for written TPF files
+        self.format_box = QComboBox(self)
+        self.format_box.addItem("TPF text (v1)", 'text')
+        self.format_box.addItem("TPF text, run-length (v1)", 'runs')
+        self.format_box.addItem("TPF text, palette + run-length (v1)", 'palette')
+        self.format_box.addItem("TPF binary (v2)", 'binary')
+        self.format_box.addItem("TPF binary, zlib rows (v2)", 'zlib')
+        self.format_box.currentIndexChanged.connect(self.update_codec_controls)
+
+        # Compression of the text formats, stored in row-band chunks
+        self.codec_box = QComboBox(self)
+        self.codec_box.addItem("Uncompressed", None)
+        for name, compression in tpf.CODECS.items():
+            self.codec_box.addItem(f"{name} chunks", compression)
+        self.codec_box.currentIndexChanged.connect(self.update_codec_controls)
+        self.level_box = QSpinBox(self)
+        self.level_box.setPrefix("Level ")
+        self.level_box.setRange(0, 9)
+        self.level_box.setValue(tpf.DEFAULT_LEVEL)
+        codec_row = QHBoxLayout()
+        codec_row.addWidget(self.codec_box)
+        codec_row.addWidget(self.level_box)
+        self.update_codec_controls()
+        
+        # Add status label and progress of the running conversion
         self.status_label = QLabel("Ready", self)
+        self.progress = TaskProgress(self.status_label, self)
         
         # Add widgets to layout
         layout.addWidget(self.btn_to_tpf)
         layout.addWidget(self.btn_from_tpf)
+        layout.addWidget(self.btn_tpf_version)
+        layout.addWidget(self.format_box)
+        layout.addLayout(codec_row)
+        layout.addWidget(self.btn_report)
         layout.addWidget(self.status_label)
+        layout.addWidget(self.progress)
         
         # Connect buttons to functions
         self.btn_to_tpf.clicked.connect(self.convert_to_tpf)
         self.btn_from_tpf.clicked.connect(self.convert_from_tpf)
+        self.btn_tpf_version.clicked.connect(self.convert_tpf_version)
+        self.btn_report.clicked.connect(self.compare_codecs)
 
-    def convert_to_tpf(self):
-        try:
-            file_path, _ = QFileDialog.getOpenFileName(
-                self, 
-                "Select Image",
-                "",
-                "Image Files (*.jpg *.png *.jpeg)"
-            )
-            
-            if not file_path:
-                return
-                
-            # Open and verify image
-            img = Image.open(file_path)
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
-            
-            width, height = img.size
-            pixels = img.load()
+    def update_codec_controls(self):
+        text = self.format_box.currentData() in tpf.TEXT_FORMATS
+        self.codec_box.setEnabled(text)
+        self.level_box.setEnabled(text and self.codec_box.currentData() is not None)
+
+    def codec(self):
+        compression = self.codec_box.currentData()
+        if compression is None:
+            return None
+        return compression, self.level_box.value()
+
+    def run_task(self, message, success, func, *args):
+        def finished(_):
+            self.status_label.setText("Conversion successful!")
+            QMessageBox.information(self, "Success", success)
             
-            save_path, _ = QFileDialog.getSaveFileName(
-                self,
-                "Save TPF",
-                os.path.splitext(file_path)[0] + ".tpf",
-                "TPF Files (*.tpf)"
-            )
+        def failed(error):
+            QMessageBox.critical(self, "Error", f"Error converting: {error}")
             
-            if not save_path:
-                return
-                
-            with open(save_path, 'w') as f:
-                # Write header
-                f.write(f"1 {width}x{height}\n")
-                
-                # Write pixel data
-                for y in range(height):
-                    for x in range(width):
-                        r, g, b = pixels[x, y]
-                        f.write(f"({x},{y}) ({r},{g},{b})\n")
+        self.progress.start(message, func, *args, on_finished=finished, on_failed=failed)
+
+    def convert_to_tpf(self):
+        file_path, _ = QFileDialog.getOpenFileName(
+            self, 
+            "Select Image",
+            "",
+            "Image Files (*.jpg *.png *.jpeg)"
+        )
+        
+        if not file_path:
+            return
             
-            self.status_label.setText("Conversion successful!")
-            QMessageBox.information(self, "Success", "Image converted to TPF successfully!")
+        save_path, _ = QFileDialog.getSaveFileName(
+            self,
+            "Save TPF",
+            os.path.splitext(file_path)[0] + ".tpf",
+            "TPF Files (*.tpf)"
+        )
+        
+        if not save_path:
+            return
             
-        except Exception as e:
-            self.status_label.setText(f"Error: {str(e)}")
-            QMessageBox.critical(self, "Error", f"Error converting image: {str(e)}")
+        # Read the image and write it in the selected format in the background
+        self.run_task("Converting image to TPF...", "Image converted to TPF successfully!",
+                      partial(convert_file, codec=self.codec()),
+                      file_path, save_path, self.format_box.currentData())
 
     def convert_from_tpf(self):
-        try:
-            file_path, _ = QFileDialog.getOpenFileName(
-                self,
-                "Select TPF",
-                "",
-                "TPF Files (*.tpf)"
-            )
-            
-            if not file_path:
-                return
-                
-            with open(file_path, 'r') as f:
-                lines = f.readlines()
-                
-            if not lines:
-                raise ValueError("Empty TPF file")
-                
-            # Parse header
-            header = lines[0].strip().split()
-            if len(header) != 2:
-                raise ValueError("Invalid TPF header format")
-                
-            version, dimensions = header
-            if version != "1":
-                raise ValueError(f"Unsupported TPF version: {version}")
-                
-            try:
-                width, height = map(int, dimensions.split('x'))
-            except:
-                raise ValueError("Invalid dimensions in TPF header")
-            
-            # Create new image
-            img = Image.new('RGB', (width, height), color='black')
-            pixels = img.load()
-            
-            # Parse pixels
-            for line in lines[1:]:
-                try:
-                    coords, colors = line.strip().split(') (')
-                    x, y = map(int, coords[1:].split(','))
-                    r, g, b = map(int, colors.split(','))
-                    
-                    if not (0 <= x < width and 0 <= y < height):
-                        continue
-                    if not (0 <= r <= 255 and 0 <= g <= 255 and 0 <= b <= 255):
-                        continue
-                        
-                    pixels[x, y] = (r, g, b)
-                except:
-                    continue
+        file_path, _ = QFileDialog.getOpenFileName(
+            self,
+            "Select TPF",
+            "",
+            "TPF Files (*.tpf)"
+        )
+        
+        if not file_path:
+            return
             
-            save_path, _ = QFileDialog.getSaveFileName(
-                self,
-                "Save Image",
-                os.path.splitext(file_path)[0] + ".png",
-                "PNG Files (*.png);;JPEG Files (*.jpg *.jpeg)"
-            )
+        save_path, _ = QFileDialog.getSaveFileName(
+            self,
+            "Save Image",
+            os.path.splitext(file_path)[0] + ".png",
+            "PNG Files (*.png);;JPEG Files (*.jpg *.jpeg)"
+        )
+        
+        if not save_path:
+            return
             
-            if not save_path:
-                return
-                
-            img.save(save_path)
-            self.status_label.setText("Conversion successful!")
-            QMessageBox.information(self, "Success", "TPF converted to image successfully!")
+        self.run_task("Converting TPF to image...", "TPF converted to image successfully!",
+                      convert_file, file_path, save_path, None)
+
+    def convert_tpf_version(self):
+        file_path, _ = QFileDialog.getOpenFileName(
+            self,
+            "Select TPF",
+            "",
+            "TPF Files (*.tpf)"
+        )
+        
+        if not file_path:
+            return
             
-        except Exception as e:
+        # Text becomes binary and binary becomes text
+        try:
+            binary = not tpf.is_binary(file_path)
+        except OSError as e:
             self.status_label.setText(f"Error: {str(e)}")
             QMessageBox.critical(self, "Error", f"Error converting TPF: {str(e)}")
+            return
+        suffix = "_v2.tpf" if binary else "_v1.tpf"
+        
+        save_path, _ = QFileDialog.getSaveFileName(
+            self,
+            "Save TPF",
+            os.path.splitext(file_path)[0] + suffix,
+            "TPF Files (*.tpf)"
+        )
+        
+        if not save_path:
+            return
+            
+        tpf_format = self.format_box.currentData()
+        if binary:
+            tpf_format = 'zlib' if tpf_format == 'zlib' else 'binary'
+        elif tpf_format not in tpf.TEXT_FORMATS:
+            tpf_format = 'text'
+        self.run_task("Converting TPF...", "TPF converted successfully!",
+                      partial(translate_tpf, codec=self.codec()),
+                      file_path, save_path, tpf_format)
+
+    def compare_codecs(self):
+        file_path, _ = QFileDialog.getOpenFileName(
+            self,
+            "Select Image or TPF",
+            "",
+            "Images and TPF Files (*.jpg *.png *.jpeg *.tpf)"
+        )
+        
+        if not file_path:
+            return
+            
+        tpf_format = self.format_box.currentData()
+        if tpf_format not in tpf.TEXT_FORMATS:
+            tpf_format = 'text'
+
+        def measure(progress):
+            return codec_report(read_pixels(file_path), tpf_format, progress)
+
+        def finished(report):
+            self.status_label.setText("Ready")
+            box = QMessageBox(self)
+            box.setWindowTitle("Compression levels")
+            box.setText(f"<pre>{format_codec_report(*report)}</pre>")
+            box.exec()
+
+        def failed(error):
+            QMessageBox.critical(self, "Error", f"Error measuring: {error}")
+
+        self.progress.start("Measuring compression levels...", measure,
+                            on_finished=finished, on_failed=failed)
 
 def main():
+    # Arguments were handled before the Qt imports; only the window is left
     app = QApplication(sys.argv)
     converter = ImageConverter()
     converter.show()
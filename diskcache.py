@@ -0,0 +1,124 @@
+import hashlib
+import os
+import threading
+
+# Thumbnails, pyramids and row indexes together; past this the least
+# recently used entries go
+CACHE_BYTES = 1 << 30
+# Other processes write to the cache too, so the running total this
+# process keeps is recounted from disk after this many stores
+RECOUNT_STORES = 256
+# A prune goes down to this fraction of the cap, so that a full cache is
+# not scanned again on every store that follows
+PRUNE_TO = 0.9
+
+_lock = threading.Lock()
+# Bytes in the cache as of the last count plus what was stored since, and
+# the stores left until the next count
+_total = None
+_stores_left = 0
+
+
+def cache_root():
+    base = os.environ.get('XDG_CACHE_HOME') or os.environ.get('LOCALAPPDATA')
+    if not base:
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'tpf-tools')
+
+
+def cache_dir(kind):
+    return os.path.join(cache_root(), kind)
+
+
+def _digest(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:20]
+
+
+def cache_path(file_path, kind, ext):
+    """Cache entry for a file; it changes with the file's size and mtime.
+
+    The name starts with a hash of the file's path, so stored() can find
+    the entries an earlier version of the file left behind.
+    """
+    stat = os.stat(file_path)
+    path = os.path.abspath(file_path)
+    key = f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}"
+    return os.path.join(cache_dir(kind), f"{_digest(path)}-{_digest(key)}{ext}")
+
+
+def used(entry):
+    """Mark an entry as just used after a hit, which keeps it from pruning."""
+    try:
+        os.utime(entry)
+    except OSError:
+        pass
+
+
+def stored(entry, max_bytes=CACHE_BYTES):
+    """Call after writing an entry: drops the entries of the file's older
+    versions and prunes the cache once it grows past max_bytes."""
+    global _total, _stores_left
+    directory, name = os.path.split(entry)
+    prefix = name.split('-', 1)[0] + '-'
+    try:
+        names = os.listdir(directory)
+        added = os.path.getsize(entry)
+    except OSError:
+        return
+    for other in names:
+        if other != name and other.startswith(prefix):
+            other = os.path.join(directory, other)
+            try:
+                size = os.path.getsize(other)
+                os.remove(other)
+            except OSError:
+                continue
+            added -= size
+    with _lock:
+        _stores_left -= 1
+        if _total is not None and _stores_left > 0:
+            _total += added
+            if _total <= max_bytes:
+                return
+        _stores_left = RECOUNT_STORES
+    prune(max_bytes)
+
+
+def prune(max_bytes=CACHE_BYTES):
+    """Delete the least recently used entries once the cache is over
+    max_bytes, leaving it at PRUNE_TO of it."""
+    global _total
+    entries = []
+    root = cache_root()
+    try:
+        kinds = os.listdir(root)
+    except OSError:
+        return
+    for kind in kinds:
+        try:
+            scan = os.scandir(os.path.join(root, kind))
+        except OSError:
+            continue
+        with scan:
+            for item in scan:
+                # Names starting with a dot are writes still in progress
+                if item.name.startswith('.') or not item.is_file():
+                    continue
+                try:
+                    stat = item.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, item.path))
+    total = sum(size for _, size, _ in entries)
+    entries.sort()
+    target = max_bytes * PRUNE_TO if total > max_bytes else total
+    for _, size, path in entries:
+        if total <= target:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+    with _lock:
+        _total = total
@@ -0,0 +1,141 @@
+import numpy as np
+
+
+def matching(words, seed, tolerance=0):
+    """(H, W) bool mask of the pixels within tolerance of seed in every channel.
+
+    words is an (H, W) uint32 view of an RGB32 image, seed one of its words.
+    """
+    if tolerance <= 0:
+        return words == seed
+    channels = words[..., None].view(np.uint8)
+    mask = None
+    for channel in range(3):
+        value = (int(seed) >> (8 * channel)) & 0xff
+        low, high = max(value - tolerance, 0), min(value + tolerance, 255)
+        # Wrapping uint8 subtraction tests low <= c <= high in one compare
+        inside = np.subtract(channels[..., channel], low, dtype=np.uint8) <= high - low
+        mask = inside if mask is None else np.logical_and(mask, inside, out=mask)
+    return mask
+
+
+def spans(mask):
+    """Return the (starts, ends) of every run of True in mask, row by row.
+
+    Both are flat indices into rows of width + 1, so runs never touch across
+    rows and a run's row is its index // (width + 1).
+    """
+    height, width = mask.shape
+    padded = np.zeros((height, width + 1), dtype=bool)
+    padded[:, :-1] = mask
+    flat = padded.reshape(-1)
+    # Runs alternate with gaps, so the edges alternate between starts and ends
+    edges = np.empty(flat.size, dtype=bool)
+    edges[0] = flat[0]
+    np.not_equal(flat[1:], flat[:-1], out=edges[1:])
+    edges = np.flatnonzero(edges)
+    return edges[0::2], edges[1::2]
+
+
+def _links(starts, ends, mask):
+    # Pairs of runs in neighbouring rows that share a column
+    height, width = mask.shape
+    stride = width + 1
+    if len(starts) * 8 < mask.size:
+        # For every run the runs above it that overlap are contiguous: the
+        # ones ending after its start and starting before its end
+        first = np.searchsorted(ends, starts - stride, 'right')
+        count = np.maximum(np.searchsorted(starts, ends - stride, 'left') - first, 0)
+        below = np.repeat(np.arange(len(starts)), count)
+        offsets = np.arange(len(below)) - np.repeat(np.cumsum(count) - count, count)
+        return np.repeat(first, count) + offsets, below
+
+    # With many short runs, as in a maze, a pass over the pixels is cheaper:
+    # every stretch of columns two rows share links the runs holding it
+    padded = np.zeros((height, stride), dtype=bool)
+    padded[:, :-1] = mask
+    flat = padded.reshape(-1)
+    run_of = np.zeros(flat.size, dtype=np.int64)
+    run_of[starts] = 1
+    np.cumsum(run_of, out=run_of)
+    run_of -= 1
+    shared = flat[:-stride] & flat[stride:]
+    first = shared.copy()
+    first[1:] &= ~shared[:-1]
+    first = np.flatnonzero(first)
+    return run_of[first], run_of[first + stride]
+
+
+def _components(count, above, below):
+    # Labels every run with a run of its connected area: the roots of linked
+    # runs are hooked onto the lower one, then the chains are shortened to
+    # their root, until no link joins two labels. Parents are always lower,
+    # so when several links hook one root any of them may win
+    labels = np.arange(count)
+    roots = None
+    while True:
+        first, second = labels[above], labels[below]
+        differ = first != second
+        if not differ.any():
+            return labels
+        above, below = above[differ], below[differ]
+        first, second = first[differ], second[differ]
+        labels[np.maximum(first, second)] = np.minimum(first, second)
+        if roots is None:
+            # At first every run is a root, so all of them are shortened
+            while True:
+                parents = labels[labels]
+                if np.array_equal(parents, labels):
+                    break
+                labels = parents
+        else:
+            # Later only the old roots moved; they are shortened first and
+            # every other run then reaches its new root through its old one
+            while True:
+                parents = labels[roots]
+                grandparents = labels[parents]
+                if np.array_equal(parents, grandparents):
+                    break
+                labels[roots] = grandparents
+            labels = labels[labels]
+        roots = np.flatnonzero(labels == np.arange(count))
+
+
+def region(words, x, y, tolerance=0):
+    """Return the area a fill at (x, y) covers as ((x, y, w, h), mask).
+
+    The area is every pixel within tolerance of the one at (x, y) that is
+    4-connected to it; mask is the (h, w) bool mask of it inside the box.
+    """
+    height, width = words.shape
+    stride = width + 1
+    matches = matching(words, words[y, x], tolerance)
+    starts, ends = spans(matches)
+    above, below = _links(starts, ends, matches)
+    labels = _components(len(starts), above, below)
+    seed = np.searchsorted(starts, y * stride + x, 'right') - 1
+    chosen = labels == labels[seed]
+    if not chosen.all():
+        starts, ends = starts[chosen], ends[chosen]
+    left = int((starts % stride).min())
+    right = int((ends % stride).max())
+    top = int(starts[0] // stride)
+    bottom = int(ends[-1] // stride) + 1
+    box = (left, top, right - left, bottom - top)
+    if len(starts) == len(chosen):
+        # Every match is connected, as on an open canvas
+        return box, matches[top:bottom, left:right]
+
+    # +1 where a run starts and -1 where it ends; the running sum is the mask
+    base = top * stride
+    cover = np.zeros((bottom - top) * stride, dtype=np.int8)
+    cover[starts - base] = 1
+    cover[ends - base] = -1
+    inside = np.cumsum(cover, dtype=np.int8).view(bool).reshape(bottom - top, stride)
+    return box, inside[:, left:right]
+
+
+def paint(words, box, mask, color):
+    """Set the pixels of a region() to the uint32 color in one masked copy."""
+    left, top, width, height = box
+    np.copyto(words[top:top + height, left:left + width], np.uint32(color), where=mask)
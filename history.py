@@ -0,0 +1,282 @@
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import tpf
+
+# Edits are recorded per tile, so undo costs what the edit touched
+TILE_SIZE = 64
+HISTORY_BYTES = 64 * 1024 * 1024
+
+
+def _words(image, writable=False):
+    """(H, W) uint32 view of an RGB32 QImage's pixels."""
+    return tpf.qimage_view(image, writable).view(np.uint32)[..., 0]
+
+
+class Patch:
+    """A rectangle of pixels, zlib-compressed on the history's worker thread."""
+
+    def __init__(self, x, y, words, executor):
+        self.x = x
+        self.y = y
+        self.shape = words.shape
+        self.raw_size = words.nbytes
+        self.data = executor.submit(zlib.compress, words.tobytes(), 1)
+
+    def nbytes(self):
+        return len(self.data.result()) if self.data.done() else self.raw_size
+
+    def pending(self):
+        return not self.data.done()
+
+    def restore(self, words):
+        height, width = self.shape
+        pixels = np.frombuffer(zlib.decompress(self.data.result()), dtype=np.uint32)
+        words[self.y:self.y + height, self.x:self.x + width] = pixels.reshape(self.shape)
+
+
+def _pack_mask(mask):
+    return zlib.compress(np.packbits(mask).tobytes(), 1)
+
+
+class MaskPatch:
+    """The pixels under a mask, as one color or as one word per masked pixel.
+
+    Fills are kept this way: the mask compresses to little and a fill
+    with no tolerance needs no copy of the pixels at all.
+    """
+
+    def __init__(self, x, y, shape, mask_data, values, executor):
+        self.x = x
+        self.y = y
+        self.shape = shape
+        self.mask_data = mask_data
+        if isinstance(values, int):
+            self.values = values
+        else:
+            self.values_size = values.nbytes
+            self.values = executor.submit(zlib.compress, values.tobytes(), 1)
+
+    def nbytes(self):
+        # Each side of the edit counts half of the mask they share
+        size = len(self.mask_data.result()) // 2 if self.mask_data.done() else 0
+        if not isinstance(self.values, int):
+            size += len(self.values.result()) if self.values.done() else self.values_size
+        return size
+
+    def pending(self):
+        return not self.mask_data.done() or not (isinstance(self.values, int) or self.values.done())
+
+    def restore(self, words):
+        height, width = self.shape
+        bits = np.frombuffer(zlib.decompress(self.mask_data.result()), dtype=np.uint8)
+        mask = np.unpackbits(bits, count=height * width).view(bool).reshape(self.shape)
+        target = words[self.y:self.y + height, self.x:self.x + width]
+        if isinstance(self.values, int):
+            np.copyto(target, np.uint32(self.values), where=mask)
+        else:
+            target[mask] = np.frombuffer(zlib.decompress(self.values.result()), dtype=np.uint32)
+
+
+class Entry:
+    def __init__(self, before_size, after_size, before, after):
+        self.before_size = before_size
+        self.after_size = after_size
+        self.before = before
+        self.after = after
+
+    def nbytes(self):
+        return sum(patch.nbytes() for patch in self.before + self.after)
+
+    def pending(self):
+        """True while a patch is still being compressed."""
+        return any(patch.pending() for patch in self.before + self.after)
+
+    def bounds(self):
+        left = min(patch.x for patch in self.before)
+        top = min(patch.y for patch in self.before)
+        right = max(patch.x + patch.shape[1] for patch in self.before)
+        bottom = max(patch.y + patch.shape[0] for patch in self.before)
+        return left, top, right - left, bottom - top
+
+
+class History:
+    """Undo/redo stack of the tiles each edit changed.
+
+    Call begin() before an edit, touch() with every rectangle before it is
+    painted, and end() once the edit is done. The stacks are trimmed from
+    the oldest edit once their compressed size exceeds max_bytes.
+    """
+
+    def __init__(self, max_bytes=HISTORY_BYTES, tile_size=TILE_SIZE):
+        self.max_bytes = max_bytes
+        self.tile_size = tile_size
+        self.undo_stack = []
+        self.redo_stack = []
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.edit_tiles = None
+
+    def can_undo(self):
+        return bool(self.undo_stack)
+
+    def can_redo(self):
+        return bool(self.redo_stack)
+
+    def begin(self):
+        self.edit_tiles = {}
+
+    def touch(self, image, x, y, width, height):
+        """Save the tiles under a rectangle that this edit has not saved yet."""
+        if self.edit_tiles is None:
+            return
+        size = self.tile_size
+        left, top = max(x, 0) // size, max(y, 0) // size
+        right = min(x + width, image.width()) - 1
+        bottom = min(y + height, image.height()) - 1
+        if right < 0 or bottom < 0:
+            return
+        words = None
+        for ty in range(top, bottom // size + 1):
+            for tx in range(left, right // size + 1):
+                if (tx, ty) in self.edit_tiles:
+                    continue
+                if words is None:
+                    words = _words(image)
+                tile = words[ty * size:(ty + 1) * size, tx * size:(tx + 1) * size]
+                self.edit_tiles[tx, ty] = Patch(tx * size, ty * size, tile, self.executor)
+
+    def end(self, image):
+        tiles, self.edit_tiles = self.edit_tiles, None
+        if not tiles:
+            return
+        words = _words(image)
+        before = list(tiles.values())
+        after = [Patch(patch.x, patch.y,
+                       words[patch.y:patch.y + patch.shape[0], patch.x:patch.x + patch.shape[1]],
+                       self.executor)
+                 for patch in before]
+        size = (image.width(), image.height())
+        self.push(Entry(size, size, before, after))
+
+    def masked(self, image, box, mask, before, after):
+        """Record setting the masked pixels of box (x, y, w, h) from before to after.
+
+        Both are a uint32 color or the masked pixels' words in mask order;
+        call this before the pixels are written.
+        """
+        self.edit_tiles = None
+        x, y = box[:2]
+        mask_data = self.executor.submit(_pack_mask, mask)
+        patches = [MaskPatch(x, y, mask.shape, mask_data, values, self.executor)
+                   for values in (before, after)]
+        size = (image.width(), image.height())
+        self.push(Entry(size, size, patches[:1], patches[1:]))
+
+    def replace(self, before_image, after_image):
+        """Record swapping the whole image, e.g. for a new canvas or a loaded file."""
+        self.edit_tiles = None
+        before = [Patch(0, 0, _words(before_image), self.executor)]
+        after = [Patch(0, 0, _words(after_image), self.executor)]
+        self.push(Entry((before_image.width(), before_image.height()),
+                        (after_image.width(), after_image.height()), before, after))
+
+    def push(self, entry):
+        self.redo_stack = []
+        self.trim()
+        self.undo_stack.append(entry)
+
+    def trim(self):
+        # Runs before the next edit is pushed and counts both stacks. An
+        # entry still being compressed is neither counted nor dropped until
+        # a later trim, as its raw size says little about what it keeps.
+        # The oldest edits go first, then the redo steps furthest away
+        total = sum(entry.nbytes() for entry in self.undo_stack + self.redo_stack
+                    if not entry.pending())
+        for stack in (self.undo_stack, self.redo_stack):
+            while total > self.max_bytes and stack and not stack[0].pending():
+                total -= stack.pop(0).nbytes()
+
+    def undo_bounds(self):
+        """The (x, y, w, h) the next undo changes, or None if it swaps the whole image."""
+        return self._bounds(self.undo_stack[-1])
+
+    def redo_bounds(self):
+        return self._bounds(self.redo_stack[-1])
+
+    def _bounds(self, entry):
+        if entry.before_size != entry.after_size:
+            return None
+        return entry.bounds()
+
+    def undo(self, image):
+        """Return the image with the last edit undone and the changed (x, y, w, h)."""
+        entry = self.undo_stack.pop()
+        self.redo_stack.append(entry)
+        return self._apply(image, entry.before_size, entry.before), entry.bounds()
+
+    def redo(self, image):
+        entry = self.redo_stack.pop()
+        self.undo_stack.append(entry)
+        return self._apply(image, entry.after_size, entry.after), entry.bounds()
+
+    def _apply(self, image, size, patches):
+        from PyQt6.QtGui import QImage
+        if (image.width(), image.height()) != size:
+            # Every patch of a size-changing entry covers the whole image
+            image = QImage(size[0], size[1], QImage.Format.Format_RGB32)
+        words = _words(image, writable=True)
+        for patch in patches:
+            patch.restore(words)
+        return image
+
+
+class Changes:
+    """The tiles painted on since the last save, each as it was saved.
+
+    Call touch() with every rectangle before it is painted and changes()
+    to get the pixels that differ from the saved ones, so a save costs
+    what was edited. complete is False once the saved file cannot be
+    brought up to date this way, e.g. after the image was swapped.
+    """
+
+    def __init__(self, tile_size=TILE_SIZE):
+        self.tile_size = tile_size
+        self.tiles = {}
+        self.complete = False
+
+    def reset(self, complete=True):
+        self.tiles = {}
+        self.complete = complete
+
+    def touch(self, image, x, y, width, height):
+        if not self.complete:
+            return
+        size = self.tile_size
+        left, top = max(x, 0) // size, max(y, 0) // size
+        right = min(x + width, image.width()) - 1
+        bottom = min(y + height, image.height()) - 1
+        if right < 0 or bottom < 0:
+            return
+        words = None
+        for ty in range(top, bottom // size + 1):
+            for tx in range(left, right // size + 1):
+                if (tx, ty) not in self.tiles:
+                    if words is None:
+                        words = _words(image)
+                    self.tiles[tx, ty] = words[ty * size:(ty + 1) * size, tx * size:(tx + 1) * size].copy()
+
+    def changes(self, image):
+        """Return [(words, mask, (x, y))] for every tile whose pixels changed."""
+        words = _words(image)
+        size = self.tile_size
+        changed = []
+        for (tx, ty), saved in self.tiles.items():
+            x, y = tx * size, ty * size
+            tile = words[y:y + saved.shape[0], x:x + saved.shape[1]]
+            # Only the color bytes count; the alpha byte of RGB32 is not saved
+            mask = ((tile ^ saved) & 0xffffff) != 0
+            if mask.any():
+                changed.append((tile.copy(), mask, (x, y)))
+        return changed
@@ -1,116 +1,255 @@
 import sys
-from PyQt6.QtWidgets import QApplication
-
-# Create QApplication first
-app = QApplication(sys.argv)
-
-# Now import the rest
 import os
-import qtawesome as qta
-from PyQt6.QtWidgets import (QMainWindow, QWidget, QVBoxLayout, 
+import time
+from functools import partial
+import numpy as np
+import fill
+import tpf
+import tracing
+from history import Changes, History
+from workers import TaskProgress
+from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
                             QHBoxLayout, QPushButton, QColorDialog, QSpinBox, 
                             QLabel, QFileDialog, QMenuBar, QMenu, QDialog,
                             QGridLayout, QLineEdit, QFontDialog)
-from PyQt6.QtGui import QPainter, QColor, QImage, QPen, QIcon, QFont, QFontDatabase
-from PyQt6.QtCore import Qt, QPoint, QSize, QPointF
+from PyQt6.QtGui import (QPainter, QColor, QImage, QPen, QIcon, QFont, QFontDatabase, QFontMetrics,
+                         QPainterPath, QKeySequence)
+from PyQt6.QtCore import Qt, QPoint, QSize, QPointF, QRect, QTimer, pyqtSignal
+
+# Saves append changed pixels to the file until they add up to this share
+# of the last full write, then the file is rewritten without the overrides
+APPEND_COMPACT_RATIO = 0.5
 
 class Canvas(QWidget):
+    # Time spent in paintEvent (ms) and the number of pixels it blitted
+    frame_painted = pyqtSignal(float, int)
+
     def __init__(self):
         super().__init__()
+        self.stroke_painter = None
+        self.history = History()
+        self.changes = Changes()
+        self.image = None
         self.init_canvas()
         self.eraser_mode = False
         self.text_mode = False
+        self.fill_mode = False
+        self.fill_tolerance = 0
         self.text_to_draw = ""
         self.text_font = QFont("Arial", 12)
+        self.log_frames = False
 
     def init_canvas(self, width=600, height=400):
-        self.image = QImage(width, height, QImage.Format.Format_RGB32)
-        self.image.fill(Qt.GlobalColor.white)
-        self.drawing = False
-        self.brush_size = 3
-        self.brush_color = QColor(0, 0, 0)
-        self.last_point = QPoint()
-        self.update()
+        image = QImage(width, height, QImage.Format.Format_RGB32)
+        image.fill(Qt.GlobalColor.white)
+        self.set_image(image)
 
     def paintEvent(self, event):
-        painter = QPainter(self)
-        painter.drawImage(0, 0, self.image)
+        start = time.perf_counter()
+        with tracing.span('canvas paint') as span:
+            # Mouse moves since the last frame are rasterized together
+            self.flush_stroke()
+            # Only the damaged part is copied, so the cost follows the edit, not the canvas
+            rect = event.rect().intersected(self.image.rect())
+            painter = QPainter(self)
+            painter.drawImage(rect, self.image, rect)
+            painter.end()
+            span.add(pixels=rect.width() * rect.height())
+        if self.log_frames:
+            self.frame_painted.emit((time.perf_counter() - start) * 1000,
+                                    rect.width() * rect.height())
+
+    def segment_rect(self, start, end):
+        # Bounding box of a brush moved from start to end, with room for antialiasing
+        margin = self.brush_size // 2 + 2
+        return QRect(start, end).normalized().adjusted(-margin, -margin, margin, margin)
+
+    def begin_stroke(self, point):
+        # One painter serves the whole stroke instead of one per mouse event
+        self.end_stroke()
+        color = QColor(Qt.GlobalColor.white) if self.eraser_mode else self.brush_color
+        self.history.begin()
+        self.stroke_painter = QPainter(self.image)
+        self.stroke_painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+        # A round-capped line covers the same area as the old row of antialiased dabs
+        self.stroke_painter.setPen(QPen(color, self.brush_size + 0.5, Qt.PenStyle.SolidLine,
+                                        Qt.PenCapStyle.RoundCap, Qt.PenJoinStyle.RoundJoin))
+        self.stroke_start = point
+        self.stroke_points = []
+        self.last_point = point
+
+    def extend_stroke(self, point):
+        # Queue the point; Qt merges the update() calls into one repaint per frame
+        self.stroke_points.append(point)
+        self.update(self.segment_rect(self.last_point, point))
+        self.last_point = point
+
+    def flush_stroke(self):
+        if not self.stroke_painter or not self.stroke_points:
+            return
+        path = QPainterPath(QPointF(self.stroke_start))
+        for point in self.stroke_points:
+            path.lineTo(QPointF(point))
+        # Keep the pixels under the new segments for undo before painting over them
+        margin = self.brush_size // 2 + 2
+        rect = path.boundingRect().toAlignedRect().adjusted(-margin, -margin, margin, margin)
+        self.history.touch(self.image, rect.x(), rect.y(), rect.width(), rect.height())
+        self.changes.touch(self.image, rect.x(), rect.y(), rect.width(), rect.height())
+        self.stroke_painter.drawPath(path)
+        self.stroke_start = self.stroke_points[-1]
+        self.stroke_points = []
+
+    def end_stroke(self):
+        if self.stroke_painter:
+            self.flush_stroke()
+            self.stroke_painter.end()
+            self.stroke_painter = None
+            self.history.end(self.image)
+
+    def undo(self):
+        self.end_stroke()
+        if self.history.can_undo():
+            self.touch_changes(self.history.undo_bounds())
+            self.show_history_step(*self.history.undo(self.image))
+
+    def redo(self):
+        self.end_stroke()
+        if self.history.can_redo():
+            self.touch_changes(self.history.redo_bounds())
+            self.show_history_step(*self.history.redo(self.image))
+
+    def touch_changes(self, rect):
+        # A step that swaps the whole image cannot be saved as changed pixels
+        if rect is None:
+            self.changes.complete = False
+        else:
+            self.changes.touch(self.image, *rect)
 
+    def show_history_step(self, image, rect):
+        if image is self.image:
+            self.update(QRect(*rect))
+        else:
+            self.image = image
+            self.update()
+
+    @tracing.traced('fill')
+    def fill_at(self, point):
+        # The area is found on a view of the image buffer and painted in
+        # one masked copy; undo keeps its mask rather than its tiles
+        if not self.image.rect().contains(point):
+            return
+        self.end_stroke()
+        words = tpf.qimage_view(self.image, writable=True).view(np.uint32)[..., 0]
+        box, mask = fill.region(words, point.x(), point.y(), self.fill_tolerance)
+        x, y, width, height = box
+        if self.fill_tolerance:
+            before = words[y:y + height, x:x + width][mask]
+        else:
+            before = int(words[point.y(), point.x()])
+        color = self.brush_color.rgb()
+        self.history.masked(self.image, box, mask, before, color)
+        self.changes.touch(self.image, *box)
+        fill.paint(words, box, mask, color)
+        self.update(QRect(x, y, width, height))
+
+    @tracing.traced('mouse press')
     def mousePressEvent(self, event):
         if event.button() == Qt.MouseButton.LeftButton:
-            if self.text_mode:
+            if self.fill_mode:
+                self.fill_at(event.pos())
+            elif self.text_mode:
+                text_rect = QFontMetrics(self.text_font).boundingRect(self.text_to_draw)
+                text_rect = text_rect.translated(event.pos()).adjusted(-2, -2, 2, 2)
+                self.history.begin()
+                self.history.touch(self.image, text_rect.x(), text_rect.y(),
+                                   text_rect.width(), text_rect.height())
+                self.changes.touch(self.image, text_rect.x(), text_rect.y(),
+                                   text_rect.width(), text_rect.height())
                 painter = QPainter(self.image)
                 painter.setFont(self.text_font)
                 painter.setPen(QPen(self.brush_color))
                 painter.drawText(event.pos(), self.text_to_draw)
-                self.update()
+                painter.end()
+                self.history.end(self.image)
+                self.update(text_rect)
             else:
                 self.drawing = True
-                self.last_point = event.pos()
+                self.begin_stroke(event.pos())
 
+    @tracing.traced('mouse move')
     def mouseMoveEvent(self, event):
         if event.buttons() & Qt.MouseButton.LeftButton and self.drawing:
-            painter = QPainter(self.image)
-            painter.setRenderHint(QPainter.RenderHint.Antialiasing)  # For smooth circles
-            
-            if self.eraser_mode:
-                painter.setPen(QPen(Qt.GlobalColor.white, 1))
-                painter.setBrush(QColor(Qt.GlobalColor.white))
-            else:
-                painter.setPen(QPen(self.brush_color, 1))
-                painter.setBrush(self.brush_color)
-
-            # Calculate intermediate points for smooth line
-            current_point = event.pos()
-            steps = max(abs(current_point.x() - self.last_point.x()),
-                       abs(current_point.y() - self.last_point.y())) // 2
-            if steps == 0:
-                steps = 1
-
-            for i in range(steps + 1):
-                x = self.last_point.x() + ((current_point.x() - self.last_point.x()) * i) / steps
-                y = self.last_point.y() + ((current_point.y() - self.last_point.y()) * i) / steps
-                radius = self.brush_size / 2
-                painter.drawEllipse(QPointF(x, y), radius, radius)
-
-            self.last_point = current_point
-            self.update()
+            self.extend_stroke(event.pos())
 
+    @tracing.traced('mouse release')
     def mouseReleaseEvent(self, event):
         if event.button() == Qt.MouseButton.LeftButton:
             self.drawing = False
+            self.end_stroke()
 
-    def save_tpf(self, filename):
-        width = self.image.width()
-        height = self.image.height()
-        
-        with open(filename, 'w') as f:
-            f.write(f"{width}x{height}\n")
-            for y in range(height):
-                for x in range(width):
-                    color = self.image.pixelColor(x, y)
-                    f.write(f"({x},{y}) ({color.red()},{color.green()},{color.blue()})\n")
+    def save_tpf(self, filename, tpf_format='palette'):
+        write_canvas(filename, self.image, tpf_format)
 
     def load_tpf(self, filename):
-        with open(filename, 'r') as f:
-            # Read dimensions from first line
-            dimensions = f.readline().strip()
-            width, height = map(int, dimensions.split('x'))
-            
-            # Create new image
-            self.init_canvas(width, height)
-            
-            # Read pixel data
-            for line in f:
-                if not line.strip():
-                    continue
-                pos, color = line.strip().split(') (')
-                x, y = map(int, pos[1:].split(','))
-                r, g, b = map(int, color.split(')')[0].split(','))
-                self.image.setPixelColor(x, y, QColor(r, g, b))
-        
+        self.set_image(read_canvas(filename))
+
+    def mark_saved(self):
+        """Track changes from here on against the file just saved or opened."""
+        self.end_stroke()
+        self.changes.reset()
+
+    def changed_lines(self, runs=True):
+        """Lines that bring the last saved file up to date, or None if it needs a rewrite."""
+        self.end_stroke()
+        if not self.changes.complete:
+            return None
+        return b''.join(tpf.encode_changes(words, mask, origin, runs).tobytes()
+                        for words, mask, origin in self.changes.changes(self.image))
+
+    def set_image(self, image):
+        # Take over an already decoded image without copying it
+        self.end_stroke()
+        if self.image is not None:
+            # A new canvas or an opened file can be undone like any edit
+            self.history.replace(self.image, image)
+        # Until it is saved, the new image has no file to append changes to
+        self.changes.reset(complete=False)
+        self.image = image
+        self.drawing = False
+        self.brush_size = 3
+        self.brush_color = QColor(0, 0, 0)
+        self.last_point = QPoint()
         self.update()
 
+def read_canvas(filename, progress=None):
+    pixels = tpf.read(filename, background=(255, 255, 255), progress=progress)
+    # Create new image straight from the decoded buffer
+    return tpf.to_qimage(pixels, QImage.Format.Format_RGB32)
+
+def write_canvas(filename, image, tpf_format, progress=None, version=None,
+                 compression=tpf.COMPRESSION_NONE, level=tpf.DEFAULT_LEVEL):
+    # The keywords take a tpf.dialect(); Paint's own files have no "1 " version field
+    pixels = tpf.from_qimage(image)
+    if tpf_format == 'binary':
+        tpf.write_binary(filename, pixels, compression, level, progress=progress)
+    else:
+        # Format straight from the QImage buffer
+        tpf.write(filename, pixels, version=version, progress=progress, tpf_format=tpf_format,
+                  compression=compression, level=level)
+
+def append_canvas(filename, lines, progress=None):
+    tpf.append(filename, lines)
+    return len(lines)
+
+def appendable(dialect):
+    # Only plain, uncompressed text can take more lines at its end
+    return (dialect is not None and dialect['tpf_format'] in tpf.TEXT_FORMATS
+            and dialect.get('compression', tpf.COMPRESSION_NONE) == tpf.COMPRESSION_NONE)
+
+def file_stamp(filename):
+    stat = os.stat(filename)
+    return stat.st_size, stat.st_mtime_ns
+
 class CanvasSizeDialog(QDialog):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -169,6 +308,13 @@ class MainWindow(QMainWindow):
         super().__init__()
         self.setWindowTitle("TPF Paint")
         self.resize(800, 600)
+        # The file the canvas was last saved to or opened from, and its size
+        # and mtime then; saving to it again only appends the changed pixels
+        self.file_path = None
+        self.file_dialect = None
+        self.file_stamp = None
+        self.base_size = 0
+        self.appended = 0
         
         # Create menubar
         menubar = self.menuBar()
@@ -177,13 +323,27 @@ class MainWindow(QMainWindow):
         file_menu = menubar.addMenu("File")
         file_menu.addAction("New", self.new_canvas)
         file_menu.addAction("Open", self.open_file)
-        file_menu.addAction("Save", self.save_file)
+        save_action = file_menu.addAction("Save", self.save_file)
+        save_action.setShortcut(QKeySequence.StandardKey.Save)
+        save_as_action = file_menu.addAction("Save As...", self.save_file_as)
+        save_as_action.setShortcut(QKeySequence.StandardKey.SaveAs)
         file_menu.addSeparator()
         file_menu.addAction("Exit", self.close)
 
         # Edit menu
         edit_menu = menubar.addMenu("Edit")
+        undo_action = edit_menu.addAction("Undo", self.undo)
+        undo_action.setShortcut(QKeySequence.StandardKey.Undo)
+        redo_action = edit_menu.addAction("Redo", self.redo)
+        redo_action.setShortcut(QKeySequence.StandardKey.Redo)
+        edit_menu.addSeparator()
         edit_menu.addAction("Canvas Size", self.change_canvas_size)
+
+        # View menu
+        view_menu = menubar.addMenu("View")
+        self.frame_log_action = view_menu.addAction("Log Frame Times")
+        self.frame_log_action.setCheckable(True)
+        self.frame_log_action.toggled.connect(self.toggle_frame_log)
         
         # Main widget and layout
         main_widget = QWidget()
@@ -194,15 +354,13 @@ class MainWindow(QMainWindow):
         toolbar = QHBoxLayout()
         
         # Color button
-        color_btn = QPushButton()
-        color_btn.setIcon(QIcon(qta.icon('fa5s.palette').pixmap(32, 32)))  # Changed from fa5.palette
+        color_btn = self.color_btn = QPushButton()
         color_btn.setToolTip("Choose Color")
         color_btn.clicked.connect(self.choose_color)
         toolbar.addWidget(color_btn)
         
         # Text tool button
         self.text_btn = QPushButton()
-        self.text_btn.setIcon(QIcon(qta.icon('fa5s.font').pixmap(32, 32)))  # Changed from fa5.font
         self.text_btn.setToolTip("Text Tool")
         self.text_btn.setCheckable(True)
         self.text_btn.clicked.connect(self.toggle_text_tool)
@@ -210,12 +368,23 @@ class MainWindow(QMainWindow):
         
         # Eraser toggle button
         self.eraser_btn = QPushButton()
-        self.eraser_btn.setIcon(QIcon(qta.icon('fa5s.eraser').pixmap(32, 32)))  # Changed from fa5.eraser
         self.eraser_btn.setToolTip("Eraser")
         self.eraser_btn.setCheckable(True)
         self.eraser_btn.clicked.connect(self.toggle_eraser)
         toolbar.addWidget(self.eraser_btn)
         
+        # Bucket fill button and how far colors may differ from the clicked one
+        self.fill_btn = QPushButton()
+        self.fill_btn.setToolTip("Fill")
+        self.fill_btn.setCheckable(True)
+        self.fill_btn.clicked.connect(self.toggle_fill_tool)
+        toolbar.addWidget(self.fill_btn)
+        toolbar.addWidget(QLabel("Tolerance:"))
+        self.fill_tolerance = QSpinBox()
+        self.fill_tolerance.setRange(0, 255)
+        self.fill_tolerance.valueChanged.connect(self.change_fill_tolerance)
+        toolbar.addWidget(self.fill_tolerance)
+        
         # Brush size
         toolbar.addWidget(QLabel("Brush size:"))
         self.brush_size = QSpinBox()
@@ -233,15 +402,40 @@ class MainWindow(QMainWindow):
         color_btn.setStyleSheet(button_style)
         self.text_btn.setStyleSheet(button_style)
         self.eraser_btn.setStyleSheet(button_style)
+        self.fill_btn.setStyleSheet(button_style)
         
         layout.addLayout(toolbar)
+        self.icons_loaded = False
         
         # Canvas
         self.canvas = Canvas()
+        self.canvas.frame_painted.connect(self.log_frame)
         layout.addWidget(self.canvas)
+        
+        # Status bar with progress of background loads and saves
+        self.status_label = QLabel("Ready")
+        self.progress = TaskProgress(self.status_label)
+        self.statusBar().addWidget(self.status_label)
+        self.statusBar().addPermanentWidget(self.progress)
+
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        # The icon font takes a quarter second to load, so the icons are
+        # filled in after the first frame is on screen
+        if not self.icons_loaded:
+            self.icons_loaded = True
+            QTimer.singleShot(0, self.load_icons)
+
+    def load_icons(self):
+        import qtawesome as qta
+        self.color_btn.setIcon(QIcon(qta.icon('fa5s.palette').pixmap(32, 32)))  # Changed from fa5.palette
+        self.text_btn.setIcon(QIcon(qta.icon('fa5s.font').pixmap(32, 32)))  # Changed from fa5.font
+        self.eraser_btn.setIcon(QIcon(qta.icon('fa5s.eraser').pixmap(32, 32)))  # Changed from fa5.eraser
+        self.fill_btn.setIcon(QIcon(qta.icon('fa5s.fill-drip').pixmap(32, 32)))
 
     def new_canvas(self):
         self.canvas.init_canvas()
+        self.set_file(None)
 
     def open_file(self):
         filename, _ = QFileDialog.getOpenFileName(
@@ -251,19 +445,100 @@ class MainWindow(QMainWindow):
             "TPF Files (*.tpf);;All Files (*.*)"
         )
         if filename:
-            self.canvas.load_tpf(filename)
+            self.progress.start("Loading...", read_canvas, filename,
+                                on_finished=lambda image: self.file_loaded(filename, image))
+
+    def file_loaded(self, filename, image):
+        self.canvas.set_image(image)
+        # Save writes the file back in its own format, codec and header
+        try:
+            dialect = tpf.dialect(filename)
+        except ValueError:
+            dialect = None
+        self.set_file(filename, dialect)
+        if appendable(dialect):
+            self.canvas.mark_saved()
+
+    def set_file(self, filename, dialect=None):
+        self.file_path = filename
+        self.file_dialect = dialect
+        self.file_stamp = file_stamp(filename) if filename else None
+        self.base_size = self.file_stamp[0] if filename else 0
+        self.appended = 0
+        name = os.path.basename(filename) if filename else None
+        self.setWindowTitle(f"{name} - TPF Paint" if name else "TPF Paint")
 
     def save_file(self):
-        filename, _ = QFileDialog.getSaveFileName(
+        if self.file_path is None:
+            self.save_file_as()
+        elif self.file_dialect is None:
+            # A layout none of the writers produce cannot be kept; pick one
+            self.status_label.setText(f"Choose a format to save {os.path.basename(self.file_path)} in")
+            self.save_file_as()
+        else:
+            self.write_file(self.file_path, self.file_dialect)
+
+    def save_file_as(self):
+        filename, selected_filter = QFileDialog.getSaveFileName(
             self,
             "Save TPF File",
             "",
-            "TPF Files (*.tpf);;All Files (*.*)"
+            "TPF Files (*.tpf);;Plain TPF Files (*.tpf);;Binary TPF Files (*.tpf);;All Files (*.*)"
         )
         if filename:
+            # Plain TPF is one line per pixel; the default stores runs of palette colors
+            tpf_format = 'palette'
+            if selected_filter.startswith("Plain"):
+                tpf_format = 'text'
+            elif selected_filter.startswith("Binary"):
+                tpf_format = 'binary'
             if not filename.endswith('.tpf'):
                 filename += '.tpf'
-            self.canvas.save_tpf(filename)
+            self.write_file(filename, {'tpf_format': tpf_format})
+
+    def write_file(self, filename, dialect):
+        lines = None
+        if (filename == self.file_path and dialect == self.file_dialect and appendable(dialect)
+                and os.path.exists(filename) and file_stamp(filename) == self.file_stamp):
+            # Plain TPF stays one line per pixel
+            lines = self.canvas.changed_lines(runs=dialect['tpf_format'] != 'text')
+        if lines is not None and self.appended + len(lines) <= APPEND_COMPACT_RATIO * self.base_size:
+            if not lines:
+                self.status_label.setText("No changes to save")
+            elif self.progress.start("Saving...", append_canvas, filename, lines,
+                                     on_finished=lambda size: self.file_appended(filename, size),
+                                     on_failed=lambda _: self.save_failed()):
+                self.canvas.mark_saved()
+            return
+        # A new file, or overrides piling up past the threshold: write the
+        # whole canvas, which also drops the overridden lines.
+        # A shallow copy shares the pixels until the canvas is painted on
+        # again, so the save sees a consistent snapshot without a copy
+        snapshot = QImage(self.canvas.image)
+        if self.progress.start("Saving...", partial(write_canvas, **dialect), filename, snapshot,
+                               on_finished=lambda _: self.file_saved(filename, dialect),
+                               on_failed=lambda _: self.save_failed(),
+                               on_cancelled=self.save_failed):
+            self.canvas.mark_saved()
+
+    def file_saved(self, filename, dialect):
+        self.set_file(filename, dialect)
+        self.status_label.setText("Saved")
+
+    def file_appended(self, filename, size):
+        self.file_stamp = file_stamp(filename)
+        self.appended += size
+        self.status_label.setText(f"Saved {size / 1e3:.1f} KB of changes")
+
+    def save_failed(self):
+        # The file may not hold what the tracked changes were made against
+        self.canvas.changes.complete = False
+
+    def undo(self):
+        self.canvas.undo()
+
+    def redo(self):
+        self.canvas.redo()
 
     def choose_color(self):
         color = QColorDialog.getColor()
@@ -279,14 +554,41 @@ class MainWindow(QMainWindow):
             width = dialog.width_spin.value()
             height = dialog.height_spin.value()
             self.canvas.init_canvas(width, height)
+            self.set_file(None)
+
+    def toggle_frame_log(self, enabled):
+        self.canvas.log_frames = enabled
+        if not enabled:
+            self.status_label.setText("Ready")
+
+    def log_frame(self, ms, pixels):
+        # Stays flat while drawing if only the dirty rectangles are repainted;
+        # with --profile every repaint is also a 'canvas paint' span in the trace
+        self.status_label.setText(f"Repaint: {ms:.2f} ms, {pixels} px")
+
+    def change_fill_tolerance(self, tolerance):
+        self.canvas.fill_tolerance = tolerance
 
     def toggle_eraser(self):
         self.canvas.eraser_mode = self.eraser_btn.isChecked()
+        if self.canvas.eraser_mode:
+            self.fill_btn.setChecked(False)
+            self.canvas.fill_mode = False
+
+    def toggle_fill_tool(self):
+        self.canvas.fill_mode = self.fill_btn.isChecked()
+        if self.canvas.fill_mode:
+            self.eraser_btn.setChecked(False)
+            self.text_btn.setChecked(False)
+            self.canvas.eraser_mode = False
+            self.canvas.text_mode = False
 
     def toggle_text_tool(self):
         if self.text_btn.isChecked():
             self.eraser_btn.setChecked(False)
+            self.fill_btn.setChecked(False)
             self.canvas.eraser_mode = False
+            self.canvas.fill_mode = False
             dialog = TextInputDialog(self)
             if dialog.exec():
                 self.canvas.text_to_draw = dialog.text_input.text()
@@ -295,7 +597,12 @@ class MainWindow(QMainWindow):
         else:
             self.canvas.text_mode = False
 
-if __name__ == '__main__':
+def main():
+    sys.argv = tracing.from_argv(sys.argv)
+    app = QApplication(sys.argv)
     window = MainWindow()
     window.show()
-    sys.exit(app.exec())
\ No newline at end of file
+    sys.exit(app.exec())
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
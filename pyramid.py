@@ -0,0 +1,92 @@
+import os
+
+import numpy as np
+
+import diskcache
+import tpf
+
+# Levels are halved until both sides fit in this many pixels
+MIN_LEVEL_SIZE = 128
+
+
+def halve(pixels):
+    """Downscale an (H, W, 3) uint8 array by 2 with a 2x2 box filter."""
+    height, width = pixels.shape[:2]
+    # Odd edges are repeated so every output pixel averages four inputs
+    if height % 2 or width % 2:
+        pixels = np.pad(pixels, ((0, height % 2), (0, width % 2), (0, 0)), mode='edge')
+    quads = pixels.astype(np.uint16)
+    total = quads[0::2, 0::2] + quads[1::2, 0::2] + quads[0::2, 1::2] + quads[1::2, 1::2]
+    return ((total + 2) // 4).astype(np.uint8)
+
+
+def build(pixels, min_size=MIN_LEVEL_SIZE):
+    """Return [pixels, 1/2, 1/4, ...] down to about min_size pixels per side."""
+    levels = [pixels]
+    while max(levels[-1].shape[:2]) > min_size:
+        levels.append(halve(levels[-1]))
+    return levels
+
+
+def level_for_zoom(zoom, count):
+    """Index of the coarsest level that still has at least zoom resolution."""
+    level = 0
+    while level + 1 < count and 0.5 ** (level + 1) >= zoom:
+        level += 1
+    return level
+
+
+def cache_path(file_path):
+    """Sidecar path for a TPF file; it changes with the file's size and mtime."""
+    return diskcache.cache_path(file_path, 'pyramids', '.npz')
+
+
+def save_cached(file_path, levels):
+    """Persist every level but the full-resolution one."""
+    path = cache_path(file_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tpf.atomic_path(path) as temp_path:
+        with open(temp_path, 'wb') as f:
+            # The shapes let a reader skip big levels without loading them
+            shapes = np.array([level.shape[:2] for level in levels[1:]], dtype=np.int64)
+            np.savez(f, *levels[1:], shapes=shapes)
+    diskcache.stored(path)
+
+
+def load_cached(file_path, max_size=None):
+    """Return the cached [None, 1/2, 1/4, ...] levels, or None on a miss.
+
+    The full-resolution slot is None; it is filled in once decoded. Levels
+    with a side over max_size are left as None without being read, which
+    keeps a quick preview cheap.
+    """
+    try:
+        path = cache_path(file_path)
+        with np.load(path) as data:
+            shapes = data['shapes']
+            levels = [None] * (len(shapes) + 1)
+            for i, shape in enumerate(shapes):
+                if not max_size or max(shape) <= max_size:
+                    levels[i + 1] = data[f'arr_{i}']
+    except Exception:
+        return None
+    if not any(level is not None for level in levels):
+        return None
+    diskcache.used(path)
+    return levels
+
+
+def for_image(pixels, file_path=None):
+    """Build the pyramid for a decoded image, going through the sidecar cache."""
+    if file_path:
+        levels = load_cached(file_path)
+        if levels and all(level is not None for level in levels[1:]):
+            levels[0] = pixels
+            return levels
+    levels = build(pixels)
+    if file_path:
+        try:
+            save_cached(file_path, levels)
+        except OSError:
+            pass
+    return levels
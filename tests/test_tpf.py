@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+import tpf
+
+
+def decode(body, palette=None, size=(4, 2)):
+    pixels = tpf.new_raster(*size)
+    tpf.decode_into(pixels, body, None if palette is None else np.array(palette))
+    return pixels
+
+
+@pytest.mark.parametrize('line', [
+    b'(0,0) (1,2,3)(4)',     # five numbers in a run line's place
+    b'(1.5,0) (9,9,9)',      # six numbers, but not a run
+    b'(0,0,1,2) 3',          # six numbers in a run line's place
+    b'(0) (0,1,2,3)',
+    b'0 0 1 2 3',
+    b'(0,0) (1,2,3) 4',
+    b'(0,0)',
+])
+def test_malformed_lines_are_skipped(line):
+    pixels = decode(b'(1,1) (7,7,7)\n' + line + b'\n(3,1) (8,8,8)\n')
+    expected = tpf.new_raster(4, 2)
+    expected[1, 1] = 7
+    expected[1, 3] = 8
+    assert np.array_equal(pixels, expected)
+
+
+def test_malformed_lines_skipped_in_plain_text_body():
+    # Every line holds five numbers, so the plain text shortcut is tried
+    pixels = decode(b'(0,0) (1,2,3)\n(1 0,) (4,5,6)\n(2,0) (7,8,9)\n')
+    assert pixels[0].tolist() == [[1, 2, 3], [0, 0, 0], [7, 8, 9], [0, 0, 0]]
+
+
+def test_well_formed_dialects():
+    body = (b'(0,0) (1,2,3)\r\n'
+            b'( 1 , 0 ) ( 4 , 5 , 6 )\n'
+            b'(2,0,2) (7,8,9)\n'
+            b'(0,1)(10,11,12)\n'
+            b'(1,1) 1\n'
+            b'(2,1,2) 0')
+    pixels = decode(body, palette=[(20, 21, 22), (30, 31, 32)])
+    assert pixels.tolist() == [
+        [[1, 2, 3], [4, 5, 6], [7, 8, 9], [7, 8, 9]],
+        [[10, 11, 12], [30, 31, 32], [20, 21, 22], [20, 21, 22]],
+    ]
+
+
+def test_palette_lines_need_a_palette():
+    pixels = decode(b'(0,0) 1\n(1,0) (1,2,3)\n')
+    assert pixels[0].tolist() == [[0, 0, 0], [1, 2, 3], [0, 0, 0], [0, 0, 0]]
+
+
+def test_empty_palette_drops_every_index(tmp_path):
+    path = tmp_path / 'empty.tpf'
+    path.write_bytes(b'2x1\npalette 0\n(0,0) 0\n(1,0) (1,2,3)\n')
+    assert tpf.read(str(path)).tolist() == [[[0, 0, 0], [1, 2, 3]]]
+
+
+def test_negative_x_clips_runs_and_drops_pixels():
+    pixels = decode(b'(-1,0,3) (8,8,8)\n(-1,1) (9,9,9)\n(-3,1,2) (7,7,7)\n')
+    assert pixels.tolist() == [
+        [[8, 8, 8], [8, 8, 8], [0, 0, 0], [0, 0, 0]],
+        [[0, 0, 0], [0, 0, 0], [0, 0, 0], [0, 0, 0]],
+    ]
+
+
+def test_read_skips_malformed_lines(tmp_path):
+    path = tmp_path / 'bad.tpf'
+    path.write_bytes(b'1 2x1\n(0,0) (1,2,3)(4)\n(1.5,0) (9,9,9)\n')
+    assert tpf.read(str(path)).tolist() == [[[0, 0, 0], [0, 0, 0]]]
@@ -0,0 +1,63 @@
+import numpy as np
+
+import batch
+import tpf
+import validate
+
+
+def write(tmp_path, text):
+    path = tmp_path / 'in.tpf'
+    path.write_bytes(text)
+    return str(path)
+
+
+def test_check_flags_lines_by_shape(tmp_path):
+    path = write(tmp_path, b'1 2x1\n(0,0) (1,2,3)(4)\n(1.5,0) (9,9,9)\n(1,0) (5,6,7)\n')
+    report = validate.check(path)
+    assert report.problems['malformed'] == [2, ['line 2', 'line 3']]
+
+
+def test_repair_drops_flagged_lines(tmp_path):
+    path = write(tmp_path, b'1 4x1\n'
+                           b'(0,0) (1,2,3)(4)\n'   # malformed
+                           b'(1.5,0) (9,9,9)\n'    # malformed
+                           b'(-1,1) (8,8,8)\n'     # out of bounds
+                           b'(2,0) (300,0,0)\n'    # channel over 255
+                           b'(3,0) (5,6,7)\n')
+    out = str(tmp_path / 'out.tpf')
+    report = batch.check_file(path, out)
+    assert report.repaired == out
+    assert tpf.read(out).tolist() == [[[0, 0, 0], [0, 0, 0], [0, 0, 0], [5, 6, 7]]]
+    assert not validate.check(out).errors()
+
+
+def test_repair_clips_runs_and_keeps_overrides(tmp_path):
+    path = write(tmp_path, b'2x1\npalette 1\n(1,2,3)\n(0,0,5) 0\n(1,0) (4,5,6)\n(0,0) 3\n')
+    out = str(tmp_path / 'out.tpf')
+    batch.check_file(path, out)
+    assert tpf.read(out).tolist() == [[[1, 2, 3], [4, 5, 6]]]
+
+
+def test_runs_left_of_the_row_are_clipped_like_the_decoder(tmp_path):
+    path = write(tmp_path, b'1 4x1\n(-1,0,3) (8,8,8)\n(-2,0) (9,9,9)\n')
+    report = validate.check(path)
+    assert report.problems['run overflow'][0] == 1
+    assert report.problems['out of bounds'][0] == 1
+    out = str(tmp_path / 'out.tpf')
+    batch.check_file(path, out)
+    assert tpf.read(out).tolist() == tpf.read(path).tolist() == [[[8, 8, 8], [8, 8, 8], [0, 0, 0], [0, 0, 0]]]
+
+
+def test_empty_palette_reports_every_index(tmp_path):
+    path = write(tmp_path, b'2x1\npalette 0\n(0,0) 0\n(1,0,1) 1\n')
+    report = validate.check(path)
+    assert report.problems['palette index'][0] == 2
+    out = str(tmp_path / 'out.tpf')
+    batch.check_file(path, out)
+    assert tpf.read(out).tolist() == [[[0, 0, 0], [0, 0, 0]]]
+
+
+def test_check_without_decode_keeps_no_pixels(tmp_path):
+    path = write(tmp_path, b'1 1x1\n(0,0) (1,2,3)\n')
+    assert validate.check(path).pixels is None
+    assert np.array_equal(validate.check(path, decode=True).pixels, tpf.read(path))
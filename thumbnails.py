@@ -0,0 +1,56 @@
+import os
+
+import numpy as np
+
+import diskcache
+import pyramid
+import tpf
+
+THUMBNAIL_SIZE = 128
+
+
+def cache_path(file_path):
+    return diskcache.cache_path(file_path, 'thumbnails', '.npy')
+
+
+def fit(pixels, size):
+    """Shrink an (H, W, 3) array so its longer side is at most size."""
+    while max(pixels.shape[:2]) >= 2 * size:
+        pixels = pyramid.halve(pixels)
+    step = max(1, -(-max(pixels.shape[:2]) // size))
+    return np.ascontiguousarray(pixels[::step, ::step])
+
+
+def from_pyramid(file_path, size):
+    # A pyramid sidecar from the viewer already holds a small copy
+    levels = pyramid.load_cached(file_path, max_size=4 * size)
+    if not levels:
+        return None
+    level = next((level for level in levels if level is not None), None)
+    return None if level is None else fit(level, size)
+
+
+def load(file_path, size=THUMBNAIL_SIZE):
+    """Return the thumbnail for a TPF file, decoding it only on a cache miss."""
+    path = cache_path(file_path)
+    try:
+        thumbnail = np.load(path)
+        if thumbnail.ndim == 3 and max(thumbnail.shape[:2]) <= size:
+            diskcache.used(path)
+            return thumbnail
+    except (OSError, ValueError):
+        pass
+
+    thumbnail = from_pyramid(file_path, size)
+    if thumbnail is None:
+        thumbnail = fit(tpf.read_preview(file_path, 2 * size, background=(255, 255, 255)), size)
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tpf.atomic_path(path) as temp_path:
+            with open(temp_path, 'wb') as f:
+                np.save(f, thumbnail)
+        diskcache.stored(path)
+    except OSError:
+        pass
+    return thumbnail
@@ -0,0 +1,1560 @@
+import contextlib
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import zlib
+
+import numpy as np
+
+import tracing
+
+# Every byte that is not a digit becomes a separator for np.fromstring
+_DIGITS_ONLY = bytes(c if 48 <= c <= 57 else 32 for c in range(256))
+
+# Decimal text of 0-255, NUL padded to 3 columns; NULs are dropped on output
+_DEC_TEXT = np.frombuffer(b''.join(b'%d' % i + b'\0' * (3 - len(b'%d' % i)) for i in range(256)),
+                          dtype=np.uint8).reshape(256, 3)
+
+# Rows are formatted in blocks of about this many pixels
+ENCODE_BLOCK_PIXELS = 1 << 18
+WRITE_BUFFER_SIZE = 1 << 22
+
+# Files are decoded in chunks of this many bytes
+READ_CHUNK_SIZE = 1 << 22
+
+# Text files at least this big are worth splitting over processes, and so
+# are compressed text files with at least this many pixels
+PARALLEL_DECODE_BYTES = 1 << 25
+PARALLEL_DECODE_PIXELS = 1 << 21
+
+# Binary (version 2) files: a fixed little-endian header of magic, version,
+# compression, compression level, channel layout, width and height, then
+# either the raw pixel plane or a table of H + 1 row offsets followed by
+# zlib-compressed rows. The magic starts with a non-ASCII byte so it never
+# looks like a text header.
+BINARY_MAGIC = b'\x89TPF'
+BINARY_VERSION = 2
+BINARY_HEADER = struct.Struct('<4sHBB4sII12x')
+LAYOUT_RGB = b'RGB\0'
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_LZMA = 2
+
+# Compressed text files share the binary header with the TXT layout. The
+# header is followed by the chunk count, padded to 8 bytes, N + 1 chunk
+# offsets and N + 1 first rows, all u8; chunk i then holds the text lines
+# of rows [rows[i], rows[i + 1]), compressed on its own. Chunk 0 holds the
+# palette block, if any, and no pixel lines. Unpacked and joined, the
+# chunks are the body of the plain text file.
+LAYOUT_TEXT = b'TXT\0'
+CHUNK_COUNT = struct.Struct('<I4x')
+CODECS = {'zlib': COMPRESSION_ZLIB, 'lzma': COMPRESSION_LZMA}
+CODEC_LEVELS = {COMPRESSION_ZLIB: range(0, 10), COMPRESSION_LZMA: range(0, 10)}
+DEFAULT_LEVEL = 6
+
+# A pixel line is "(x,y) (r,g,b)", a run line is "(x,y,count) (r,g,b)"
+PIXEL_FIELDS = 5
+RUN_FIELDS = 6
+
+# Palette files list "(r,g,b)" entries in a "palette N" block after the
+# header; their lines are "(x,y) index" and "(x,y,count) index"
+PALETTE_PIXEL_FIELDS = 3
+PALETTE_RUN_FIELDS = 4
+PALETTE_MAX_COLORS = 256
+
+# Every line shape above, with each number written as 0 and blanks dropped,
+# by length; a line is only applied if it has one of these shapes
+LINE_SHAPES = {
+    12: (b'(0,0)(0,0,0)', PIXEL_FIELDS),
+    14: (b'(0,0,0)(0,0,0)', RUN_FIELDS),
+    6: (b'(0,0)0', PALETTE_PIXEL_FIELDS),
+    8: (b'(0,0,0)0', PALETTE_RUN_FIELDS),
+}
+# Digits and minus signs become 0 and blanks are deleted on the way there
+_SHAPE_TABLE = bytes(48 if 48 <= c <= 57 or c == 45 else c for c in range(256))
+_BLANKS = b' \t\r'
+# Lines that all hold five numbers have the pixel shape if this is what is
+# left of each once numbers and blanks go, and every "(" and "," is
+# directly followed by a number
+_PIXEL_PUNCTUATION = np.frombuffer(b'(,)(,,)\n', dtype='<u8')[0]
+
+# Runs averaging at least this many pixels are copied with one slice
+# assignment each instead of through a per-pixel index
+SLICE_RUN_LENGTH = 16
+# Bounds the per-pixel index built for short runs
+EXPAND_BLOCK_PIXELS = 1 << 20
+
+# Text formats every tool can write: one line per pixel, runs, or runs of
+# palette indices (falls back to runs for images with too many colors)
+TEXT_FORMATS = ('text', 'runs', 'palette')
+
+# Text files whose lines are sorted by row get a sidecar with the byte
+# offset of every few rows, so a region is decoded without reading the
+# rest. An entry covers a multiple of INDEX_ROWS rows and at least
+# INDEX_BLOCK_PIXELS pixels. Smaller files are cheaper to decode whole.
+# Lines after the sorted ones, as append() adds them, are the index's tail
+# and are decoded for every region.
+INDEX_ROWS = 8
+INDEX_BLOCK_PIXELS = 1 << 14
+INDEX_MIN_BYTES = 1 << 24
+
+# dialect() tells the text formats apart from this much of the first lines
+DIALECT_SAMPLE_BYTES = 1 << 16
+
+
+def parse_header(line):
+    """Return (version, width, height) from a "1 WxH" or bare "WxH" header.
+
+    version is None for the bare dialect written by Paint and the viewer.
+    """
+    if isinstance(line, bytes):
+        line = line.decode('ascii', 'replace')
+    parts = line.strip().split()
+    if len(parts) == 2:
+        version, dimensions = parts
+        if version != "1":
+            raise ValueError(f"Unsupported TPF version: {version}")
+    elif len(parts) == 1:
+        version, dimensions = None, parts[0]
+    else:
+        raise ValueError("Invalid TPF header format")
+
+    try:
+        width, height = map(int, dimensions.split('x'))
+    except ValueError:
+        raise ValueError("Invalid dimensions in TPF header")
+    if width <= 0 or height <= 0:
+        raise ValueError("Invalid dimensions in TPF header")
+    return version, width, height
+
+
+def _tokenize(body):
+    # Returns every integer in the body and how many of them sit on each line
+    raw = np.frombuffer(body, dtype=np.uint8)
+    is_digit = (raw >= 48) & (raw <= 57)
+    starts = is_digit.copy()
+    starts[1:] &= ~is_digit[:-1]
+    del is_digit
+    if not starts.any():
+        # np.fromstring reads a lone 0 out of an all-blank string
+        return np.empty(0, dtype=np.int64), np.zeros(1, dtype=np.int64)
+
+    values = np.fromstring(body.translate(_DIGITS_ONLY), dtype=np.int64, sep=' ')
+
+    # Negative numbers only show up in broken files; keep the sign so a pixel
+    # there falls outside the image instead of landing on a wrong pixel, and
+    # a run starting left of the row is clipped to it like any other run
+    if b'-' in body:
+        start_pos = np.flatnonzero(starts)
+        has_prev = start_pos > 0
+        negative = np.zeros(len(start_pos), dtype=bool)
+        negative[has_prev] = raw[start_pos[has_prev] - 1] == 45
+        values[negative] *= -1
+
+    fields = np.add.reduceat(starts, _line_starts(raw), dtype=np.int64)
+    if fields.sum() != len(values):
+        raise ValueError("Malformed TPF pixel data")
+    return values, fields
+
+
+def _line_shapes(body, fields, palette):
+    """Return (the field count of each line, the length of its shape).
+
+    The count is that of the line's shape, or 0 for a line whose shape is
+    not in LINE_SHAPES or whose numbers _tokenize() read differently, such
+    as "(1.5,0) (9,9,9)". Palette shapes only count with a palette.
+    """
+    count = len(fields)
+    if np.all(fields == PIXEL_FIELDS) and body.endswith(b'\n') and b'-' not in body:
+        # Plain text, most of the bytes in most files, skips the line by
+        # line check: with as many "(" and "," followed by a digit as there
+        # are numbers, every slot holds one number and none is outside
+        punctuation = body.translate(None, b'0123456789' + _BLANKS)
+        if (len(punctuation) == 8 * count
+                and np.all(np.frombuffer(punctuation, dtype='<u8') == _PIXEL_PUNCTUATION)):
+            raw = np.frombuffer(body, dtype=np.uint8)
+            opener = (raw[:-1] == 40) | (raw[:-1] == 44)
+            opener &= (raw[1:] >= 48) & (raw[1:] <= 57)
+            if np.count_nonzero(opener) == PIXEL_FIELDS * count:
+                return np.full(count, PIXEL_FIELDS), np.full(count, 12)
+    # Each number (with its sign) becomes one 0 and blanks go, so
+    # "(10, -2) (255,0,7)" reads "(0,0)(0,0,0)"
+    shape = np.frombuffer(body.translate(_SHAPE_TABLE, _BLANKS), dtype=np.uint8)
+    digit = shape == 48
+    keep = ~digit
+    keep[1:] |= ~digit[:-1]
+    shape = shape[keep]
+    ends = np.flatnonzero(shape == 10)
+    if len(ends) < len(fields):
+        ends = np.append(ends, len(shape))
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    lengths = ends - starts
+    expected = np.zeros(len(fields), dtype=np.int64)
+    for length, (pattern, field_count) in LINE_SHAPES.items():
+        if palette is None and field_count <= PALETTE_RUN_FIELDS:
+            continue
+        rows = np.flatnonzero(lengths == length)
+        match = np.ones(len(rows), dtype=bool)
+        if len(rows) == len(fields):
+            # Lines of one length, as written by the tools, stack into
+            # columns that are plain slices
+            for i, c in enumerate(pattern):
+                match &= shape[i::length + 1] == c
+        else:
+            at = starts[rows]
+            for i, c in enumerate(pattern):
+                match &= shape[at + i] == c
+        expected[rows[match]] = field_count
+    # A shape only fits if the numbers in it were read as many numbers
+    expected[expected != fields] = 0
+    return expected, lengths
+
+
+def _line_starts(raw):
+    line_starts = np.flatnonzero(raw == 10) + 1
+    if len(line_starts) and line_starts[-1] == len(raw):
+        line_starts = line_starts[:-1]
+    return np.concatenate(([0], line_starts))
+
+
+@tracing.traced('apply')
+def _apply(pixels, x, y, length, colors):
+    # Write pixels/runs in file order, so later lines override earlier ones
+    height, width = pixels.shape[:2]
+    # Runs are clipped to their row at both ends
+    end = np.minimum(x + length, width)
+    x = np.maximum(x, 0)
+    # Viewing as unsigned folds the negative check into the upper bound
+    valid = (
+        (y.view(np.uint64) < height) & (x < end)
+        & (colors.view(np.uint64).max(axis=1) <= 255)
+    )
+    x, y, end, colors = x[valid], y[valid], end[valid], colors[valid]
+    if len(y) == 0:
+        return None
+    length = end - x
+    start = y * width + x
+
+    # Treat each RGB triple as one 3-byte item so every write is a single copy
+    flat = pixels.reshape(-1, 3).view('V3').reshape(-1)
+    colors = np.ascontiguousarray(colors, dtype=np.uint8).view('V3').reshape(-1)
+    # The band of rows and the span of flat pixel indices written
+    band = int(y.min()), int(y.max()) + 1, int(start.min()), int((start + length).max())
+    if np.all(length == 1):
+        flat[start] = colors
+        return band
+
+    # Consecutive groups of runs keep the file order while bounding memory
+    total = np.cumsum(length)
+    group = (total - length) // EXPAND_BLOCK_PIXELS
+    bounds = np.flatnonzero(np.diff(group)) + 1
+    for lo, hi in zip(np.concatenate(([0], bounds)), np.concatenate((bounds, [len(start)]))):
+        pixel_count = int(total[hi - 1] - total[lo] + length[lo])
+        if pixel_count >= SLICE_RUN_LENGTH * (hi - lo):
+            # Long runs, as in flat artwork: one slice per run
+            for s, n, c in zip(start[lo:hi].tolist(), length[lo:hi].tolist(), colors[lo:hi]):
+                flat[s:s + n] = c
+        else:
+            n = length[lo:hi]
+            first = np.cumsum(n) - n
+            index = np.repeat(start[lo:hi] - first, n) + np.arange(pixel_count)
+            flat[index] = np.repeat(colors[lo:hi], n)
+    return band
+
+
+def decode_into(pixels, body, palette=None):
+    """Apply complete pixel lines to an (H, W, 3) array.
+
+    palette is the (N, 3) table of a palette file; without it index lines
+    are skipped. Returns the (top, bottom) row band written, or None.
+    """
+    band = _decode(pixels, body, palette)
+    return band and band[:2]
+
+
+def _decode(pixels, body, palette, origin=(0, 0)):
+    # decode_into, also returning the span of flat pixel indices written;
+    # pixels holds the region of the image whose top left corner is origin
+    if not body or body.isspace():
+        return None
+
+    with tracing.span('tokenize', bytes=len(body)):
+        values, fields = _tokenize(body)
+        if not len(values):
+            return None
+        # Lines are told apart by their shape, not just by how many numbers
+        # they hold, so "(0,0) (1,2,3)(4)" is skipped rather than misread
+        expected, _ = _line_shapes(body, fields, palette)
+    first = np.cumsum(fields) - fields
+    left, top = origin
+
+    if np.all(expected == PIXEL_FIELDS):
+        rows = values.reshape(-1, PIXEL_FIELDS)
+        x, y = rows[:, 0], rows[:, 1]
+        if left or top:
+            x, y = x - left, y - top
+        return _apply(pixels, x, y, np.ones(len(rows), dtype=np.int64), rows[:, 2:])
+
+    # Mixed dialect: keep pixel and run lines, skip anything malformed
+    kept = expected > 0
+    first, fields = first[kept], fields[kept]
+    is_run = (fields == RUN_FIELDS) | (fields == PALETTE_RUN_FIELDS)
+    x = values[first]
+    y = values[first + 1]
+    x -= left
+    y -= top
+    length = np.where(is_run, values[first + 2], 1)
+    is_index = fields <= PALETTE_RUN_FIELDS
+    colors = np.empty((len(first), 3), dtype=np.int64)
+    rgb_at = (first + fields - 3)[~is_index]
+    colors[~is_index] = values[rgb_at[:, None] + np.arange(3)]
+    if is_index.any():
+        index = values[(first + fields - 1)[is_index]]
+        in_range = index.view(np.uint64) < len(palette)
+        # An index outside the palette gets an invalid color and is dropped;
+        # with an empty palette that is every index
+        colors[is_index] = -1
+        colors[np.flatnonzero(is_index)[in_range]] = palette[index[in_range]]
+    return _apply(pixels, x, y, length, colors)
+
+
+def _palette_count(line):
+    parts = line.split()
+    if len(parts) != 2 or parts[0] != b'palette' or not parts[1].isdigit():
+        raise ValueError("Invalid TPF palette")
+    return int(parts[1])
+
+
+def _parse_palette(entries, count):
+    values, _ = _tokenize(entries)
+    if len(values) != 3 * count or (count and not 0 <= values.min() <= values.max() <= 255):
+        raise ValueError("Invalid TPF palette")
+    return values.reshape(count, 3)
+
+
+def _split_palette(body):
+    # Returns (palette or None, the pixel lines after it)
+    if not body.startswith(b'palette'):
+        return None, body
+    line, _, body = body.partition(b'\n')
+    count = _palette_count(line)
+    parts = body.split(b'\n', count)
+    if len(parts) <= count:
+        parts.append(b'')
+    return _parse_palette(b'\n'.join(parts[:count]), count), parts[count]
+
+
+def new_raster(width, height, background=(0, 0, 0)):
+    pixels = np.empty((height, width, 3), dtype=np.uint8)
+    pixels[:] = background
+    return pixels
+
+
+def decode_body(body, width, height, background=(0, 0, 0)):
+    """Decode the text after the header of a TPF file into an (H, W, 3) uint8 array."""
+    pixels = new_raster(width, height, background)
+    palette, body = _split_palette(body)
+    decode_into(pixels, body, palette)
+    return pixels
+
+
+def decode(data, background=(0, 0, 0)):
+    """Decode a whole TPF file held in memory into an (H, W, 3) uint8 array."""
+    if not data or data.isspace():
+        raise ValueError("Empty TPF file")
+    header, _, body = data.partition(b'\n')
+    _, width, height = parse_header(header)
+    return decode_body(body, width, height, background)
+
+
+def iter_bands(file_path, background=(0, 0, 0), chunk_size=READ_CHUNK_SIZE, progress=None):
+    """Decode a TPF file chunk by chunk, yielding (pixels, top, bottom).
+
+    pixels is the whole raster being filled in place and [top, bottom) the
+    rows written by the latest chunk. The first yield comes right after the
+    header with an empty band, so callers can size their output early.
+    Memory stays at one raster plus about one chunk of text. Uncompressed
+    binary files are memory-mapped instead and pixels is a read-only view
+    of the mapping, so nothing is copied until the caller does; compressed
+    ones are inflated a band of rows at a time.
+
+    progress, if given, is called as progress(done, total) after every
+    chunk; raising from it aborts the decode.
+    """
+    if is_binary(file_path):
+        yield from _iter_binary_bands(file_path, progress)
+        return
+    if is_compressed(file_path):
+        yield from _iter_compressed_bands(file_path, background, progress)
+        return
+
+    total = os.path.getsize(file_path)
+    with open(file_path, 'rb') as f:
+        width, height, palette = _read_text_header(f)
+        pixels = new_raster(width, height, background)
+        yield pixels, 0, 0
+
+        tail = b''
+        while True:
+            with tracing.span('read') as span:
+                chunk = f.read(chunk_size)
+                span.add(bytes=len(chunk))
+            if not chunk:
+                break
+            if progress:
+                progress(f.tell(), total)
+            # Only complete lines are parsed; the partial last line waits
+            # for the next chunk
+            cut = chunk.rfind(b'\n')
+            if cut < 0:
+                tail += chunk
+                continue
+            band = decode_into(pixels, tail + chunk[:cut + 1], palette)
+            tail = chunk[cut + 1:]
+            if band:
+                yield (pixels,) + band
+
+        band = decode_into(pixels, tail, palette)
+        if band:
+            yield (pixels,) + band
+
+
+def _read_text_header(f):
+    # Returns (width, height, palette or None) and leaves f at the first pixel line
+    header = f.readline()
+    if not header or header.isspace():
+        raise ValueError("Empty TPF file")
+    _, width, height = parse_header(header)
+    body_start = f.tell()
+    line = f.readline()
+    if line.startswith(b'palette'):
+        count = _palette_count(line)
+        return width, height, _parse_palette(b''.join(f.readline() for _ in range(count)), count)
+    f.seek(body_start)
+    return width, height, None
+
+
+def _read_counts(pixels, file_path, *args, **kwargs):
+    # Bytes and pixels of a traced read, see tracing.traced
+    return {'bytes': os.path.getsize(file_path), 'pixels': pixels.shape[0] * pixels.shape[1]}
+
+
+def _write_counts(result, file_path, pixels, *args, **kwargs):
+    return {'bytes': os.path.getsize(file_path), 'pixels': pixels.shape[0] * pixels.shape[1]}
+
+
+@tracing.traced('tpf.read', _read_counts)
+def read(file_path, background=(0, 0, 0), chunk_size=READ_CHUNK_SIZE, progress=None):
+    for pixels, _, _ in iter_bands(file_path, background, chunk_size, progress):
+        pass
+    return pixels
+
+
+@tracing.traced('tpf.read_parallel', _read_counts)
+def read_parallel(file_path, background=(0, 0, 0), jobs=None, progress=None):
+    """Decode a large text TPF file with a pool of processes.
+
+    The body is split at line boundaries into a few ranges per process and
+    every range is decoded straight into a shared-memory raster. The result
+    matches read(): if two ranges wrote the same pixels, the file is decoded
+    again in order. Binary and small files go through read().
+    """
+    for pixels, _, _ in iter_bands_parallel(file_path, background, jobs, progress):
+        pass
+    return pixels
+
+
+def iter_bands_parallel(file_path, background=(0, 0, 0), jobs=None, progress=None):
+    """Like iter_bands, decoding large text files as read_parallel does.
+
+    Bands come in the order the ranges finish, which is only roughly top to
+    bottom, and a band covers whole rows around what its range wrote. The
+    last yield always covers the whole image. Compressed text files are
+    split into ranges of chunks.
+    """
+    plan = _parallel_plan(file_path, jobs or os.cpu_count() or 1)
+    if plan is None:
+        yield from iter_bands(file_path, background, progress=progress)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from multiprocessing import get_context, shared_memory
+
+    width, height, palette, worker, ranges, decode_all = plan
+    result = new_raster(width, height, background)
+    yield result, 0, 0
+    memory = shared_memory.SharedMemory(create=True, size=width * height * 3)
+    try:
+        pixels = np.ndarray((height, width, 3), dtype=np.uint8, buffer=memory.buf)
+        pixels[:] = background
+        # Spawned workers do not inherit the caller's threads, e.g. a GUI's
+        executor = ProcessPoolExecutor(jobs, mp_context=get_context('spawn'))
+        try:
+            futures = [executor.submit(worker, file_path, start, end, memory.name,
+                                       width, height, palette)
+                       for start, end in ranges]
+            for done, future in enumerate(as_completed(futures), 1):
+                span = future.result()
+                if progress:
+                    progress(done, len(futures))
+                if span:
+                    # Each finished range is copied out so callers can show it
+                    lo, hi = span
+                    result.reshape(-1, 3)[lo:hi] = pixels.reshape(-1, 3)[lo:hi]
+                    yield result, lo // width, -(-hi // width)
+        finally:
+            executor.shutdown(cancel_futures=True)
+        spans = sorted(future.result() for future in futures if future.result())
+
+        if any(a[1] > b[0] for a, b in zip(spans, spans[1:])):
+            result[:] = background
+            decode_all(result)
+    finally:
+        # The view must go before the block closes, also on a cancel
+        pixels = None
+        memory.close()
+        memory.unlink()
+    yield result, 0, height
+
+
+def _parallel_plan(file_path, jobs):
+    # (width, height, palette, worker, ranges, decode_all) for a file worth
+    # decoding on several processes, or None; decode_all decodes the whole
+    # file in order into a raster
+    if jobs < 2 or is_binary(file_path):
+        return None
+    buffer = _map(file_path)
+    if is_compressed(file_path):
+        compression, width, height = _read_binary_header(buffer, LAYOUT_TEXT)
+        offsets, _ = _chunk_table(buffer, height)
+        count = len(offsets) - 1
+        if width * height < PARALLEL_DECODE_PIXELS or count < 3:
+            return None
+        palette = _chunk_palette(buffer, offsets, compression)
+        bounds = np.linspace(1, count, min(4 * jobs, count - 1) + 1).astype(int).tolist()
+        ranges = [(a, b) for a, b in zip(bounds, bounds[1:]) if a < b]
+        return (width, height, palette, _decode_chunks, ranges,
+                lambda pixels: _decode_chunk_range(pixels, buffer, 1, count, palette))
+
+    if os.path.getsize(file_path) < PARALLEL_DECODE_BYTES:
+        return None
+    with open(file_path, 'rb') as f:
+        width, height, palette = _read_text_header(f)
+        body_start = f.tell()
+    return (width, height, palette, _decode_range, _split_lines(buffer, body_start, 4 * jobs),
+            lambda pixels: _decode_lines(pixels, buffer, body_start, len(buffer), palette))
+
+
+def _split_lines(buffer, start, count):
+    # Cut buffer[start:] into about count ranges that end on a newline
+    end = len(buffer)
+    bounds = [start]
+    for i in range(1, count):
+        cut = buffer.find(b'\n', max(start + (end - start) * i // count, bounds[-1]))
+        if cut < 0:
+            break
+        bounds.append(cut + 1)
+    bounds.append(end)
+    return [(a, b) for a, b in zip(bounds, bounds[1:]) if a < b]
+
+
+def _decode_lines(pixels, buffer, start, end, palette, origin=(0, 0)):
+    # Decodes buffer[start:end] a chunk at a time; returns the (lo, hi)
+    # span of flat pixel indices written, or None
+    lo = hi = None
+    while start < end:
+        stop = min(start + READ_CHUNK_SIZE, end)
+        if stop < end:
+            cut = buffer.rfind(b'\n', start, stop)
+            if cut < 0:
+                cut = buffer.find(b'\n', stop, end)
+            stop = end if cut < 0 else cut + 1
+        band = _decode(pixels, buffer[start:stop], palette, origin)
+        if band:
+            lo = band[2] if lo is None else min(lo, band[2])
+            hi = band[3] if hi is None else max(hi, band[3])
+        start = stop
+    return None if lo is None else (lo, hi)
+
+
+def _decode_range(file_path, start, end, memory_name, width, height, palette):
+    # Runs in a read_parallel worker process
+    return _decode_shared(memory_name, width, height,
+                          lambda pixels: _decode_lines(pixels, _map(file_path), start, end, palette))
+
+
+def _decode_chunks(file_path, first, last, memory_name, width, height, palette):
+    # Runs in a read_parallel worker process, for compressed text files
+    return _decode_shared(memory_name, width, height,
+                          lambda pixels: _decode_chunk_range(pixels, _map(file_path), first, last, palette))
+
+
+def _decode_shared(memory_name, width, height, decode):
+    from multiprocessing import shared_memory
+    # Workers share the parent's resource tracker, so attaching adds no
+    # second owner; the parent unlinks the block
+    memory = shared_memory.SharedMemory(name=memory_name)
+    try:
+        pixels = np.ndarray((height, width, 3), dtype=np.uint8, buffer=memory.buf)
+        span = decode(pixels)
+        del pixels
+    finally:
+        memory.close()
+    return span
+
+
+def read_size(file_path):
+    """Return (width, height) from the header without decoding pixels."""
+    with open(file_path, 'rb') as f:
+        head = f.read(BINARY_HEADER.size)
+        if head.startswith(BINARY_MAGIC):
+            _, width, height = _read_binary_header(head, head[8:12])
+            return width, height
+        f.seek(0)
+        header = f.readline()
+    if not header or header.isspace():
+        raise ValueError("Empty TPF file")
+    _, width, height = parse_header(header)
+    return width, height
+
+
+def _layout(file_path):
+    # The layout of a version 2 file, or None for a text file
+    with open(file_path, 'rb') as f:
+        head = f.read(BINARY_HEADER.size)
+    if not head.startswith(BINARY_MAGIC):
+        return None
+    return head[8:12]
+
+
+def is_binary(file_path):
+    """True for version 2 files holding pixels; compressed text is not binary."""
+    layout = _layout(file_path)
+    return layout is not None and layout != LAYOUT_TEXT
+
+
+def is_compressed(file_path):
+    """True for text TPF stored in compressed chunks, see write()."""
+    return _layout(file_path) == LAYOUT_TEXT
+
+
+def dialect(file_path):
+    """Return the write() arguments that lay out a file the way it is.
+
+    A dict with tpf_format, version for plain text, and compression and
+    level; tpf_format is 'binary' for version 2 pixel files, which
+    write_binary() takes the compression and level of. The text format
+    is told from the palette and the first lines, which is how all the
+    writers here start a file. Raises ValueError for a file none of them
+    would have written.
+    """
+    with open(file_path, 'rb') as f:
+        head = f.read(BINARY_HEADER.size)
+        if not head.startswith(BINARY_MAGIC):
+            f.seek(0)
+            version, _, _ = parse_header(f.readline())
+            return {'tpf_format': _sample_format(f.read(DIALECT_SAMPLE_BYTES)), 'version': version,
+                    'compression': COMPRESSION_NONE, 'level': DEFAULT_LEVEL}
+    layout = head[8:12]
+    compression, _, height = _read_binary_header(head, layout)
+    level = head[7] if compression else DEFAULT_LEVEL
+    if layout == LAYOUT_RGB:
+        return {'tpf_format': 'binary', 'compression': compression, 'level': level}
+    buffer = _map(file_path)
+    offsets, _ = _chunk_table(buffer, height)
+    sample = _chunk(buffer, offsets, 0, compression)
+    if not sample and len(offsets) > 2:
+        sample = _chunk(buffer, offsets, 1, compression)[:DIALECT_SAMPLE_BYTES]
+    return {'tpf_format': _sample_format(sample), 'version': None,
+            'compression': compression, 'level': level}
+
+
+def _sample_format(body):
+    # 'palette' with a palette block, 'runs' once a run line shows up and
+    # 'text' for pixel lines only
+    if body.startswith(b'palette'):
+        return 'palette'
+    body = body[:body.rfind(b'\n') + 1]
+    _, fields = _tokenize(body)
+    if np.any(fields == RUN_FIELDS):
+        return 'runs'
+    if np.all((fields == PIXEL_FIELDS) | (fields == 0)):
+        return 'text'
+    raise ValueError("Unrecognized TPF dialect")
+
+
+def _read_binary_header(buffer, layout=LAYOUT_RGB):
+    if len(buffer) < BINARY_HEADER.size:
+        raise ValueError("Truncated TPF header")
+    magic, version, compression, _, file_layout, width, height = BINARY_HEADER.unpack_from(buffer)
+    if magic != BINARY_MAGIC:
+        raise ValueError("Invalid TPF header format")
+    if version != BINARY_VERSION:
+        raise ValueError(f"Unsupported TPF version: {version}")
+    if file_layout != layout or layout not in (LAYOUT_RGB, LAYOUT_TEXT):
+        file_layout = file_layout.rstrip(b'\0').decode('ascii', 'replace')
+        raise ValueError(f"Unsupported TPF channel layout: {file_layout}")
+    known = (COMPRESSION_NONE, COMPRESSION_ZLIB) if layout == LAYOUT_RGB else tuple(CODECS.values())
+    if compression not in known:
+        raise ValueError(f"Unsupported TPF compression: {compression}")
+    return compression, width, height
+
+
+def _map(file_path):
+    with open(file_path, 'rb') as f:
+        # The map keeps its own handle, so the file can be closed right away
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _compress(data, compression, level):
+    if compression == COMPRESSION_LZMA:
+        import lzma
+        return lzma.compress(data, preset=level)
+    return zlib.compress(data, level)
+
+
+def _decompress(data, compression):
+    if compression == COMPRESSION_LZMA:
+        import lzma
+        return lzma.decompress(data)
+    return zlib.decompress(data)
+
+
+def _chunk_table(buffer, height):
+    # Returns the (offsets, rows) arrays of a compressed text file
+    start = BINARY_HEADER.size + CHUNK_COUNT.size
+    if len(buffer) < start:
+        raise ValueError("Truncated TPF chunk table")
+    count, = CHUNK_COUNT.unpack_from(buffer, BINARY_HEADER.size)
+    if count < 1 or len(buffer) < start + 16 * (count + 1):
+        raise ValueError("Truncated TPF chunk table")
+    table = np.frombuffer(buffer, dtype='<u8', count=2 * (count + 1), offset=start).astype(np.int64)
+    offsets, rows = table[:count + 1], table[count + 1:]
+    if (offsets[0] < start + 16 * (count + 1) or offsets[-1] > len(buffer) or np.any(np.diff(offsets) < 0)
+            or rows[0] != 0 or rows[-1] != height or np.any(np.diff(rows) < 0)):
+        raise ValueError("Corrupt TPF chunk table")
+    return offsets, rows
+
+
+def _chunk(buffer, offsets, i, compression):
+    try:
+        return _decompress(buffer[offsets[i]:offsets[i + 1]], compression)
+    except Exception:
+        raise ValueError(f"Corrupt TPF chunk {i}")
+
+
+def _chunk_palette(buffer, offsets, compression):
+    palette, _ = _split_palette(_chunk(buffer, offsets, 0, compression))
+    return palette
+
+
+def _decode_chunk_range(pixels, buffer, first, last, palette, origin=(0, 0)):
+    # Decodes chunks [first, last) of a compressed text file; returns the
+    # (lo, hi) span of flat pixel indices written, or None
+    compression, _, height = _read_binary_header(buffer, LAYOUT_TEXT)
+    offsets, _ = _chunk_table(buffer, height)
+    lo = hi = None
+    for i in range(first, last):
+        band = _decode(pixels, _chunk(buffer, offsets, i, compression), palette, origin)
+        if band:
+            lo = band[2] if lo is None else min(lo, band[2])
+            hi = band[3] if hi is None else max(hi, band[3])
+    return None if lo is None else (lo, hi)
+
+
+def _iter_compressed_bands(file_path, background, progress=None):
+    buffer = _map(file_path)
+    compression, width, height = _read_binary_header(buffer, LAYOUT_TEXT)
+    offsets, _ = _chunk_table(buffer, height)
+    pixels = new_raster(width, height, background)
+    yield pixels, 0, 0
+    palette = _chunk_palette(buffer, offsets, compression)
+    count = len(offsets) - 1
+    for i in range(1, count):
+        band = decode_into(pixels, _chunk(buffer, offsets, i, compression), palette)
+        if progress:
+            progress(i, count - 1)
+        if band:
+            yield (pixels,) + band
+
+
+def _iter_binary_bands(file_path, progress=None):
+    buffer = _map(file_path)
+    compression, width, height = _read_binary_header(buffer)
+    if compression == COMPRESSION_NONE:
+        pixels = _plane(buffer, width, height)
+        yield pixels, 0, 0
+        if progress:
+            progress(height, height)
+        yield pixels, 0, height
+        return
+
+    pixels = new_raster(width, height)
+    yield pixels, 0, 0
+    offsets = _row_offsets(buffer, height)
+    rows = max(1, ENCODE_BLOCK_PIXELS // max(width, 1))
+    for top in range(0, height, rows):
+        bottom = min(top + rows, height)
+        _inflate_rows(buffer, offsets, pixels, top, bottom)
+        if progress:
+            progress(bottom, height)
+        yield pixels, top, bottom
+
+
+def _row_offsets(buffer, height):
+    return np.frombuffer(buffer, dtype='<u8', count=height + 1, offset=BINARY_HEADER.size)
+
+
+def _inflate_row(buffer, offsets, y, width):
+    row = zlib.decompress(buffer[offsets[y]:offsets[y + 1]])
+    if len(row) != width * 3:
+        raise ValueError("Corrupt TPF pixel data")
+    return np.frombuffer(row, dtype=np.uint8).reshape(width, 3)
+
+
+def _inflate_rows(buffer, offsets, pixels, top, bottom):
+    for y in range(top, bottom):
+        pixels[y] = _inflate_row(buffer, offsets, y, pixels.shape[1])
+
+
+@tracing.traced('tpf.read_preview', _read_counts)
+def read_preview(file_path, max_size, background=(0, 0, 0)):
+    """Decode a subsampled copy whose sides are at most about max_size.
+
+    Binary files only touch the sampled rows. Text files do the same when
+    a row index was saved for them (see row_index); otherwise they are
+    decoded in full and then subsampled.
+    """
+    if not is_binary(file_path):
+        width, height = read_size(file_path)
+        step = _preview_step(width, height, max_size)
+        index = load_index(file_path) if step > 1 else None
+        # A tail would be decoded again for every block of rows
+        if index and index[2] == os.path.getsize(file_path):
+            return _preview_rows(file_path, index, width, height, step, background)
+        pixels = read(file_path, background)
+        return pixels[::step, ::step].copy()
+
+    buffer = _map(file_path)
+    compression, width, height = _read_binary_header(buffer)
+    step = _preview_step(width, height, max_size)
+    if compression == COMPRESSION_NONE:
+        return _plane(buffer, width, height)[::step, ::step].copy()
+
+    offsets = _row_offsets(buffer, height)
+    rows = range(0, height, step)
+    preview = np.empty((len(rows), len(range(0, width, step)), 3), dtype=np.uint8)
+    for i, y in enumerate(rows):
+        preview[i] = _inflate_row(buffer, offsets, y, width)[::step]
+    return preview
+
+
+def _preview_rows(file_path, index, width, height, step, background):
+    # Decodes only the indexed blocks of rows that hold a sampled row
+    rows = index[0]
+    sampled = np.arange(0, height, step)
+    blocks = np.unique(np.searchsorted(rows, sampled, 'right') - 1)
+    if len(blocks) >= len(rows):
+        return read(file_path, background)[::step, ::step].copy()
+    preview = np.empty((len(sampled), len(range(0, width, step)), 3), dtype=np.uint8)
+    for block in blocks.tolist():
+        top = int(rows[block]) if block >= 0 else 0
+        bottom = int(rows[block + 1]) if block + 1 < len(rows) else height
+        pixels = new_raster(width, bottom - top, background)
+        _decode_rows(pixels, file_path, index, 0, top)
+        wanted = (sampled >= top) & (sampled < bottom)
+        preview[wanted] = pixels[sampled[wanted] - top, ::step]
+    return preview
+
+
+def _preview_step(width, height, max_size):
+    return max(1, -(-max(width, height) // max_size))
+
+
+def index_path(file_path):
+    """Sidecar path of a text file's row index; it changes with the file's size and mtime."""
+    import diskcache
+    return diskcache.cache_path(file_path, 'indexes', '.npz')
+
+
+def save_index(file_path, index):
+    """Persist (rows, offsets, end) for a file, or None for one that cannot be indexed."""
+    path = index_path(file_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    rows, offsets, end = index or ((), (), 0)
+    with atomic_path(path) as temp_path:
+        with open(temp_path, 'wb') as f:
+            np.savez(f, rows=np.asarray(rows, dtype=np.int64),
+                     offsets=np.asarray(offsets, dtype=np.int64), end=end, ordered=index is not None)
+    import diskcache
+    diskcache.stored(path)
+
+
+def load_index(file_path):
+    """Return the cached index as (rows, offsets, end) or None, and False on a miss."""
+    try:
+        path = index_path(file_path)
+        with np.load(path) as data:
+            index = (data['rows'], data['offsets'], int(data['end'])) if data['ordered'] else None
+    except Exception:
+        return False
+    import diskcache
+    diskcache.used(path)
+    return index
+
+
+def row_index(file_path):
+    """Return (rows, offsets, end) for a text TPF file, or None if it cannot be indexed.
+
+    offsets[i] is the byte offset of the first line at or below row rows[i].
+    Lines are indexed while they are sorted by row, as the converter and
+    Paint write them; end is the offset of the first line that is not, or
+    the file size. The index is built with one pass over the file on first
+    use and kept in a sidecar, see index_path.
+    """
+    index = load_index(file_path)
+    if index is False:
+        index = _scan_index(file_path)
+        try:
+            save_index(file_path, index)
+        except OSError:
+            pass
+    return index
+
+
+def _index_step(width):
+    return INDEX_ROWS * max(1, -(-INDEX_BLOCK_PIXELS // (INDEX_ROWS * width)))
+
+
+def _scan_index(file_path):
+    rows, offsets = [], []
+    next_row = 0
+    last_row = -1
+    with open(file_path, 'rb') as f:
+        width, _, _ = _read_text_header(f)
+        step = _index_step(width)
+        position = f.tell()
+        tail = b''
+        while True:
+            chunk = f.read(READ_CHUNK_SIZE)
+            body = tail + chunk
+            if chunk:
+                cut = body.rfind(b'\n')
+                if cut < 0:
+                    tail = body
+                    continue
+                body, tail = body[:cut + 1], body[cut + 1:]
+
+            y, starts = _line_rows(body)
+            # The sorted lines end at the first one above its predecessor
+            cut = len(y)
+            if len(y) and y[0] < last_row:
+                cut = 0
+            elif len(y) > 1:
+                drops = np.flatnonzero(y[1:] < y[:-1])
+                if len(drops):
+                    cut = int(drops[0]) + 1
+            if cut:
+                last_row = int(y[cut - 1])
+                boundaries = np.arange(next_row, last_row + 1, step)
+                if len(boundaries):
+                    rows.extend(boundaries.tolist())
+                    offsets.extend((position + starts[np.searchsorted(y[:cut], boundaries)]).tolist())
+                    next_row = int(boundaries[-1]) + step
+            if cut < len(y):
+                position += int(starts[cut])
+                break
+            position += len(body)
+            if not chunk:
+                break
+    return np.array(rows, dtype=np.int64), np.array(offsets, dtype=np.int64), position
+
+
+def _line_rows(body):
+    # The row and byte offset of every pixel or run line in the body
+    values, fields = _tokenize(body)
+    if not len(values):
+        return values, values
+    first = np.cumsum(fields) - fields
+    kept = (fields >= PALETTE_PIXEL_FIELDS) & (fields <= RUN_FIELDS)
+    starts = _line_starts(np.frombuffer(body, dtype=np.uint8))
+    return values[first[kept] + 1], starts[kept]
+
+
+@tracing.traced('tpf.decode_region', _read_counts)
+def decode_region(file_path, x, y, width, height, background=(0, 0, 0)):
+    """Decode the width x height rectangle at (x, y), clipped to the image.
+
+    Binary files only read the rows of the rectangle and compressed text
+    files only unpack the chunks holding them. Text files seek to them
+    through row_index() and are decoded whole only when they are under
+    INDEX_MIN_BYTES or their lines are not sorted by row.
+    """
+    full_width, full_height = read_size(file_path)
+    left, top = max(x, 0), max(y, 0)
+    right, bottom = max(left, min(x + width, full_width)), max(top, min(y + height, full_height))
+
+    if is_binary(file_path):
+        buffer = _map(file_path)
+        compression, _, _ = _read_binary_header(buffer)
+        if compression == COMPRESSION_NONE:
+            return _plane(buffer, full_width, full_height)[top:bottom, left:right].copy()
+        offsets = _row_offsets(buffer, full_height)
+        pixels = np.empty((bottom - top, right - left, 3), dtype=np.uint8)
+        for row in range(top, bottom):
+            pixels[row - top] = _inflate_row(buffer, offsets, row, full_width)[left:right]
+        return pixels
+
+    if is_compressed(file_path):
+        # Only the chunks whose row bands meet the rectangle are unpacked
+        buffer = _map(file_path)
+        compression, _, _ = _read_binary_header(buffer, LAYOUT_TEXT)
+        offsets, rows = _chunk_table(buffer, full_height)
+        pixels = new_raster(right - left, bottom - top, background)
+        wanted = np.flatnonzero((rows[:-1] < bottom) & (rows[1:] > top))
+        wanted = wanted[wanted > 0]
+        if pixels.size and len(wanted):
+            palette = _chunk_palette(buffer, offsets, compression)
+            _decode_chunk_range(pixels, buffer, int(wanted[0]), int(wanted[-1]) + 1, palette, (left, top))
+        return pixels
+
+    index = row_index(file_path) if os.path.getsize(file_path) >= INDEX_MIN_BYTES else None
+    if index is None:
+        return read(file_path, background)[top:bottom, left:right].copy()
+    pixels = new_raster(right - left, bottom - top, background)
+    _decode_rows(pixels, file_path, index, left, top)
+    return pixels
+
+
+def _decode_rows(pixels, file_path, index, left, top):
+    # Decodes the sorted lines that can touch the region pixels covers,
+    # then the tail, whose lines may land anywhere
+    rows, offsets, end = index
+    if not pixels.size:
+        return
+    with open(file_path, 'rb') as f:
+        _, _, palette = _read_text_header(f)
+    buffer = _map(file_path)
+    if len(rows):
+        first = max(int(np.searchsorted(rows, top, 'right')) - 1, 0)
+        last = int(np.searchsorted(rows, top + pixels.shape[0]))
+        stop = int(offsets[last]) if last < len(rows) else end
+        _decode_lines(pixels, buffer, int(offsets[first]), stop, palette, (left, top))
+    if end < len(buffer):
+        _decode_lines(pixels, buffer, end, len(buffer), palette, (left, top))
+
+
+def _plane(buffer, width, height):
+    if len(buffer) < BINARY_HEADER.size + width * height * 3:
+        raise ValueError("Truncated TPF pixel data")
+    plane = np.frombuffer(buffer, dtype=np.uint8, count=width * height * 3,
+                          offset=BINARY_HEADER.size)
+    return plane.reshape(height, width, 3)
+
+
+def _decimal_table(count):
+    # Decimal text for 0..count-1, NUL padded to equal-width columns
+    digits = len(str(max(count - 1, 0)))
+    text = b''.join(b'%d' % i + b'\0' * (digits - len(b'%d' % i)) for i in range(count))
+    return np.frombuffer(text, dtype=np.uint8).reshape(count, digits)
+
+
+class _RowFormatter:
+    # Each pixel is laid out as a fixed-width record
+    #   "(" x "," y ") (" r "," g "," b ")\n"
+    # with NUL padding inside the numbers. The x column and the punctuation
+    # are the same for every row, so they are built once as a template; a
+    # block of rows only fills in y and the colors, then drops the NULs.
+
+    def __init__(self, width, height):
+        self.width = width
+        self.coords = _decimal_table(max(width, height))
+        digits = self.coords.shape[1]
+        self.y_at = 2 + digits
+        self.rgb_at = 5 + 2 * digits
+        self.template = np.zeros((width, self.rgb_at + 13), dtype=np.uint8)
+        self._put(0, b'(')
+        self.template[:, 1:1 + digits] = self.coords[:width]
+        self._put(1 + digits, b',')
+        self._put(self.y_at + digits, b') (')
+        self._put(self.rgb_at + 3, b',')
+        self._put(self.rgb_at + 7, b',')
+        self._put(self.rgb_at + 11, b')\n')
+
+    def _put(self, column, text):
+        self.template[:, column:column + len(text)] = np.frombuffer(text, dtype=np.uint8)
+
+    def format(self, pixels, first_row):
+        rows = pixels.shape[0]
+        digits = self.coords.shape[1]
+        records = np.empty((rows,) + self.template.shape, dtype=np.uint8)
+        records[:] = self.template
+        records[:, :, self.y_at:self.y_at + digits] = self.coords[first_row:first_row + rows, None, :]
+        for channel in range(3):
+            at = self.rgb_at + 4 * channel
+            records[:, :, at:at + 3] = _DEC_TEXT[pixels[:, :, channel]]
+        records = records.reshape(-1)
+        return records[records != 0]
+
+
+def _pack(pixels):
+    # One uint32 per pixel, so neighbours compare in a single operation
+    words = pixels[..., 0].astype(np.uint32) << 16
+    words |= pixels[..., 1].astype(np.uint32) << 8
+    words |= pixels[..., 2]
+    return words
+
+
+def _runs(pixels):
+    # Returns the packed colors and the flat index where every run starts;
+    # the first column always starts a run, so runs never cross rows
+    words = _pack(pixels)
+    change = np.empty(words.shape, dtype=bool)
+    change[:, 0] = True
+    np.not_equal(words[:, 1:], words[:, :-1], out=change[:, 1:])
+    return words.reshape(-1), np.flatnonzero(change)
+
+
+def _join(parts, count):
+    # Lay out count records side by side from literal bytes and (count, k)
+    # text columns, then drop the NUL padding
+    widths = [len(part) if isinstance(part, bytes) else part.shape[1] for part in parts]
+    records = np.zeros((count, sum(widths)), dtype=np.uint8)
+    at = 0
+    for part, part_width in zip(parts, widths):
+        if isinstance(part, bytes):
+            records[:, at:at + part_width] = np.frombuffer(part, dtype=np.uint8)
+        else:
+            records[:, at:at + part_width] = part
+        at += part_width
+    records = records.reshape(-1)
+    return records[records != 0]
+
+
+class _RunFormatter:
+    # Formats "(x,y,count) (r,g,b)" lines, or "(x,y,count) index" with a
+    # palette; runs of one pixel drop the ",count" and become pixel lines
+
+    def __init__(self, width, height, palette=None):
+        self.width = width
+        self.coords = _decimal_table(max(width, height) + 1)
+        self.palette = None
+        if palette is not None:
+            self.palette = _pack(palette[None])[0]
+            self.indices = _decimal_table(len(palette))
+
+    def format(self, pixels, first_row):
+        rows = pixels.shape[0]
+        words, starts = _runs(pixels)
+        lengths = np.diff(np.append(starts, rows * self.width))
+        y, x = np.divmod(starts, self.width)
+        colors = words[starts]
+        if self.palette is not None:
+            color_text = [self.indices[np.searchsorted(self.palette, colors)]]
+        else:
+            color_text = _rgb_text(colors)
+        return _run_lines(self.coords, x, y + first_row, lengths, color_text)
+
+
+def _rgb_text(colors):
+    # "(r,g,b)" columns for packed colors
+    return [b'(', _DEC_TEXT[colors >> 16], b',', _DEC_TEXT[(colors >> 8) & 255],
+            b',', _DEC_TEXT[colors & 255], b')']
+
+
+def _run_lines(coords, x, y, lengths, color_text):
+    # "(x,y,count) color" lines, with ",count" left out of runs of one pixel
+    count = len(x)
+    length_text = np.zeros((count, 1 + coords.shape[1]), dtype=np.uint8)
+    long_run = lengths > 1
+    length_text[long_run, 0] = ord(',')
+    length_text[long_run, 1:] = coords[lengths[long_run]]
+    parts = [b'(', coords[x], b',', coords[y], length_text, b') ']
+    return _join(parts + color_text + [b'\n'], count)
+
+
+def encode_changes(words, mask, origin=(0, 0), runs=True):
+    """Format the masked pixels of a region as lines that set them.
+
+    words is an (H, W) array of 0xRRGGBB colors, such as the uint32 view of
+    an RGB32 QImage (the top byte is ignored), and origin the position of
+    its top left pixel in the image. With runs, masked neighbours of one
+    color in a row share a run line; otherwise every pixel gets a pixel
+    line, as in the plain text format.
+    """
+    height, width = mask.shape
+    colors = words & 0xffffff
+    # A pixel continues the run of its left neighbour if both are masked
+    # and have the same color
+    joined = np.zeros(mask.shape, dtype=bool)
+    if runs and width > 1:
+        joined[:, 1:] = mask[:, 1:] & mask[:, :-1] & (colors[:, 1:] == colors[:, :-1])
+    starts = np.flatnonzero(mask & ~joined)
+    if not len(starts):
+        return np.empty(0, dtype=np.uint8)
+    ends = np.empty(mask.shape, dtype=bool)
+    ends[:, :-1] = mask[:, :-1] & ~joined[:, 1:]
+    ends[:, -1] = mask[:, -1]
+    lengths = np.flatnonzero(ends) - starts + 1
+    y, x = np.divmod(starts, width)
+    left, top = origin
+    coords = _decimal_table(max(left + width, top + height) + 1)
+    return _run_lines(coords, x + left, y + top, lengths, _rgb_text(colors.reshape(-1)[starts]))
+
+
+def append(file_path, text):
+    """Append lines, e.g. from encode_changes(), to a text TPF file.
+
+    Loaders apply lines in file order, so the new ones override what the
+    file set before. A failed write leaves the file as it was. A row index
+    saved for the file is kept, with the new lines in its tail.
+    """
+    if _layout(file_path) is not None:
+        raise ValueError("Only uncompressed text TPF files can be appended to")
+    size = os.path.getsize(file_path)
+    index = load_index(file_path) if size >= INDEX_MIN_BYTES else None
+    with open(file_path, 'r+b') as f:
+        f.seek(max(size - 1, 0))
+        # A last line without a newline would run into the first new one
+        if size and f.read(1) != b'\n':
+            text = b'\n' + bytes(text)
+        try:
+            f.write(text)
+            f.flush()
+        except BaseException:
+            f.truncate(size)
+            raise
+    if index:
+        try:
+            save_index(file_path, index[:2] + (min(index[2], size),))
+        except OSError:
+            pass
+
+
+@tracing.traced('palette')
+def find_palette(pixels, max_colors=PALETTE_MAX_COLORS):
+    """Return the image's colors as a sorted (N, 3) array, or None if N > max_colors."""
+    colors = np.empty(0, dtype=np.uint32)
+    rows = max(1, ENCODE_BLOCK_PIXELS // max(pixels.shape[1], 1))
+    for y in range(0, pixels.shape[0], rows):
+        # Only run starts are compared, which is cheap for flat images
+        words, starts = _runs(pixels[y:y + rows])
+        colors = np.union1d(colors, words[starts])
+        if len(colors) > max_colors:
+            return None
+    palette = np.empty((len(colors), 3), dtype=np.uint8)
+    palette[:, 0] = colors >> 16
+    palette[:, 1] = (colors >> 8) & 255
+    palette[:, 2] = colors & 255
+    return palette
+
+
+def format_palette(palette):
+    lines = [b'palette %d\n' % len(palette)]
+    lines += [b'(%d,%d,%d)\n' % tuple(color) for color in palette.tolist()]
+    return b''.join(lines)
+
+
+def encode_runs(pixels, first_row=0, formatter=None):
+    """Format rows of an (H, W, 3) array as run lines, split at color changes."""
+    if formatter is None:
+        formatter = _RunFormatter(pixels.shape[1], first_row + pixels.shape[0])
+    return formatter.format(pixels, first_row)
+
+
+def encode_rows(pixels, first_row=0, formatter=None):
+    """Format rows of an (H, W, 3) array as "(x,y) (r,g,b)" lines."""
+    if formatter is None:
+        formatter = _RowFormatter(pixels.shape[1], first_row + pixels.shape[0])
+    return formatter.format(pixels, first_row)
+
+
+def format_header(width, height, version="1"):
+    if version is None:
+        return f"{width}x{height}\n".encode('ascii')
+    return f"{version} {width}x{height}\n".encode('ascii')
+
+
+def encode(pixels, f, version="1", progress=None, tpf_format='text', index=None):
+    """Write an (H, W, 3) uint8 array to a binary file object as TPF text.
+
+    version=None writes the bare "WxH" header used by Paint. tpf_format is
+    one of TEXT_FORMATS. progress is called as progress(rows_done, height)
+    after every block of rows. If index is a pair of lists, the first row
+    of every block and its offset in f are appended to them, as row_index
+    would return them.
+    """
+    height, width = pixels.shape[:2]
+    f.write(format_header(width, height, version))
+    if width == 0 or height == 0:
+        return
+
+    if tpf_format == 'text':
+        formatter = _RowFormatter(width, height)
+    else:
+        palette = find_palette(pixels) if tpf_format == 'palette' else None
+        if palette is not None:
+            f.write(format_palette(palette))
+        formatter = _RunFormatter(width, height, palette)
+    # Indexed files are written in the index's smaller blocks, which costs
+    # little once a block holds INDEX_BLOCK_PIXELS
+    rows = max(1, ENCODE_BLOCK_PIXELS // width) if index is None else _index_step(width)
+    for y in range(0, height, rows):
+        if index is not None:
+            index[0].append(y)
+            index[1].append(f.tell())
+        with tracing.span('format', pixels=min(rows, height - y) * width):
+            text = formatter.format(pixels[y:y + rows], y)
+        with tracing.span('write', bytes=len(text)):
+            f.write(text)
+        if progress:
+            progress(min(y + rows, height), height)
+
+
+def _new_file_mode():
+    # Reading the umask means setting it, which is process-wide; this runs
+    # once at import, before any worker thread creates files
+    mask = os.umask(0)
+    os.umask(mask)
+    return 0o666 & ~mask
+
+
+# The mode open() gives a new file
+_NEW_FILE_MODE = _new_file_mode()
+
+
+@contextlib.contextmanager
+def atomic_path(file_path):
+    """Yield a temporary path that replaces file_path only on success.
+
+    The temporary file gets a unique name next to file_path, so parallel
+    writers never share it, and keeps the extension, so Pillow still picks
+    the format from it. A failed or cancelled write leaves nothing behind.
+    """
+    directory, name = os.path.split(file_path)
+    root, ext = os.path.splitext(name)
+    fd, temp_path = tempfile.mkstemp(dir=directory or '.', prefix=f".{root}.", suffix=ext)
+    os.close(fd)
+    try:
+        # mkstemp makes the file private; give it the mode a new file gets
+        os.chmod(temp_path, _NEW_FILE_MODE)
+        yield temp_path
+        os.replace(temp_path, file_path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temp_path)
+        raise
+
+
+@tracing.traced('tpf.write', _write_counts)
+def write(file_path, pixels, version="1", progress=None, tpf_format='text',
+          compression=COMPRESSION_NONE, level=DEFAULT_LEVEL):
+    """Write an (H, W, 3) uint8 array as a TPF text file.
+
+    With compression (COMPRESSION_ZLIB or COMPRESSION_LZMA) the text is
+    stored in row-band chunks compressed at the given level, behind a
+    version 2 header; version is then not written.
+    """
+    if compression != COMPRESSION_NONE:
+        with atomic_path(file_path) as temp_path:
+            with open(temp_path, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+                _write_compressed(f, pixels, tpf_format, compression, level, progress)
+        return
+
+    index = ([], [])
+    with atomic_path(file_path) as temp_path:
+        with open(temp_path, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+            encode(pixels, f, version, progress, tpf_format, index)
+    # The offsets come for free here, which spares large files the first scan
+    size = os.path.getsize(file_path)
+    if size >= INDEX_MIN_BYTES:
+        try:
+            save_index(file_path, index + (size,))
+        except OSError:
+            pass
+
+
+def _write_compressed(f, pixels, tpf_format, compression, level, progress):
+    from concurrent.futures import ThreadPoolExecutor
+    if level not in CODEC_LEVELS.get(compression, ()):
+        raise ValueError(f"Unsupported TPF compression level: {level}")
+    height, width = pixels.shape[:2]
+    band_rows = max(1, ENCODE_BLOCK_PIXELS // max(width, 1))
+    # Chunk 0 is the palette block; every other chunk is one formatted band
+    rows = [0] + list(range(0, height, band_rows)) + [height]
+    count = len(rows) - 1
+    f.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, compression, level,
+                               LAYOUT_TEXT, width, height))
+    f.write(CHUNK_COUNT.pack(count))
+    start = f.tell()
+    f.write(bytes(16 * (count + 1)))  # the table is filled in at the end
+
+    if tpf_format == 'text':
+        formatter = _RowFormatter(width, height)
+        palette_text = b''
+    else:
+        palette = find_palette(pixels) if tpf_format == 'palette' else None
+        palette_text = b'' if palette is None else format_palette(palette)
+        formatter = _RunFormatter(width, height, palette)
+
+    offsets = [f.tell()]
+
+    def store(future, done):
+        offsets.append(offsets[-1] + f.write(future.result()))
+        if progress:
+            progress(done, height)
+
+    # zlib and lzma release the GIL, so bands compress while the next one
+    # is formatted; only a few are held in flight
+    workers = os.cpu_count() or 1
+    with ThreadPoolExecutor(workers) as executor:
+        pending = [(executor.submit(_compress, palette_text, compression, level), 0)]
+        for y in rows[1:-1]:
+            text = formatter.format(pixels[y:y + band_rows], y)
+            pending.append((executor.submit(_compress, text, compression, level),
+                            min(y + band_rows, height)))
+            while len(pending) > 2 * workers:
+                store(*pending.pop(0))
+        for future, done in pending:
+            store(future, done)
+    if progress:
+        progress(height, height)
+
+    f.seek(start)
+    f.write(np.array(offsets + rows, dtype='<u8').tobytes())
+    f.seek(0, os.SEEK_END)
+
+
+@tracing.traced('tpf.write_binary', _write_counts)
+def write_binary(file_path, pixels, compression=COMPRESSION_NONE, level=6, progress=None):
+    """Write an (H, W, 3) uint8 array as a binary (version 2) TPF file."""
+    with atomic_path(file_path) as temp_path:
+        with open(temp_path, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+            _write_binary(f, pixels, compression, level, progress)
+
+
+def _write_binary(f, pixels, compression, level, progress):
+    height, width = pixels.shape[:2]
+    f.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, compression,
+                               level if compression else 0, LAYOUT_RGB, width, height))
+    if compression == COMPRESSION_NONE:
+        rows = max(1, ENCODE_BLOCK_PIXELS // max(width, 1))
+        for y in range(0, height, rows):
+            f.write(np.ascontiguousarray(pixels[y:y + rows], dtype=np.uint8))
+            if progress:
+                progress(min(y + rows, height), height)
+        return
+
+    # Reserve the row offset table and fill it in once the rows are out
+    offsets = np.empty(height + 1, dtype='<u8')
+    offsets[0] = BINARY_HEADER.size + offsets.nbytes
+    f.write(offsets)
+    for y, row in enumerate(pixels):
+        data = zlib.compress(np.ascontiguousarray(row, dtype=np.uint8), level)
+        f.write(data)
+        offsets[y + 1] = offsets[y] + len(data)
+        if progress:
+            progress(y + 1, height)
+    f.seek(BINARY_HEADER.size)
+    f.write(offsets)
+
+
+@tracing.traced('from_pil')
+def from_pil(image):
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return np.asarray(image)
+
+
+def qimage_view(image, writable=False):
+    """(H, W, 4) uint8 view of a 32-bit QImage's buffer, without the row padding.
+
+    The view does not keep the image alive; hold on to the QImage for as
+    long as the view is used. A writable view detaches a shared image
+    first, so other copies of it keep their pixels.
+    """
+    # constBits() does not detach, so reading never copies a shared image
+    bits = image.bits() if writable else image.constBits()
+    bits.setsize(image.sizeInBytes())
+    rows = np.frombuffer(bits, dtype=np.uint8).reshape(image.height(), image.bytesPerLine())
+    return rows[:, :4 * image.width()].reshape(image.height(), image.width(), 4)
+
+
+@tracing.traced('from_qimage')
+def from_qimage(image, writable=False):
+    """Return an (H, W, 3) RGB view of a QImage's pixel buffer.
+
+    RGB32/ARGB32 (0xAARRGGBB words) and RGBX8888/RGBA8888 (R, G, B, A
+    bytes) images are viewed in place; other formats are converted first,
+    and the view is then a copy.
+    """
+    from PyQt6.QtGui import QImage
+    Format = QImage.Format
+    if image.format() in (Format.Format_RGBX8888, Format.Format_RGBA8888):
+        return qimage_view(image, writable)[..., :3]
+    converted = image.format() not in (Format.Format_RGB32, Format.Format_ARGB32)
+    if converted:
+        image = image.convertToFormat(Format.Format_RGB32)
+    argb = qimage_view(image, writable)
+    # 0xAARRGGBB words are stored B, G, R, A on little-endian machines
+    rgb = argb[..., 2::-1] if sys.byteorder == 'little' else argb[..., 1:]
+    # A converted image dies with this call, so the view must not outlive it
+    return rgb.copy() if converted else rgb
+
+
+@tracing.traced('to_pil')
+def to_pil(pixels):
+    from PIL import Image
+    return Image.fromarray(np.ascontiguousarray(pixels, dtype=np.uint8), 'RGB')
+
+
+@tracing.traced('to_qimage')
+def to_qimage(pixels, image_format=None):
+    """Build a QImage of an (H, W, 3) uint8 array.
+
+    Without image_format the QImage is RGB888 and shares the array's
+    buffer when it is contiguous; PyQt keeps the array alive for it.
+    Otherwise the pixels are converted once into a QImage of their own.
+    """
+    from PyQt6.QtGui import QImage
+    pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+    height, width = pixels.shape[:2]
+    image = QImage(pixels.data, width, height, 3 * width, QImage.Format.Format_RGB888)
+    if image_format is None or image_format == QImage.Format.Format_RGB888:
+        return image
+    return image.convertToFormat(image_format)
+
+
+@tracing.traced('qimage_to_pil')
+def qimage_to_pil(image):
+    """Build an RGB PIL image from a QImage in one pass over its buffer."""
+    from PIL import Image
+    from PyQt6.QtGui import QImage
+    Format = QImage.Format
+    if image.format() in (Format.Format_RGBX8888, Format.Format_RGBA8888):
+        raw_mode = 'RGBX'
+    else:
+        if image.format() not in (Format.Format_RGB32, Format.Format_ARGB32):
+            image = image.convertToFormat(Format.Format_RGB32)
+        raw_mode = 'BGRX' if sys.byteorder == 'little' else 'XRGB'
+    bits = image.constBits()
+    bits.setsize(image.sizeInBytes())
+    # The raw decoder unpacks straight from Qt's rows, padding included.
+    # frombuffer would map an RGBX buffer instead, as an image whose core
+    # mode disagrees with 'RGB'
+    return Image.frombytes('RGB', (image.width(), image.height()), bits,
+                           'raw', raw_mode, image.bytesPerLine(), 1)
+
+
+@tracing.traced('pil_to_qimage')
+def pil_to_qimage(image):
+    """Build an RGB32 QImage from a PIL image with a single copy of the pixels."""
+    from PyQt6.QtGui import QImage
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    raw_mode = 'BGRX' if sys.byteorder == 'little' else 'XRGB'
+    # The QImage keeps the packed bytes alive instead of copying them again
+    return QImage(image.tobytes('raw', raw_mode), image.width, image.height,
+                  4 * image.width, QImage.Format.Format_RGB32)
@@ -0,0 +1,224 @@
+"""Opt-in timing of the tools' hot paths, saved as a Chrome trace.
+
+Set TPF_PROFILE=trace.json or pass --profile [trace.json] to any of the
+tools. Every span then records its wall time, the bytes and pixels it
+reports and the process's memory, and the trace is written on exit; open
+it in chrome://tracing or https://ui.perfetto.dev. While tracing is off,
+span() hands out one shared no-op object and costs a function call.
+"""
+import atexit
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+DEFAULT_PATH = 'tpf-trace.json'
+
+_events = None
+_path = None
+_local = threading.local()
+_last = {}
+
+
+def enabled():
+    return _events is not None
+
+
+def enable(path=DEFAULT_PATH):
+    """Start recording; the trace is written to path when the process exits."""
+    global _events, _path
+    if _events is None:
+        _events = []
+        if path:
+            atexit.register(save)
+    _path = path
+
+
+def from_argv(argv):
+    """Turn tracing on for --profile [PATH] or TPF_PROFILE and return argv without the flag."""
+    argv = list(argv)
+    env = os.environ.get('TPF_PROFILE')
+    if env:
+        enable(DEFAULT_PATH if env == '1' else env)
+    for i, arg in enumerate(argv):
+        if arg == '--profile':
+            path = DEFAULT_PATH
+            if i + 1 < len(argv) and argv[i + 1].endswith('.json'):
+                path = argv.pop(i + 1)
+            argv.pop(i)
+            enable(path)
+            break
+        if arg.startswith('--profile='):
+            argv.pop(i)
+            enable(arg.split('=', 1)[1] or DEFAULT_PATH)
+            break
+    return argv
+
+
+def _memory():
+    # Current and peak resident size in MB, where the platform tells
+    rss = peak = None
+    try:
+        with open('/proc/self/statm') as f:
+            rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1e6
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        peak /= 1e6 if sys.platform == 'darwin' else 1e3
+    except ImportError:
+        pass
+    return rss, peak
+
+
+class _Span:
+    __slots__ = ('name', 'counts', 'start', 'children')
+
+    def __init__(self, name, counts):
+        self.name = name
+        self.counts = counts
+        self.children = []
+
+    def add(self, **counts):
+        for key, value in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + value
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        stack.append(self)
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        stack = _local.stack
+        stack.pop()
+        rss, peak = _memory()
+        args = dict(self.counts, rss_mb=rss, peak_mb=peak)
+        event = {
+            'name': self.name, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+            'ts': self.start / 1e3, 'dur': (end - self.start) / 1e3, 'args': args,
+        }
+        _events.append(event)
+        if stack:
+            stack[-1].children.append(event)
+        else:
+            _last[self.name] = (event, self.children)
+        return False
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def add(self, **counts):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name, **counts):
+    """Context manager timing a stage; counts such as bytes= and pixels= go into the trace."""
+    if _events is None:
+        return _NO_SPAN
+    return _Span(name, counts)
+
+
+def traced(name, counts=None):
+    """Decorator that runs the function inside span(name).
+
+    counts, if given, is called as counts(result, *args, **kwargs) while
+    tracing is on and returns the bytes=/pixels= counts of the call.
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _events is None:
+                return func(*args, **kwargs)
+            with _Span(name, {}) as span:
+                result = func(*args, **kwargs)
+                if counts:
+                    span.add(**counts(result, *args, **kwargs))
+                return result
+        return wrapper
+    return decorate
+
+
+def call(func, *args, **kwargs):
+    """Run func with tracing on, e.g. in a worker process; returns (result, events) for merge()."""
+    global _events
+    _events = []
+    with _Span(getattr(func, '__name__', 'call'), {}):
+        result = func(*args, **kwargs)
+    events, _events = _events, None
+    return result, events
+
+
+def merge(result):
+    """Add the events of a call() result to this process's trace and return its result."""
+    result, events = result
+    if _events is not None:
+        _events.extend(events)
+        stack = getattr(_local, 'stack', None)
+        if stack and events:
+            # The call's own span ends last; it is a stage of the caller's span
+            stack[-1].children.append(events[-1])
+    return result
+
+
+def _format(seconds):
+    return f"{seconds * 1000:.0f} ms" if seconds < 1 else f"{seconds:.2f} s"
+
+
+def summary(name):
+    """One line about the last finished top-level span called name, or ''."""
+    if name not in _last:
+        return ""
+    event, children = _last[name]
+    parts = [f"{name} {_format(event['dur'] / 1e6)}"]
+    stages = {}
+    for child in children:
+        stages[child['name']] = stages.get(child['name'], 0) + child['dur']
+    if stages:
+        parts.append("(" + ", ".join(f"{stage} {_format(dur / 1e6)}" for stage, dur in stages.items()) + ")")
+    # Stages count the same data, e.g. bytes read and bytes parsed, so a
+    # span without its own counts takes those of its biggest stage
+    counts = dict(event['args'])
+    totals = {}
+    for child in children:
+        for key in ('bytes', 'pixels'):
+            if key in child['args']:
+                total = totals.setdefault((key, child['name']), 0)
+                totals[key, child['name']] = total + child['args'][key]
+    for (key, _), total in totals.items():
+        if key not in event['args']:
+            counts[key] = max(counts.get(key, 0), total)
+    if counts.get('bytes'):
+        size = counts['bytes']
+        parts.append(f"{size / 1e6:.1f} MB" if size >= 100e3 else f"{size / 1e3:.1f} KB")
+    if counts.get('pixels'):
+        parts.append(f"{counts['pixels'] / 1e6:.1f} Mpx")
+    if counts.get('peak_mb'):
+        parts.append(f"peak {counts['peak_mb']:.0f} MB")
+    return " ".join(parts)
+
+
+def save(path=None):
+    """Write the events recorded so far as Chrome trace-event JSON."""
+    path = path or _path
+    if _events is None or not path:
+        return
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': _events, 'displayTimeUnit': 'ms'}, f)
@@ -0,0 +1,356 @@
+import os
+
+import numpy as np
+
+import tpf
+import tracing
+
+# Problems that change what a file decodes to, or stop it from decoding
+ERRORS = ('header', 'palette', 'corrupt', 'malformed', 'out of bounds', 'empty run',
+          'run overflow', 'channel over 255', 'palette index')
+# Legal TPF the writers never produce: later lines override earlier ones,
+# pixels no line sets keep the background, and "1 WxH" is the usual header
+WARNINGS = ('bare header', 'duplicate', 'missing')
+FATAL = ('header', 'palette', 'corrupt')
+
+# Places kept per kind of problem
+MAX_EXAMPLES = 5
+
+
+class Report:
+    """What check() found in one file.
+
+    problems maps every kind in ERRORS and WARNINGS that was found to
+    [count, places], where places are up to MAX_EXAMPLES "line N" or
+    similar strings; line numbers count from the header as line 1.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.dialect = None
+        self.size = None
+        self.lines = 0
+        self.problems = {}
+        self.repaired = None
+        self.pixels = None
+
+    def add(self, kind, count, places=()):
+        if not count:
+            return
+        entry = self.problems.setdefault(kind, [0, []])
+        entry[0] += count
+        entry[1].extend(list(places)[:MAX_EXAMPLES - len(entry[1])])
+
+    def add_lines(self, kind, mask, first_line):
+        """Add the lines where mask is True; mask[0] is line first_line."""
+        lines = np.flatnonzero(mask)
+        self.add(kind, len(lines), (f"line {n}" for n in lines[:MAX_EXAMPLES] + first_line))
+
+    def errors(self):
+        return sum(self.problems[kind][0] for kind in ERRORS if kind in self.problems)
+
+    def warnings(self):
+        return sum(self.problems[kind][0] for kind in WARNINGS if kind in self.problems)
+
+    def fatal(self):
+        """True if the tools cannot open the file at all."""
+        return any(kind in self.problems for kind in FATAL)
+
+    def format(self):
+        head = f"{self.path}: {self.dialect or 'unknown format'}"
+        if self.size:
+            head += f", {self.size[0]}x{self.size[1]}"
+        if self.lines:
+            head += f", {self.lines} lines"
+        lines = [head if self.problems else head + ", ok"]
+        for kind in ERRORS + WARNINGS:
+            if kind not in self.problems:
+                continue
+            count, places = self.problems[kind]
+            more = ", ..." if count > len(places) else ""
+            label = "error" if kind in ERRORS else "warning"
+            lines.append(f"  {label}: {kind}: {count}" + (f" ({', '.join(places)}{more})" if places else ""))
+        if self.repaired:
+            lines.append(f"  repaired: {self.repaired}")
+        return "\n".join(lines)
+
+
+class _Lines:
+    # Checks the pixel lines of one file as they come, keeping a bitmap
+    # of the pixels set so far for duplicates and missing pixels. With
+    # pixels, the lines without errors are also applied to that raster
+
+    def __init__(self, report, width, height, palette, first_line, pixels=None):
+        self.report = report
+        self.width = width
+        self.height = height
+        self.palette = palette
+        self.line = first_line
+        self.covered = np.zeros(width * height, dtype=bool)
+        self.pixels = pixels
+
+    def check(self, body):
+        """Check complete lines; a last line without a newline ends the file."""
+        if not body:
+            return
+        count = body.count(b'\n') + (0 if body.endswith(b'\n') else 1)
+        first_line, self.line = self.line, self.line + count
+        self.report.lines += count
+        try:
+            values, fields = tpf._tokenize(body)
+        except ValueError:
+            values, fields = None, None
+        if values is None or not len(values):
+            # Lines without numbers are only fine if they are blank
+            _, lengths = tpf._line_shapes(body, np.zeros(count, dtype=np.int64), None)
+            self.report.add_lines('malformed', lengths > 0, first_line)
+            return
+        # The decoder skips the same lines, see tpf._line_shapes
+        expected, lengths = tpf._line_shapes(body, fields, self.palette)
+        self.report.add_lines('malformed', (expected == 0) & (lengths > 0), first_line)
+
+        good = np.flatnonzero(expected)
+        if len(good):
+            self._check_pixels(good, values, (np.cumsum(fields) - fields)[good],
+                               expected[good], first_line)
+
+    def _check_pixels(self, good, values, first, fields, first_line):
+        report, width, height = self.report, self.width, self.height
+        lines = good + first_line
+        if len(good) * tpf.PIXEL_FIELDS == len(values) and np.all(fields == tpf.PIXEL_FIELDS):
+            # Nothing but pixel lines, as in the plain text format
+            rows = values.reshape(-1, tpf.PIXEL_FIELDS)
+            x, y, rgb = rows[:, 0], rows[:, 1], rows[:, 2:]
+            length = np.ones(len(rows), dtype=np.int64)
+            is_index = np.zeros(len(rows), dtype=bool)
+            bad_color = (rgb.view(np.uint64) > 255).any(axis=1)
+        else:
+            x = values[first]
+            y = values[first + 1]
+            is_run = (fields == tpf.RUN_FIELDS) | (fields == tpf.PALETTE_RUN_FIELDS)
+            length = np.where(is_run, values[first + 2], 1)
+            is_index = fields <= tpf.PALETTE_RUN_FIELDS
+            bad_color = np.zeros(len(good), dtype=bool)
+            rgb = values[(first + fields - 3)[~is_index, None] + np.arange(3)]
+            bad_color[~is_index] = (rgb.view(np.uint64) > 255).any(axis=1)
+        report.add('channel over 255', int(bad_color.sum()),
+                   (f"line {n}" for n in lines[bad_color][:MAX_EXAMPLES]))
+        if is_index.any():
+            index = values[(first + fields - 1)[is_index]]
+            bad_index = np.zeros(len(good), dtype=bool)
+            bad_index[is_index] = index.view(np.uint64) >= len(self.palette)
+            report.add('palette index', int(bad_index.sum()),
+                       (f"line {n}" for n in lines[bad_index][:MAX_EXAMPLES]))
+            bad_color |= bad_index
+
+        # Like the decoder: a run reaching past either end of its row is
+        # clipped to it, only lines that miss the row entirely are outside
+        outside = (x >= width) | (x + np.maximum(length, 1) <= 0) | (y.view(np.uint64) >= height)
+        empty = ~outside & (length < 1)
+        overflow = ~outside & ~empty & ((x < 0) | (x + length > width))
+        for kind, mask in (('out of bounds', outside), ('empty run', empty), ('run overflow', overflow)):
+            report.add(kind, int(mask.sum()), (f"line {n}" for n in lines[mask][:MAX_EXAMPLES]))
+        if self.pixels is not None:
+            # Lines with errors are dropped; _apply clips overflowing runs
+            colors = np.zeros((len(good), 3), dtype=np.int64)
+            colors[~is_index] = rgb
+            if is_index.any():
+                # Indexes outside the palette are dropped with bad_color
+                known = ~bad_index[is_index]
+                colors[np.flatnonzero(is_index)[known]] = self.palette[index[known]]
+            kept = ~(outside | empty | bad_color)
+            tpf._apply(self.pixels, x[kept], y[kept], length[kept], colors[kept])
+
+        # What the decoder writes, which clips runs to their row
+        start = np.maximum(x, 0)
+        end = np.minimum(x + length, width)
+        drawn = (y.view(np.uint64) < height) & (start < end) & ~bad_color
+        if not drawn.any():
+            return
+        lines = lines[drawn]
+        row = y[drawn] * width
+        start, end = row + start[drawn], row + end[drawn]
+        self._check_overlap(lines, start, end)
+
+    def _check_overlap(self, lines, start, end):
+        covered = self.covered
+        if np.all(end - start == 1):
+            # Single pixels, as in the plain text format
+            order = np.argsort(start, kind='stable')
+            repeated = np.zeros(len(start), dtype=bool)
+            repeated[order[1:]] = start[order[1:]] == start[order[:-1]]
+            duplicate = covered[start] | repeated
+            covered[start] = True
+        else:
+            lo, hi = int(start.min()), int(end.max())
+            # Pixels set by earlier batches, counted over every run at once
+            before = np.concatenate(([0], np.cumsum(covered[lo:hi], dtype=np.int64)))
+            duplicate = before[end - lo] > before[start - lo]
+            # How many runs of this batch set each pixel
+            edges = (np.bincount(start - lo, minlength=hi - lo + 1)
+                     - np.bincount(end - lo, minlength=hi - lo + 1))
+            count = np.cumsum(edges[:-1])
+            covered[lo:hi] |= count > 0
+            shared = np.concatenate(([0], np.cumsum(count > 1, dtype=np.int64)))
+            overlapping = np.flatnonzero(shared[end - lo] > shared[start - lo])
+            if len(overlapping):
+                # Only the runs sharing pixels are spread out, to find out
+                # which of them came first in the file
+                n = end[overlapping] - start[overlapping]
+                pixels = np.repeat(start[overlapping] - (np.cumsum(n) - n), n) + np.arange(int(n.sum()))
+                owner = np.repeat(overlapping, n)[np.argsort(pixels, kind='stable')]
+                pixels.sort()
+                duplicate[owner[1:][pixels[1:] == pixels[:-1]]] = True
+        self.report.add('duplicate', int(duplicate.sum()),
+                        (f"line {n}" for n in lines[duplicate][:MAX_EXAMPLES]))
+
+    def finish(self):
+        missing = self.covered.size - int(np.count_nonzero(self.covered))
+        places = []
+        # Only the first few are located, a block of pixels at a time
+        for block in range(0, self.covered.size, tpf.EXPAND_BLOCK_PIXELS):
+            if len(places) >= min(missing, MAX_EXAMPLES):
+                break
+            found = np.flatnonzero(~self.covered[block:block + tpf.EXPAND_BLOCK_PIXELS])
+            places.extend(f"({(block + i) % self.width},{(block + i) // self.width})"
+                          for i in found[:MAX_EXAMPLES - len(places)].tolist())
+        self.report.add('missing', missing, places)
+
+
+def _check_text(report, file_path, chunk_size, decode):
+    with open(file_path, 'rb') as f:
+        header = f.readline()
+        try:
+            version, width, height = tpf.parse_header(header)
+        except ValueError as e:
+            report.dialect = "text"
+            report.add('header', 1, [f"line 1: {e}"])
+            return
+        report.size = (width, height)
+        if version is None:
+            report.dialect = "text, bare WxH header"
+            report.add('bare header', 1, ["line 1"])
+        else:
+            report.dialect = "text"
+        body_start = f.tell()
+        line = f.readline()
+        palette = None
+        first_line = 2
+        if line.startswith(b'palette'):
+            try:
+                count = tpf._palette_count(line)
+                palette = tpf._parse_palette(b''.join(f.readline() for _ in range(count)), count)
+            except ValueError as e:
+                report.add('palette', 1, [f"line 2: {e}"])
+                return
+            report.dialect += f", {count} color palette"
+            first_line += 1 + count
+        else:
+            f.seek(body_start)
+        report.lines = first_line - 1
+        report.pixels = tpf.new_raster(width, height) if decode else None
+        lines = _Lines(report, width, height, palette, first_line, report.pixels)
+
+        tail = b''
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            cut = chunk.rfind(b'\n')
+            if cut < 0:
+                tail += chunk
+                continue
+            lines.check(tail + chunk[:cut + 1])
+            tail = chunk[cut + 1:]
+        lines.check(tail)
+    lines.finish()
+
+
+def _check_compressed(report, buffer, decode):
+    report.dialect = "compressed text"
+    try:
+        compression, width, height = tpf._read_binary_header(buffer, tpf.LAYOUT_TEXT)
+        report.size = (width, height)
+        offsets, _ = tpf._chunk_table(buffer, height)
+    except ValueError as e:
+        report.add('header', 1, [str(e)])
+        return
+    codec = {code: name for name, code in tpf.CODECS.items()}[compression]
+    report.dialect = f"compressed text, {codec} level {buffer[7]}"
+    try:
+        palette, rest = tpf._split_palette(tpf._chunk(buffer, offsets, 0, compression))
+    except ValueError as e:
+        report.add('palette', 1, [f"chunk 0: {e}"])
+        return
+    if palette is not None:
+        report.dialect += f", {len(palette)} color palette"
+    # Line numbers are those of the same file written without compression
+    first_line = 2 + (len(palette) + 1 if palette is not None else 0)
+    report.lines = first_line - 1
+    report.pixels = tpf.new_raster(width, height) if decode else None
+    lines = _Lines(report, width, height, palette, first_line, report.pixels)
+    lines.check(rest)
+    for i in range(1, len(offsets) - 1):
+        try:
+            text = tpf._chunk(buffer, offsets, i, compression)
+        except ValueError:
+            report.add('corrupt', 1, [f"chunk {i}"])
+            continue
+        lines.check(text)
+    lines.finish()
+
+
+def _check_binary(report, buffer):
+    report.dialect = "binary"
+    try:
+        compression, width, height = tpf._read_binary_header(buffer)
+    except ValueError as e:
+        report.add('header', 1, [str(e)])
+        return
+    report.size = (width, height)
+    if compression == tpf.COMPRESSION_NONE:
+        try:
+            tpf._plane(buffer, width, height)
+        except ValueError as e:
+            report.add('corrupt', 1, [str(e)])
+        return
+
+    report.dialect = "binary, zlib rows"
+    end = tpf.BINARY_HEADER.size + 8 * (height + 1)
+    offsets = (tpf._row_offsets(buffer, height).astype(np.int64)
+               if len(buffer) >= end else np.zeros(0, dtype=np.int64))
+    if (len(offsets) != height + 1 or offsets[0] < end or offsets[-1] > len(buffer)
+            or np.any(np.diff(offsets) < 0)):
+        report.add('corrupt', 1, ["row offset table"])
+        return
+    for y in range(height):
+        try:
+            tpf._inflate_row(buffer, offsets, y, width)
+        except Exception:
+            report.add('corrupt', 1, [f"row {y}"])
+
+
+def _check_counts(report, file_path, *args, **kwargs):
+    return {'bytes': os.path.getsize(file_path)}
+
+
+@tracing.traced('check', _check_counts)
+def check(file_path, chunk_size=tpf.READ_CHUNK_SIZE, decode=False):
+    """Check a TPF file of any dialect and return a Report.
+
+    Text is checked a chunk at a time with array operations, so memory
+    stays at about one chunk of text plus a bit per pixel. With decode,
+    report.pixels is the text file's image without the lines that have
+    errors, the way --repair writes it; it stays None for binary files.
+    """
+    report = Report(file_path)
+    layout = tpf._layout(file_path)
+    if layout is None:
+        _check_text(report, file_path, chunk_size, decode)
+        return report
+    buffer = tpf._map(file_path)
+    if layout == tpf.LAYOUT_TEXT:
+        _check_compressed(report, buffer, decode)
+    else:
+        _check_binary(report, buffer)
+    return report
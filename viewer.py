@@ -1,10 +1,220 @@
 import sys
 import os
+import bisect
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QLabel, QFileDialog, 
-                            QScrollArea, QWidget, QMenuBar, QToolBar)
-from PyQt6.QtGui import QPixmap, QImage, QAction, QIcon
-from PyQt6.QtCore import Qt
-from PIL import Image, ImageDraw, ImageFont
+                            QScrollArea, QWidget, QMenuBar, QToolBar, QDockWidget,
+                            QListWidget, QListWidgetItem, QListView, QInputDialog)
+from PyQt6.QtGui import QPixmap, QImage, QAction, QIcon, QPainter, QKeySequence
+from PyQt6.QtCore import Qt, QRectF, QThreadPool, QSize, QTimer
+from collections import OrderedDict, deque
+import tpf
+import pyramid
+import thumbnails
+import tracing
+from workers import Task, TaskProgress
+
+# Cached pyramid levels up to this size are shown while a file is decoding
+PREVIEW_MAX_SIZE = 2048
+
+# Zoomed tiles are rendered at this size in screen pixels
+TILE_SIZE = 256
+TILE_CACHE_BYTES = 256 * 1024 * 1024
+
+# Decoded files kept for next/previous, and the files decoded ahead of the
+# current one in the direction of travel and behind it
+IMAGE_CACHE_BYTES = 512 * 1024 * 1024
+PREFETCH_AHEAD = 2
+PREFETCH_BEHIND = 1
+PREFETCH_WORKERS = 2
+
+class TileCache:
+    """LRU of rendered tile pixmaps keyed by (tile x, tile y, zoom)."""
+
+    def __init__(self, max_bytes=TILE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.tiles = OrderedDict()
+        self.size = 0
+
+    def get(self, key):
+        tile = self.tiles.get(key)
+        if tile is not None:
+            self.tiles.move_to_end(key)
+        return tile
+
+    def put(self, key, tile):
+        self.tiles[key] = tile
+        self.size += tile.width() * tile.height() * 4
+        while self.size > self.max_bytes and len(self.tiles) > 1:
+            _, old = self.tiles.popitem(last=False)
+            self.size -= old.width() * old.height() * 4
+
+    def discard(self, predicate):
+        for key in [key for key in self.tiles if predicate(key)]:
+            old = self.tiles.pop(key)
+            self.size -= old.width() * old.height() * 4
+
+    def clear(self):
+        self.tiles.clear()
+        self.size = 0
+
+def file_stamp(file_path):
+    """(size, mtime) of a file, or None; a cached decode is only valid while it matches."""
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+class ImageCache:
+    """LRU of decoded images keyed by file path, for flipping between files.
+
+    An image is kept with the stamp its file had when decoding started and
+    is dropped once the file changes. hits and misses count get() calls.
+    """
+
+    def __init__(self, max_bytes=IMAGE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.images = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def contains(self, file_path):
+        entry = self.images.get(file_path)
+        return entry is not None and entry[0] == file_stamp(file_path)
+
+    def get(self, file_path):
+        if self.contains(file_path):
+            self.images.move_to_end(file_path)
+            self.hits += 1
+            return self.images[file_path][1]
+        self.misses += 1
+        return None
+
+    def put(self, file_path, stamp, image):
+        self.discard(file_path)
+        if stamp is None or image.sizeInBytes() > self.max_bytes:
+            return
+        self.images[file_path] = (stamp, image)
+        self.size += image.sizeInBytes()
+        self.trim()
+
+    def discard(self, file_path):
+        entry = self.images.pop(file_path, None)
+        if entry is not None:
+            self.size -= entry[1].sizeInBytes()
+
+    def set_max_bytes(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.trim()
+
+    def trim(self):
+        while self.size > self.max_bytes and self.images:
+            _, (_, old) = self.images.popitem(last=False)
+            self.size -= old.sizeInBytes()
+
+class ImageView(QWidget):
+    """Draws a zoomed image by rendering only the tiles Qt asks to repaint.
+
+    The widget is as large as the zoomed image, so the scroll area only
+    exposes the visible part and paintEvent never touches the rest. Tiles
+    come from the pyramid level closest to the zoom; level 0 is the full
+    image and may be missing while only a cached preview is available.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.levels = []
+        self.full_size = (0, 0)
+        self.zoom = 1.0
+        self.cache = TileCache()
+
+    def set_image(self, image):
+        if image is None:
+            self.set_levels([], (0, 0))
+        else:
+            self.set_levels([image], (image.width(), image.height()))
+
+    def set_levels(self, levels, full_size):
+        self.levels = levels
+        self.full_size = full_size
+        self.cache.clear()
+        self.update_size()
+        self.update()
+
+    def set_zoom(self, zoom):
+        if zoom != self.zoom:
+            self.zoom = zoom
+            self.update_size()
+            self.update()
+
+    def update_size(self):
+        width, height = self.full_size
+        if not self.levels:
+            self.setFixedSize(0, 0)
+        else:
+            self.setFixedSize(max(1, int(width * self.zoom)), max(1, int(height * self.zoom)))
+
+    def update_rows(self, top, bottom):
+        """Redraw rows [top, bottom) of the full-resolution level after they changed."""
+        def stale(key):
+            _, ty, zoom, level = key
+            # One row of slack covers nearest-pixel rounding at the edges
+            return level == 0 and ty * TILE_SIZE <= bottom * zoom + 1 and (ty + 1) * TILE_SIZE >= top * zoom - 1
+        self.cache.discard(stale)
+        y = max(0, int(top * self.zoom) - 1)
+        self.update(0, y, self.width(), int(bottom * self.zoom) + 2 - y)
+
+    def current_level(self):
+        # Prefer the wanted level, then finer ones, then coarser ones
+        wanted = pyramid.level_for_zoom(self.zoom, len(self.levels))
+        order = list(range(wanted, -1, -1)) + list(range(wanted + 1, len(self.levels)))
+        for level in order:
+            if self.levels[level] is not None:
+                return level
+        return None
+
+    def paintEvent(self, event):
+        level = self.current_level()
+        if level is None:
+            return
+        with tracing.span('view paint') as span:
+            painter = QPainter(self)
+            rect = event.rect().intersected(self.rect())
+            for ty in range(rect.top() // TILE_SIZE, rect.bottom() // TILE_SIZE + 1):
+                for tx in range(rect.left() // TILE_SIZE, rect.right() // TILE_SIZE + 1):
+                    painter.drawPixmap(tx * TILE_SIZE, ty * TILE_SIZE, self.tile(tx, ty, level))
+            painter.end()
+            span.add(pixels=rect.width() * rect.height())
+
+    def tile(self, tx, ty, level):
+        key = (tx, ty, self.zoom, level)
+        pixmap = self.cache.get(key)
+        if pixmap is None:
+            pixmap = self.render_tile(tx, ty, level)
+            self.cache.put(key, pixmap)
+        return pixmap
+
+    @tracing.traced('render tile')
+    def render_tile(self, tx, ty, level):
+        source = self.levels[level]
+        left, top = tx * TILE_SIZE, ty * TILE_SIZE
+        width = min(TILE_SIZE, self.width() - left)
+        height = min(TILE_SIZE, self.height() - top)
+        tile = QImage(width, height, QImage.Format.Format_RGB32)
+        tile.fill(Qt.GlobalColor.white)
+
+        # The painter transform does the zoom; without smooth transform
+        # Qt samples the nearest source pixel, which keeps pixels sharp
+        scale_x = self.zoom * self.full_size[0] / source.width()
+        scale_y = self.zoom * self.full_size[1] / source.height()
+        painter = QPainter(tile)
+        painter.scale(scale_x, scale_y)
+        painter.translate(-left / scale_x, -top / scale_y)
+        source_rect = QRectF(left / scale_x, top / scale_y, width / scale_x, height / scale_y)
+        painter.drawImage(source_rect, source, source_rect)
+        painter.end()
+        return QPixmap.fromImage(tile)
 
 class TPFViewer(QMainWindow):
     def __init__(self):
@@ -13,12 +223,67 @@ class TPFViewer(QMainWindow):
         
         # Kép megjelenítő rész
         self.scroll_area = QScrollArea()
-        self.image_label = QLabel()
-        self.scroll_area.setWidget(self.image_label)
+        self.view = ImageView()
+        self.scroll_area.setWidget(self.view)
         self.setCentralWidget(self.scroll_area)
         
         self.image = None
+        self.shown_image = None
+        self.image_path = None
+        # The file asked for last and the one whose decode is running
+        self.wanted_path = None
+        self.loading_path = None
+        self.pyramid_task = None
+        self.pyramid_image = None
+        self.previewing = False
         self.zoom_level = 1.0
+        # Rows of a loading file, queued by the decoder and shown per frame
+        self.loading_bands = None
+        self.loading_pixels = None
+        self.band_timer = QTimer(self)
+        self.band_timer.timeout.connect(self.show_loaded_bands)
+        
+        # Next/previous keep decoded files and decode the neighbors ahead
+        self.image_cache = ImageCache()
+        self.step = 1
+        self.prefetch_tasks = {}
+        self.prefetch_pool = QThreadPool(self)
+        self.prefetch_pool.setMaxThreadCount(PREFETCH_WORKERS)
+
+        # Gallery panel, filled in once a folder is opened
+        self.current_directory = None
+        self.gallery_items = {}
+        self.thumbnail_tasks = {}
+        # Files whose thumbnail failed, with their stamp then; they are only
+        # tried again once the file changes
+        self.thumbnail_failures = {}
+        # A pool of its own keeps thumbnails from holding up loads and saves
+        self.thumbnail_pool = QThreadPool(self)
+        self.gallery_list = QListWidget()
+        self.gallery_list.setViewMode(QListView.ViewMode.IconMode)
+        self.gallery_list.setIconSize(QSize(thumbnails.THUMBNAIL_SIZE, thumbnails.THUMBNAIL_SIZE))
+        self.gallery_list.setUniformItemSizes(True)
+        self.gallery_list.setMovement(QListView.Movement.Static)
+        self.gallery_list.setResizeMode(QListView.ResizeMode.Adjust)
+        self.gallery_list.itemClicked.connect(self.on_gallery_item_clicked)
+        # Thumbnails are only requested for items scrolled into view
+        self.thumbnail_timer = QTimer(self)
+        self.thumbnail_timer.setSingleShot(True)
+        self.thumbnail_timer.setInterval(50)
+        self.thumbnail_timer.timeout.connect(self.request_visible_thumbnails)
+        self.gallery_list.verticalScrollBar().valueChanged.connect(self.thumbnail_timer.start)
+        self.gallery_dock = QDockWidget("Gallery", self)
+        self.gallery_dock.setWidget(self.gallery_list)
+        self.addDockWidget(Qt.DockWidgetArea.LeftDockWidgetArea, self.gallery_dock)
+        self.gallery_dock.hide()
+        
+        # Status bar with progress of background loads and saves
+        self.status_label = QLabel("Ready")
+        self.progress = TaskProgress(self.status_label)
+        self.cache_label = QLabel()
+        self.statusBar().addWidget(self.status_label)
+        self.statusBar().addPermanentWidget(self.progress)
+        self.statusBar().addPermanentWidget(self.cache_label)
         
         self.init_ui()
         self.resize(800, 600)
@@ -36,6 +301,10 @@ class TPFViewer(QMainWindow):
         open_action.triggered.connect(self.open_image)
         file_menu.addAction(open_action)
 
+        folder_action = QAction('Open Folder', self)
+        folder_action.triggered.connect(self.open_directory)
+        file_menu.addAction(folder_action)
+
         sample_action = QAction('Sample Image', self)
         sample_action.triggered.connect(self.load_sample_image)
         file_menu.addAction(sample_action)
@@ -44,6 +313,23 @@ class TPFViewer(QMainWindow):
         save_action.triggered.connect(self.save_image)
         file_menu.addAction(save_action)
 
+        view_menu = menubar.addMenu('View')
+
+        # Arrow keys are left to the scroll area
+        next_action = QAction('Next Image', self)
+        next_action.setShortcuts([QKeySequence(Qt.Key.Key_PageDown), QKeySequence(Qt.Key.Key_Space)])
+        next_action.triggered.connect(lambda: self.show_neighbor(1))
+        view_menu.addAction(next_action)
+
+        previous_action = QAction('Previous Image', self)
+        previous_action.setShortcuts([QKeySequence(Qt.Key.Key_PageUp), QKeySequence(Qt.Key.Key_Backspace)])
+        previous_action.triggered.connect(lambda: self.show_neighbor(-1))
+        view_menu.addAction(previous_action)
+
+        cache_action = QAction('Image Cache Size...', self)
+        cache_action.triggered.connect(self.ask_cache_size)
+        view_menu.addAction(cache_action)
+
     def create_toolbar(self):
         toolbar = QToolBar()
         self.addToolBar(toolbar)
@@ -59,13 +345,217 @@ class TPFViewer(QMainWindow):
         toolbar.addAction(zoom_out_action)
 
     def display_empty_image(self):
-        self.image_label.setPixmap(QPixmap())
+        self.shown_image = None
+        self.view.set_image(None)
 
     def open_image(self):
         file_path, _ = QFileDialog.getOpenFileName(self, "Open TPF File", "", "TPF files (*.tpf)")
         if file_path:
-            self.image = self.load_tpf(file_path)
+            self.open_file(file_path)
+
+    def open_file(self, file_path):
+        self.wanted_path = file_path
+        image = self.image_cache.get(file_path)
+        self.update_cache_label()
+        if image is not None:
+            # Decoded before or prefetched: shown on the next frame
+            if self.loading_path:
+                self.progress.cancel()
+            self.show_loaded_image(image, file_path)
+            return
+        if self.loading_path:
+            # The running decode hands over to this file once it stops
+            self.progress.cancel()
+            return
+        if file_path in self.prefetch_tasks:
+            # Already decoding in the background; shown when it is done
+            self.status_label.setText("Loading...")
+            return
+
+        # Decode in the background; rows are shown as they are decoded
+        # unless a cached pyramid can show the whole image right away
+        bands = deque()
+        stamp = file_stamp(file_path)
+        if self.progress.start("Loading...", read_bands, file_path, bands,
+                               on_finished=lambda image: self.image_loaded(file_path, stamp, image),
+                               on_failed=lambda _: self.load_stopped(file_path),
+                               on_cancelled=lambda: self.load_stopped(file_path)):
+            self.loading_path = file_path
+            self.stop_bands()
+            if not self.show_preview(file_path):
+                self.start_bands(bands)
+
+    def image_loaded(self, file_path, stamp, image):
+        self.loading_path = None
+        self.image_cache.put(file_path, stamp, image)
+        if file_path == self.wanted_path:
+            self.show_loaded_image(image, file_path)
+        else:
+            self.load_stopped(file_path)
+
+    def load_stopped(self, file_path):
+        self.loading_path = None
+        self.restore_image()
+        if self.wanted_path and self.wanted_path not in (file_path, self.image_path):
+            self.open_file(self.wanted_path)
+
+    def directory_files(self, file_path):
+        # The TPF files next to file_path, in the gallery's order
+        directory = os.path.dirname(file_path)
+        with os.scandir(directory or '.') as entries:
+            names = sorted(entry.name for entry in entries
+                           if entry.is_file() and entry.name.lower().endswith('.tpf'))
+        return [os.path.join(directory, name) for name in names]
+
+    def show_neighbor(self, step):
+        current = self.wanted_path or self.image_path
+        if not current:
+            return
+        try:
+            files = self.directory_files(current)
+        except OSError as e:
+            self.status_label.setText(f"Error: {e}")
+            return
+        # A file deleted meanwhile still has its place in the order
+        names = [os.path.basename(path) for path in files]
+        index = bisect.bisect_left(names, os.path.basename(current))
+        if index < len(names) and names[index] == os.path.basename(current):
+            index += step
+        elif step < 0:
+            index -= 1
+        if not 0 <= index < len(files):
+            self.status_label.setText("Last file" if step > 0 else "First file")
+            return
+        self.step = step
+        self.open_file(files[index])
+
+    def prefetch_neighbors(self, file_path):
+        # Decode the next files in the direction of travel and the one
+        # behind, each if it fits its share of the cache
+        try:
+            files = self.directory_files(file_path)
+        except OSError:
+            return
+        if file_path not in files:
+            return
+        index = files.index(file_path)
+        order = ([index + self.step * i for i in range(1, PREFETCH_AHEAD + 1)]
+                 + [index - self.step * i for i in range(1, PREFETCH_BEHIND + 1)])
+        wanted = [files[i] for i in order if 0 <= i < len(files)]
+        for path in [path for path in self.prefetch_tasks if path not in wanted]:
+            task = self.prefetch_tasks.pop(path)
+            task.cancel()
+            self.prefetch_pool.tryTake(task)
+        share = self.image_cache.max_bytes // (PREFETCH_AHEAD + PREFETCH_BEHIND + 1)
+        for path in wanted:
+            if path in self.prefetch_tasks or self.image_cache.contains(path):
+                continue
+            try:
+                width, height = tpf.read_size(path)
+            except (OSError, ValueError):
+                continue
+            if width * height * 4 > share:
+                continue
+            task = Task(prefetch_image, path)
+            task.signals.finished.connect(self.prefetch_ready)
+            task.signals.failed.connect(lambda _, path=path: self.prefetch_failed(path))
+            self.prefetch_tasks[path] = task
+            self.prefetch_pool.start(task)
+
+    def prefetch_ready(self, result):
+        file_path, stamp, image = result
+        self.prefetch_tasks.pop(file_path, None)
+        self.image_cache.put(file_path, stamp, image)
+        self.update_cache_label()
+        if file_path == self.wanted_path and file_path != self.image_path and not self.loading_path:
+            self.show_loaded_image(image, file_path)
+
+    def prefetch_failed(self, file_path):
+        self.prefetch_tasks.pop(file_path, None)
+        if file_path == self.wanted_path and file_path != self.image_path and not self.loading_path:
+            # Waiting for it; a decode of its own reports the error
+            self.open_file(file_path)
+
+    def update_cache_label(self):
+        cache = self.image_cache
+        self.cache_label.setText(f"Cache: {cache.hits} hits, {cache.misses} misses, "
+                                 f"{cache.size / 2**20:.0f}/{cache.max_bytes / 2**20:.0f} MB")
+
+    def ask_cache_size(self):
+        size, ok = QInputDialog.getInt(self, "Image Cache", "Memory for decoded images (MB):",
+                                       self.image_cache.max_bytes // 2**20, 0, 1 << 20)
+        if ok:
+            self.image_cache.set_max_bytes(size * 2**20)
+            self.update_cache_label()
+
+    def show_preview(self, file_path):
+        # A pyramid cached from an earlier visit stands in until the decode ends
+        levels = pyramid.load_cached(file_path, PREVIEW_MAX_SIZE)
+        if not levels:
+            return False
+        try:
+            full_size = tpf.read_size(file_path)
+        except (OSError, ValueError):
+            return False
+        levels = [None if level is None else tpf.to_qimage(level, QImage.Format.Format_RGB32)
+                  for level in levels]
+        self.previewing = True
+        self.view.set_levels(levels, full_size)
+        self.view.set_zoom(self.zoom_level)
+        return True
+
+    def start_bands(self, bands):
+        # Bands are drained once per display frame, however fast they come
+        self.previewing = True
+        self.loading_bands = bands
+        rate = self.screen().refreshRate() or 60
+        self.band_timer.start(max(1, int(1000 / rate)))
+
+    @tracing.traced('show bands')
+    def show_loaded_bands(self):
+        top = bottom = None
+        while self.loading_bands:
+            pixels, band_top, band_bottom = self.loading_bands.popleft()
+            if pixels is not self.loading_pixels:
+                # The first band is the blank raster; the view borrows it
+                # and sees every row the decoder writes from then on
+                self.loading_pixels = pixels
+                height, width = pixels.shape[:2]
+                self.view.set_levels([tpf.to_qimage(pixels)], (width, height))
+                self.view.set_zoom(self.zoom_level)
+            elif band_bottom > band_top:
+                top = band_top if top is None else min(top, band_top)
+                bottom = band_bottom if bottom is None else max(bottom, band_bottom)
+        if top is not None:
+            self.view.update_rows(top, bottom)
+
+    def stop_bands(self):
+        # Only called once the view has let go of the borrowed raster
+        self.band_timer.stop()
+        self.loading_bands = None
+        self.loading_pixels = None
+
+    def restore_image(self):
+        # Drop a preview whose decode did not finish
+        if not self.previewing:
+            return
+        self.previewing = False
+        self.shown_image = None
+        if self.image is not None:
             self.display_image()
+        else:
+            self.display_empty_image()
+        self.stop_bands()
+
+    def show_loaded_image(self, image, file_path=None):
+        self.image = image
+        self.image_path = file_path
+        self.previewing = False
+        self.status_label.setText(f"{image.width()}x{image.height()}")
+        self.display_image()
+        if file_path:
+            self.setWindowTitle(f"TPF Image Viewer - {os.path.basename(file_path)}")
+            self.prefetch_neighbors(file_path)
 
     def open_directory(self):
         dir_path = QFileDialog.getExistingDirectory(self, "Select Directory")
@@ -74,22 +564,109 @@ class TPFViewer(QMainWindow):
             self.load_gallery(dir_path)
 
     def load_gallery(self, directory):
+        self.clear_gallery()
+        try:
+            with os.scandir(directory) as entries:
+                files = sorted(entry.name for entry in entries
+                               if entry.is_file() and entry.name.lower().endswith('.tpf'))
+        except OSError as e:
+            self.status_label.setText(f"Error: {e}")
+            return
+
+        # Placeholders go in at once; thumbnails arrive as they are decoded
+        for file in files:
+            item = QListWidgetItem(file)
+            item.setSizeHint(QSize(thumbnails.THUMBNAIL_SIZE + 16, thumbnails.THUMBNAIL_SIZE + 32))
+            path = os.path.join(directory, file)
+            item.setData(Qt.ItemDataRole.UserRole, path)
+            self.gallery_list.addItem(item)
+            self.gallery_items[path] = item
+        self.gallery_dock.show()
+        self.status_label.setText(f"{len(files)} TPF files")
+        self.thumbnail_timer.start()
+
+    def clear_gallery(self):
+        # Queued thumbnails of the previous folder are dropped, running ones stop
+        self.thumbnail_pool.clear()
+        for task in self.thumbnail_tasks.values():
+            task.cancel()
+        self.thumbnail_tasks = {}
+        self.thumbnail_failures = {}
+        self.gallery_items = {}
         self.gallery_list.clear()
-        for file in os.listdir(directory):
-            if file.endswith('.tpf'):
-                self.gallery_list.addItem(file)
+
+    def request_visible_thumbnails(self):
+        if not self.gallery_items:
+            return
+        viewport = self.gallery_list.viewport().rect()
+        for row in self.visible_gallery_rows():
+            item = self.gallery_list.item(row)
+            if not self.gallery_list.visualItemRect(item).intersects(viewport):
+                continue
+            path = item.data(Qt.ItemDataRole.UserRole)
+            if path in self.thumbnail_tasks or not item.icon().isNull():
+                continue
+            stamp = file_stamp(path)
+            if path in self.thumbnail_failures and self.thumbnail_failures[path] == stamp:
+                continue
+            task = Task(load_thumbnail_image, path)
+            task.signals.finished.connect(self.thumbnail_ready)
+            task.signals.failed.connect(lambda _, path=path, stamp=stamp: self.thumbnail_failed(path, stamp))
+            self.thumbnail_tasks[path] = task
+            self.thumbnail_pool.start(task)
+
+    def visible_gallery_rows(self):
+        # The items have one size and sit in a grid, so the rows in view
+        # follow from the positions of the first item and its neighbours
+        # instead of from every item's rectangle
+        gallery = self.gallery_list
+        count = gallery.count()
+        first = gallery.visualItemRect(gallery.item(0))
+        per_row = 1
+        while per_row < count and gallery.visualItemRect(gallery.item(per_row)).y() == first.y():
+            per_row += 1
+        if per_row >= count:
+            return range(count)
+        step = gallery.visualItemRect(gallery.item(per_row)).y() - first.y()
+        if step <= 0:
+            return range(count)
+        height = gallery.viewport().height()
+        top = max(0, (-first.y() - first.height()) // step + 1)
+        bottom = (height - 1 - first.y()) // step
+        return range(min(count, top * per_row), min(count, (bottom + 1) * per_row))
+
+    def thumbnail_failed(self, path, stamp):
+        if self.thumbnail_tasks.pop(path, None) is not None:
+            self.thumbnail_failures[path] = stamp
+
+    def thumbnail_ready(self, result):
+        path, image = result
+        if self.thumbnail_tasks.pop(path, None) is None:
+            return
+        item = self.gallery_items.get(path)
+        if item is not None:
+            item.setIcon(QIcon(QPixmap.fromImage(image)))
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        if self.gallery_items:
+            self.thumbnail_timer.start()
 
     def on_gallery_item_clicked(self, item):
-        if self.current_directory:
-            file_path = os.path.join(self.current_directory, item.text())
-            self.image = self.load_tpf(file_path)
-            self.display_image()
+        file_path = item.data(Qt.ItemDataRole.UserRole)
+        if file_path:
+            self.open_file(file_path)
 
     def load_sample_image(self):
+        # PIL's drawing and font modules are only needed here
+        from PIL import Image, ImageDraw, ImageFont
         # Create canvas with larger dimensions
         width, height = 800, 400
-        self.image = Image.new('RGB', (width, height), (255, 255, 255))
-        draw = ImageDraw.Draw(self.image)
+        sample = Image.new('RGB', (width, height), (255, 255, 255))
+        self.image_path = None
+        self.wanted_path = None
+        self.previewing = False
+        draw = ImageDraw.Draw(sample)
         text = "Sample Image"
 
         try:
@@ -123,58 +700,39 @@ class TPFViewer(QMainWindow):
             text_y = (height - text_height) // 2
             draw.text((text_x, text_y), text, fill="black", font=font)
         
+        self.image = tpf.pil_to_qimage(sample)
         self.display_image()
 
     def load_tpf(self, file_path):
-        with open(file_path, 'r') as file:
-            lines = file.readlines()
-            dimensions = lines[0].strip().split('x')
-            width, height = int(dimensions[0]), int(dimensions[1])
-            image = Image.new('RGB', (width, height), (255, 255, 255))
-
-            for line in lines[1:]:
-                parts = line.strip().split(' ')
-                coords = parts[0].strip('()').split(',')
-                color = tuple(map(int, parts[1].strip('()').split(',')))
-                
-                if len(coords) == 3:  # Run-length encoded
-                    x, y, count = map(int, coords)
-                    for i in range(count):
-                        image.putpixel((x + i, y), color)
-                else:  # Single pixel
-                    x, y = map(int, coords)
-                    image.putpixel((x, y), color)
-
-            return image
+        return read_image(file_path)
 
+    @tracing.traced('display')
     def display_image(self):
-        if self.image:
-            # Calculate new dimensions while maintaining aspect ratio
-            new_width = int(self.image.width * self.zoom_level)
-            new_height = int(self.image.height * self.zoom_level)
-            
-            # Resize the image using NEAREST sampling to keep pixels sharp
-            resized_image = self.image.resize(
-                (new_width, new_height),
-                Image.NEAREST
-            )
-            
-            # Convert to QImage and maintain stride alignment
-            width = resized_image.width
-            height = resized_image.height
-            bytes_per_line = 3 * width  # RGB format = 3 bytes per pixel
-            
-            qimage = QImage(
-                resized_image.tobytes(), 
-                width, 
-                height, 
-                bytes_per_line,
-                QImage.Format.Format_RGB888
-            )
-            
-            pixmap = QPixmap.fromImage(qimage)
-            self.image_label.setPixmap(pixmap)
-            self.image_label.adjustSize()
+        # The image is shown as it is; zooming only changes the tile transform
+        if self.image is not None and not self.previewing and self.image is not self.shown_image:
+            self.shown_image = self.image
+            self.view.set_image(self.image)
+            self.stop_bands()
+            self.start_pyramid(self.image)
+        self.view.set_zoom(self.zoom_level)
+
+    def start_pyramid(self, image):
+        # Zoomed-out views are served from the pyramid once it is built
+        if self.pyramid_task:
+            self.pyramid_task.cancel()
+        self.pyramid_image = image
+        self.pyramid_task = Task(build_pyramid, image, self.image_path)
+        self.pyramid_task.signals.finished.connect(self.pyramid_ready)
+        QThreadPool.globalInstance().start(self.pyramid_task)
+
+    def pyramid_ready(self, result):
+        image, levels = result
+        if image is not self.pyramid_image:
+            return
+        self.pyramid_task = None
+        self.pyramid_image = None
+        if self.view.levels and self.view.levels[0] is not None:
+            self.view.set_levels([self.view.levels[0]] + levels[1:], self.view.full_size)
 
     def wheelEvent(self, event):
         # More controlled zoom with minimum and maximum limits
@@ -198,54 +756,71 @@ class TPFViewer(QMainWindow):
         self.display_image()
 
     def save_image(self):
-        if not self.image:
+        if self.image is None:
             return
             
-        file_path, _ = QFileDialog.getSaveFileName(
+        file_path, selected_filter = QFileDialog.getSaveFileName(
             self,
             "Save TPF File",
             "",
-            "TPF files (*.tpf)"
+            "TPF files (*.tpf);;Plain TPF files (*.tpf);;Binary TPF files (*.tpf)"
         )
         
         if file_path:
             if not file_path.endswith('.tpf'):
                 file_path += '.tpf'
                 
-            with open(file_path, 'w') as file:
-                # Write dimensions
-                file.write(f"{self.image.width}x{self.image.height}\n")
-                
-                # Run-length encoding for pixels
-                current_color = None
-                count = 0
-                current_y = 0
-                
-                for y in range(self.image.height):
-                    for x in range(self.image.width):
-                        color = self.image.getpixel((x, y))
-                        
-                        if current_color is None:
-                            current_color = color
-                            count = 1
-                            continue
-                        
-                        if color == current_color and x < self.image.width - 1:
-                            count += 1
-                        else:
-                            # Write the run
-                            if count > 1:
-                                file.write(f"({x-count},{y},{count}) ({current_color[0]},{current_color[1]},{current_color[2]})\n")
-                            else:
-                                file.write(f"({x-1},{y}) ({current_color[0]},{current_color[1]},{current_color[2]})\n")
-                            current_color = color
-                            count = 1
-                    
-                    # Write the last run of each line
-                    if count > 0:
-                        file.write(f"({self.image.width-count},{y},{count}) ({current_color[0]},{current_color[1]},{current_color[2]})\n")
+            # Plain TPF is one line per pixel; the default stores runs of palette colors
+            tpf_format = 'palette'
+            if selected_filter.startswith("Plain"):
+                tpf_format = 'text'
+            elif selected_filter.startswith("Binary"):
+                tpf_format = 'binary'
+            # Write in the background; a cancelled save leaves no file behind
+            self.progress.start("Saving...", write_image, file_path, self.image, tpf_format,
+                                on_finished=lambda _: self.status_label.setText("Saved"))
+
+def read_image(file_path, progress=None):
+    # Large text files are split over all cores
+    pixels = tpf.read_parallel(file_path, background=(255, 255, 255), progress=progress)
+    return tpf.to_qimage(pixels, QImage.Format.Format_RGB32)
+
+def read_bands(file_path, bands, progress=None):
+    # Every band is queued for the UI thread, which shows them per frame
+    for pixels, top, bottom in tpf.iter_bands_parallel(file_path, background=(255, 255, 255),
+                                                       progress=progress):
+        bands.append((pixels, top, bottom))
+    # Converting here keeps the one copy of the load off the UI thread
+    return tpf.to_qimage(pixels, QImage.Format.Format_RGB32)
+
+def prefetch_image(file_path, progress=None):
+    # The stamp is taken first, so a file changed during the decode is not
+    # cached as the new version
+    stamp = file_stamp(file_path)
+    return file_path, stamp, read_image(file_path, progress)
+
+def load_thumbnail_image(file_path, progress=None):
+    pixels = thumbnails.load(file_path)
+    # Reporting lets a cancelled folder stop before the conversion
+    progress(1, 1)
+    return file_path, tpf.to_qimage(pixels, QImage.Format.Format_RGB32)
+
+def build_pyramid(image, file_path, progress=None):
+    # The task holds the image, so the view of its pixels stays valid
+    levels = pyramid.for_image(tpf.from_qimage(image), file_path)
+    # Reporting lets a superseded build stop before the conversion
+    progress(1, 1)
+    return image, [None] + [tpf.to_qimage(level, QImage.Format.Format_RGB32) for level in levels[1:]]
+
+def write_image(file_path, image, tpf_format, progress=None):
+    pixels = tpf.from_qimage(image)
+    if tpf_format == 'binary':
+        tpf.write_binary(file_path, pixels, progress=progress)
+    else:
+        tpf.write(file_path, pixels, version=None, progress=progress, tpf_format=tpf_format)
 
 if __name__ == "__main__":
+    sys.argv = tracing.from_argv(sys.argv)
     app = QApplication(sys.argv)
     viewer = TPFViewer()
     viewer.show()
@@ -0,0 +1,145 @@
+from PyQt6.QtWidgets import QWidget, QHBoxLayout, QProgressBar, QPushButton
+from PyQt6.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+
+import tracing
+
+
+class Cancelled(Exception):
+    pass
+
+
+class TaskSignals(QObject):
+    progress = pyqtSignal(object, object)
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(str)
+    cancelled = pyqtSignal()
+
+
+class Task(QRunnable):
+    """Run func(*args, progress=...) on the thread pool.
+
+    func reports through the progress(done, total) callback it is given;
+    once cancel() is called the next report raises Cancelled inside the
+    worker, so the codec's cleanup (e.g. tpf.atomic_path) runs there. The
+    result is emitted as-is, so arrays and images reach the UI thread
+    without being copied.
+    """
+
+    def __init__(self, func, *args):
+        super().__init__()
+        self.func = func
+        self.args = args
+        # The span a traced run is recorded under, see tracing.summary
+        self.name = getattr(getattr(func, 'func', func), '__name__', 'task')
+        self.signals = TaskSignals()
+        self.is_cancelled = False
+
+    def cancel(self):
+        self.is_cancelled = True
+
+    def report(self, done, total):
+        if self.is_cancelled:
+            raise Cancelled()
+        self.signals.progress.emit(done, total)
+
+    def run(self):
+        try:
+            with tracing.span(self.name):
+                result = self.func(*self.args, progress=self.report)
+        except Cancelled:
+            self.signals.cancelled.emit()
+        except Exception as e:
+            self.signals.failed.emit(str(e))
+        else:
+            self.signals.finished.emit(result)
+
+
+class TaskProgress(QWidget):
+    """Progress bar and Cancel button that drive one Task at a time.
+
+    The callbacks given to start() are invoked from this widget's slots, so
+    they always run on the UI thread.
+    """
+
+    def __init__(self, status_label=None, parent=None):
+        super().__init__(parent)
+        self.status_label = status_label
+        self.task = None
+
+        layout = QHBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setRange(0, 1000)
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.clicked.connect(self.cancel)
+        layout.addWidget(self.progress_bar)
+        layout.addWidget(self.cancel_button)
+        self.hide()
+
+    def is_busy(self):
+        return self.task is not None
+
+    def start(self, message, func, *args, on_finished=None, on_failed=None, on_cancelled=None):
+        if self.is_busy():
+            self.set_status("Busy, wait for the current operation or cancel it")
+            return False
+
+        self.task = Task(func, *args)
+        self.on_finished = on_finished
+        self.on_failed = on_failed
+        self.on_cancelled = on_cancelled
+        self.task.signals.progress.connect(self.update_progress)
+        self.task.signals.finished.connect(self.task_finished)
+        self.task.signals.failed.connect(self.task_failed)
+        self.task.signals.cancelled.connect(self.task_cancelled)
+
+        self.progress_bar.setValue(0)
+        self.cancel_button.setEnabled(True)
+        self.set_status(message)
+        self.show()
+        QThreadPool.globalInstance().start(self.task)
+        return True
+
+    def cancel(self):
+        if self.task:
+            self.task.cancel()
+            self.cancel_button.setEnabled(False)
+            self.set_status("Cancelling...")
+
+    def set_status(self, text):
+        if self.status_label is not None:
+            self.status_label.setText(text)
+
+    def update_progress(self, done, total):
+        if total:
+            self.progress_bar.setValue(int(1000 * done / total))
+
+    def task_finished(self, result):
+        callback = self.on_finished
+        name = self.task.name
+        self.reset()
+        if callback:
+            callback(result)
+        if tracing.enabled():
+            self.set_status(tracing.summary(name))
+
+    def task_failed(self, message):
+        callback = self.on_failed
+        self.reset()
+        self.set_status(f"Error: {message}")
+        if callback:
+            callback(message)
+
+    def task_cancelled(self):
+        callback = self.on_cancelled
+        self.reset()
+        self.set_status("Cancelled")
+        if callback:
+            callback()
+
+    def reset(self):
+        self.task = None
+        self.on_finished = None
+        self.on_failed = None
+        self.on_cancelled = None
+        self.hide()